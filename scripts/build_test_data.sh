@@ -1,14 +1,23 @@
 #!/bin/bash
+# Builds the test data and checks it out into xemutest/data from the test data
+# cache (see xemutest/data_cache.py), which only writes files that changed. With
+# --offline, the latest test data in the cache is checked out without building.
 if [[ ! -d xemutest ]]; then
 	echo "Run from root dir"
 	exit 1
 fi
 
 set -ex
-target=data
-image=xemu-test-data-tmp-img
-docker build --target $target -t $image .
-container=$(docker create $image "")
-docker cp $container:/data xemutest/
-docker rm $container
-docker rmi -f $image
+if [[ "$1" != "--offline" ]]; then
+	target=data
+	image=xemu-test-data-tmp-img
+	docker build --target $target -t $image .
+	container=$(docker create $image "")
+	build_dir=$(mktemp -d)
+	trap 'rm -rf "$build_dir"' EXIT
+	docker cp $container:/data "$build_dir/"
+	docker rm $container
+	docker rmi -f $image
+	python3 -m xemutest.data_cache ingest "$build_dir/data" --no-checkout
+fi
+python3 -m xemutest.data_cache checkout
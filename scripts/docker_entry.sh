@@ -2,7 +2,13 @@
 exec 2>&1
 
 XVFB_WHD=640x480x24
-DISPLAY=:99
+# Number of X displays to start, one per concurrently running xemu instance
+XEMUTEST_DISPLAYS="${XEMUTEST_DISPLAYS:-1}"
+FIRST_DISPLAY_NUM=99
+DISPLAY=":${FIRST_DISPLAY_NUM}"
+# Extracted AppImages are cached here, keyed by the AppImage hash. Mount a volume
+# here to reuse extracted builds across containers.
+XEMUTEST_CACHE="${XEMUTEST_CACHE:-/work/cache}"
 
 if [ $# -eq 0 ]; then
 	echo "No launch command provided"
@@ -27,14 +33,23 @@ else
 
     echo "[*] Using xemu from ${appimage_file}"
 
-    chmod +x "${appimage_file}"
-    "${appimage_file}" --appimage-extract > /dev/null 2>&1
-    export PATH="$PWD/squashfs-root/usr/bin:${PATH}"
+    appimage_hash="$(sha256sum "${appimage_file}" | cut -d' ' -f1)"
+    xemu_root="${XEMUTEST_CACHE}/xemu-${appimage_hash}"
+    if [[ -d "${xemu_root}" ]]; then
+      echo "[*] Using cached extraction ${xemu_root}"
+    else
+      echo "[*] Extracting to ${xemu_root}"
+      mkdir -p "${XEMUTEST_CACHE}"
+      extract_dir="$(mktemp -d "${XEMUTEST_CACHE}/.extract.XXXXXX")"
+      chmod +x "${appimage_file}"
+      (cd "${extract_dir}" && "${appimage_file}" --appimage-extract > /dev/null 2>&1)
+      # Rename into place so concurrent containers never see a partial extraction
+      mv -T "${extract_dir}/squashfs-root" "${xemu_root}" || [[ -d "${xemu_root}" ]]
+      rm -rf "${extract_dir}"
+    fi
+    export PATH="${xemu_root}/usr/bin:${PATH}"
 fi
 
-echo "exec i3" >> ~/.xinitrc
-chmod +x ~/.xinitrc
-
 mkdir -p ~/.config/i3
 cat <<EOF >>~/.config/i3/config
 border none
@@ -42,16 +57,37 @@ bar {
 }
 EOF
 
-echo "[*] Starting Xvfb"
-xinit -- /usr/bin/Xvfb $DISPLAY -ac -screen 0 "$XVFB_WHD" -nolisten tcp +extension GLX +render -noreset 1>/dev/null 2>&1 &
-Xvfb_pid="$!"
-echo "[~] Waiting for Xvfb (PID: $Xvfb_pid) to be ready..."
-set +e
-while ! xdpyinfo -display "${DISPLAY}" 1>/dev/null 2>&1; do
-		sleep 0.1
+# Xvfb writes the display number to -displayfd once it accepts connections, so
+# wait for that instead of polling the server
+ready_dir="$(mktemp -d)"
+display_pool=()
+ready_fds=()
+for ((i = 0; i < XEMUTEST_DISPLAYS; i++)); do
+	display_num=$((FIRST_DISPLAY_NUM + i))
+	echo "[*] Starting Xvfb on :${display_num}"
+	mkfifo "${ready_dir}/${display_num}"
+	# Open read-write so the servers start in parallel instead of each blocking
+	# until its fifo is read
+	exec {ready_fd}<>"${ready_dir}/${display_num}"
+	ready_fds+=("${ready_fd}")
+	/usr/bin/Xvfb ":${display_num}" -displayfd 3 -ac -screen 0 "$XVFB_WHD" -nolisten tcp +extension GLX +render -noreset 3>"${ready_dir}/${display_num}" 1>/dev/null 2>&1 &
+	display_pool+=(":${display_num}")
 done
-set -e
+echo "[~] Waiting for Xvfb to be ready..."
+for ((i = 0; i < XEMUTEST_DISPLAYS; i++)); do
+	display="${display_pool[i]}"
+	if ! read -r -t 30 -u "${ready_fds[i]}" _; then
+		echo "Xvfb on ${display} failed to start"
+		exit 1
+	fi
+	exec {ready_fds[i]}<&-
+	DISPLAY="${display}" i3 1>/dev/null 2>&1 &
+done
+rm -rf "${ready_dir}"
+DISPLAY="${display_pool[0]}"
 export DISPLAY
+XEMUTEST_DISPLAY_POOL="$(IFS=,; echo "${display_pool[*]}")"
+export XEMUTEST_DISPLAY_POOL
 
 echo "[*] Starting VNC server"
 x11vnc -forever 1>/dev/null 2>&1 &
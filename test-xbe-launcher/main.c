@@ -0,0 +1,107 @@
+// Runs the test XBEs listed in E:\xemutest\batch.txt one after another.
+//
+// Each test writes C:\results\results.txt (and test_results.txt, see
+// test-xbe/xemutest_results.h) and reboots, which boots this launcher
+// again from the disc. The launcher then moves the results of the previous test
+// to C:\results\<name>\ and launches the first test that has no results
+// directory yet, until all have run.
+
+#include <hal/debug.h>
+#include <hal/video.h>
+#include <hal/xbox.h>
+#include <windows.h>
+#include <nxdk/mount.h>
+#include <stdio.h>
+#include <string.h>
+
+#define MANIFEST_PATH "E:\\xemutest\\batch.txt"
+#define TESTS_PATH "E:\\xemutest\\tests\\"
+#define RESULTS_PATH "C:\\results\\"
+#define PROGRESS_PATH RESULTS_PATH "batch_progress.txt"
+#define MAX_NAME 64
+
+static void log_progress(const char *message, const char *name)
+{
+    FILE *f = fopen(PROGRESS_PATH, "a");
+    if (f) {
+        fprintf(f, "%s%s\n", message, name);
+        fclose(f);
+    }
+}
+
+static const char *result_files[] = {"results.txt", "test_results.txt"};
+
+static void collect_results(const char *name)
+{
+    char src[MAX_PATH];
+    char dest[MAX_PATH];
+
+    if (!name[0]) {
+        return;
+    }
+    for (size_t i = 0; i < sizeof(result_files) / sizeof(result_files[0]); i++) {
+        snprintf(src, sizeof(src), RESULTS_PATH "%s", result_files[i]);
+        snprintf(dest, sizeof(dest), RESULTS_PATH "%s\\%s", name, result_files[i]);
+        MoveFileA(src, dest);
+    }
+}
+
+int main(void)
+{
+    char name[MAX_NAME];
+    char previous[MAX_NAME] = "";
+    char path[MAX_PATH];
+
+    XVideoSetMode(640, 480, 32, REFRESH_DEFAULT);
+
+    if (!nxMountDrive('C', "\\Device\\Harddisk0\\Partition2\\") ||
+        !nxMountDrive('E', "\\Device\\Harddisk0\\Partition1\\")) {
+        debugPrint("Failed to mount drives!\n");
+        goto shutdown;
+    }
+    CreateDirectoryA("C:\\results", NULL);
+
+    FILE *manifest = fopen(MANIFEST_PATH, "r");
+    if (!manifest) {
+        debugPrint("Failed to open " MANIFEST_PATH "\n");
+        goto shutdown;
+    }
+
+    while (fgets(name, sizeof(name), manifest)) {
+        name[strcspn(name, "\r\n")] = '\0';
+        if (!name[0]) {
+            continue;
+        }
+        snprintf(path, sizeof(path), RESULTS_PATH "%s", name);
+        if (GetFileAttributesA(path) != INVALID_FILE_ATTRIBUTES) {
+            strcpy(previous, name);
+            continue;
+        }
+
+        fclose(manifest);
+        collect_results(previous);
+        CreateDirectoryA(path, NULL);
+        log_progress("Starting ", name);
+
+        snprintf(path, sizeof(path), TESTS_PATH "%s.xbe", name);
+        debugPrint("Launching %s\n", path);
+        XLaunchXBE(path);
+
+        // Only returns if the launch failed, continue with the next test
+        log_progress("Failed to launch ", name);
+        XReboot();
+        goto shutdown;
+    }
+
+    fclose(manifest);
+    collect_results(previous);
+    log_progress("Completed batch", "");
+
+shutdown:
+    HalInitiateShutdown();
+    while (1) {
+        Sleep(2000);
+    }
+
+    return 0;
+}
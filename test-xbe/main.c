@@ -1,19 +1,44 @@
 #include <hal/debug.h>
 
 #include <hal/video.h>
+#include <hal/xbox.h>
 #include <windows.h>
 #include <nxdk/mount.h>
 #include <stdio.h>
 #include <string.h>
 
-int main(void)
+#include "xemutest_results.h"
+
+#define SCRATCH_PATH "C:\\results\\scratch.bin"
+#define SCRATCH_SIZE (1024 * 1024)
+
+static char scratch[SCRATCH_SIZE];
+static char readback[SCRATCH_SIZE];
+
+static BOOL write_scratch(void)
 {
-    XVideoSetMode(640, 480, 32, REFRESH_DEFAULT);
+    FILE *f = fopen(SCRATCH_PATH, "wb");
+    if (!f) {
+        return FALSE;
+    }
+    size_t written = fwrite(scratch, 1, sizeof(scratch), f);
+    return fclose(f) == 0 && written == sizeof(scratch);
+}
 
-    for (int i = 0; i < 2; i++) {
-        debugPrint("Hello nxdk!\n");
-        Sleep(500);
+static BOOL read_scratch(void)
+{
+    FILE *f = fopen(SCRATCH_PATH, "rb");
+    if (!f) {
+        return FALSE;
     }
+    size_t read = fread(readback, 1, sizeof(readback), f);
+    fclose(f);
+    return read == sizeof(readback) && !memcmp(scratch, readback, sizeof(scratch));
+}
+
+int main(void)
+{
+    XtResults results;
 
     BOOL ret = nxMountDrive('C', "\\Device\\Harddisk0\\Partition2\\");
     if (!ret) {
@@ -21,19 +46,53 @@ int main(void)
         goto shutdown;
     }
 
-    CreateDirectoryA("C:\\results", NULL);
+    if (!xt_open(&results)) {
+        goto shutdown;
+    }
+
+    xt_start(&results, "video_mode");
+    xt_finish(&results, XVideoSetMode(640, 480, 32, REFRESH_DEFAULT),
+              "Failed to set 640x480 video mode");
 
+    xt_start(&results, "sleep");
+    for (int i = 0; i < 2; i++) {
+        debugPrint("Hello nxdk!\n");
+        Sleep(500);
+    }
+    xt_finish(&results, TRUE, NULL);
+
+    for (int i = 0; i < SCRATCH_SIZE; i++) {
+        scratch[i] = (char)(i * 31);
+    }
+    xt_start(&results, "file_write");
+    if (xt_finish(&results, write_scratch(), "Failed to write " SCRATCH_PATH)) {
+        xt_start(&results, "file_read");
+        xt_finish(&results, read_scratch(), "Read back data differs");
+    } else {
+        xt_skip(&results, "file_read", "Nothing was written");
+    }
+    DeleteFileA(SCRATCH_PATH);
+
+    int failures = xt_close(&results);
+
+    // Plain result of earlier versions of the harness
     FILE *f = fopen("C:\\results\\results.txt", "w");
     if (!f) {
         goto shutdown;
     }
 
-    const char *buf = "Success";
+    const char *buf = failures ? "Failure" : "Success";
     fwrite(buf, strlen(buf), 1, f);
     fclose(f);
 
 
 shutdown:
+    // When run by the batch launcher, reboot into it to run the next test
+    if (nxMountDrive('E', "\\Device\\Harddisk0\\Partition1\\") &&
+        GetFileAttributesA("E:\\xemutest\\batch.txt") != INVALID_FILE_ATTRIBUTES) {
+        XReboot();
+    }
+
     HalInitiateShutdown();
     while (1) {
         Sleep(2000);
@@ -0,0 +1,99 @@
+// Structured results of guest test programs, read by xemutest.
+//
+// Records are appended to C:\results\test_results.txt, one per line:
+//
+//   xemutest-results 1 <ticks per second>
+//   <PASS|FAIL|SKIP>\t<name>\t<duration in ticks>\t<message>
+//
+// Durations are measured with the performance counter of the guest, so that they
+// can be tracked across xemu builds. Every record is flushed as it is written, so
+// the records of checks that ran before a crash are kept.
+//
+// Usage:
+//
+//   XtResults results;
+//   xt_open(&results);
+//   xt_start(&results, "mount_c");
+//   xt_finish(&results, nxMountDrive(...), "Failed to mount C:");
+//   xt_close(&results);
+
+#ifndef XEMUTEST_RESULTS_H
+#define XEMUTEST_RESULTS_H
+
+#include <windows.h>
+#include <stdio.h>
+
+#define XT_RESULTS_DIR "C:\\results"
+#define XT_RESULTS_PATH XT_RESULTS_DIR "\\test_results.txt"
+
+typedef struct {
+    FILE *file;
+    const char *name;
+    LARGE_INTEGER start;
+    int failures;
+} XtResults;
+
+static BOOL xt_open(XtResults *results)
+{
+    LARGE_INTEGER frequency;
+
+    results->name = NULL;
+    results->failures = 0;
+    CreateDirectoryA(XT_RESULTS_DIR, NULL);
+    results->file = fopen(XT_RESULTS_PATH, "w");
+    if (!results->file) {
+        return FALSE;
+    }
+    QueryPerformanceFrequency(&frequency);
+    fprintf(results->file, "xemutest-results 1 %llu\n", frequency.QuadPart);
+    fflush(results->file);
+    return TRUE;
+}
+
+// Start timing a check
+static void xt_start(XtResults *results, const char *name)
+{
+    results->name = name;
+    QueryPerformanceCounter(&results->start);
+}
+
+static void xt_record(XtResults *results, const char *status, const char *message)
+{
+    LARGE_INTEGER end;
+
+    QueryPerformanceCounter(&end);
+    if (results->file && results->name) {
+        fprintf(results->file, "%s\t%s\t%llu\t%s\n", status, results->name,
+                end.QuadPart - results->start.QuadPart, message ? message : "");
+        fflush(results->file);
+    }
+    results->name = NULL;
+}
+
+// Record the outcome of the check started last, with a message if it failed
+static BOOL xt_finish(XtResults *results, BOOL passed, const char *message)
+{
+    if (!passed) {
+        results->failures++;
+    }
+    xt_record(results, passed ? "PASS" : "FAIL", passed ? "" : message);
+    return passed;
+}
+
+static void xt_skip(XtResults *results, const char *name, const char *reason)
+{
+    xt_start(results, name);
+    xt_record(results, "SKIP", reason);
+}
+
+// Returns the number of failed checks
+static int xt_close(XtResults *results)
+{
+    if (results->file) {
+        fclose(results->file);
+        results->file = NULL;
+    }
+    return results->failures;
+}
+
+#endif
@@ -1,10 +1,25 @@
-from . import ci
-from .env import Environment
-from .comparators import GoldenImageComparator
-from .hdd_manager import HddManager
-from .test_base import TestBase, XemuTestBase, TestResult, TestStatus
-from .video_capture import VideoCapture
-from .xemu_manager import XemuManager
+"""xemu automated tests.
+
+Submodules are imported on first access of the names below (PEP 562), so that
+tools which only need part of the package, such as result processing, do not pay
+for importing the test machinery and its dependencies.
+"""
+
+import importlib
+
+# Module defining each name, relative to the package
+_LAZY_NAMES = {
+    "ci": "",
+    "Environment": ".env",
+    "GoldenImageComparator": ".comparators",
+    "HddManager": ".hdd_manager",
+    "TestBase": ".test_base",
+    "TestResult": ".test_base",
+    "TestStatus": ".test_base",
+    "XemuTestBase": ".test_base",
+    "VideoCapture": ".video_capture",
+    "XemuManager": ".xemu_manager",
+}
 
 __all__ = (
     "ci",
@@ -18,3 +33,19 @@ __all__ = (
     "VideoCapture",
     "XemuManager",
 )
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_NAMES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name = _LAZY_NAMES[name]
+    if module_name:
+        value = getattr(importlib.import_module(module_name, __name__), name)
+    else:
+        value = importlib.import_module(f".{name}", __name__)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,17 +1,84 @@
 import argparse
-import importlib
-import inspect
+import atexit
+import dataclasses
+import functools
+import json
 import logging
+import shutil
 import sys
+import threading
+from collections.abc import Iterator
 from pathlib import Path
 
-from xemutest import Environment, TestBase
-from xemutest import ci
-from xemutest.test_base import TestResult, TestStatus
+from xemutest import Environment
+from xemutest import benchmark, ci, html_report, scheduler
+from xemutest.artifact_pack import ArtifactPacker
+from xemutest.budget import FailureBudget
+from xemutest.comparators import COMPARE_MODES
+from xemutest.discovery import TestSelection, discover_tests
+from xemutest.display_pool import DisplayPool
+from xemutest.results_export import ResultExporter
+from xemutest.scratch import ScratchSpace, default_budget, remove_tree
+from xemutest.test_base import (
+    ResultCounts,
+    RetryPolicy,
+    TestResult,
+    TestStatus,
+    walk_results,
+)
 
 log = logging.getLogger(__name__)
 
 
+def format_status(r: TestResult) -> str:
+    match r.status:
+        case TestStatus.PASSED:
+            return "✅ Passed"
+        case TestStatus.FAILED:
+            return "❌ Failed"
+        case TestStatus.UNVERIFIED:
+            return "⚠️ Unverified"
+        case TestStatus.RUNNING:
+            return "🔄 Running"
+
+
+def collect_rows(test_result: TestResult) -> Iterator[list[str]]:
+    """Yield rows for a test and its subtests."""
+    for full_name, result in walk_results(test_result):
+        yield [full_name, format_status(result), result.duration, result.message]
+
+
+def build_job_summary(test_results_summary: dict[str, TestResult]) -> ci.JobSummary:
+    """Build the GitHub Actions job summary of all test results."""
+    summary = ci.JobSummary()
+    summary.add_heading("xemu Test Results")
+
+    counts = ResultCounts.count(test_results_summary.values())
+    summary.add_paragraph(
+        ", ".join(
+            f"{counts.total[status]} {status.name.lower()}"
+            for status in (TestStatus.PASSED, TestStatus.FAILED, TestStatus.UNVERIFIED)
+        )
+    )
+    failed_groups = [
+        [group, str(group_counts[TestStatus.FAILED]), str(group_counts.total())]
+        for group, group_counts in counts.groups.items()
+        if group_counts[TestStatus.FAILED]
+    ]
+    if failed_groups:
+        summary.add_table(headers=["Group", "Failed", "Total"], rows=failed_groups)
+
+    summary.add_table(
+        headers=["Test", "Status", "Duration", "Details"],
+        rows=(
+            row
+            for test_result in test_results_summary.values()
+            for row in collect_rows(test_result)
+        ),
+    )
+    return summary
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("xemu", help="Path to the xemu binary")
@@ -19,6 +86,109 @@ def main():
     ap.add_argument("results", help="Path to directory where results should go")
     ap.add_argument("--ffmpeg", help="Path to the ffmpeg binary")
     ap.add_argument("--perceptualdiff", help="Path to the perceptualdiff binary")
+    ap.add_argument(
+        "--compare-mode",
+        choices=COMPARE_MODES,
+        default="full",
+        help="Run perceptualdiff on every image (full), or only on images whose "
+        "pixels differ, localizing the differences it fails (tiered)",
+    )
+    ap.add_argument(
+        "-k",
+        "--select",
+        action="append",
+        metavar="PATTERN",
+        help="Only run tests matching a pattern such as 'TestXBE' or "
+        "'TestNxdkPgraphTests::suite::test' (wildcards allowed, may be repeated)",
+    )
+    ap.add_argument(
+        "--retries",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Re-run failed subtests up to N more times to detect flaky results",
+    )
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Run up to N tests or config matrix cells concurrently (default: 1)",
+    )
+    ap.add_argument(
+        "--schedule",
+        choices=scheduler.SCHEDULE_STRATEGIES,
+        default="lpt",
+        help="How to distribute jobs across workers: from a shared queue longest "
+        "first (lpt), or planned per worker with work stealing (steal)",
+    )
+    ap.add_argument(
+        "--max-failures",
+        type=int,
+        metavar="N",
+        help="Cancel the run after N failed subtests, terminating running xemu "
+        "instances and reporting the results so far. Tests that crash or hang are "
+        "counted after each xemu launch, other failures when their job finishes",
+    )
+    ap.add_argument(
+        "--max-incomplete",
+        type=float,
+        metavar="PERCENT",
+        help="Cancel the run when more than PERCENT of the tests started by xemu "
+        "did not complete (judged after 10 tests)",
+    )
+    ap.add_argument(
+        "--max-duration",
+        type=float,
+        metavar="MIN",
+        help="Cancel the run after MIN minutes of wall time",
+    )
+    ap.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        help="Serve jobs to workers over HTTP instead of running them (see "
+        "xemutest/distributed.py); -j is then the number of workers to shard for",
+    )
+    ap.add_argument(
+        "--timings",
+        metavar="PATH",
+        help="Timing history used for scheduling and sharding, updated after the "
+        "run (default: timings.json in the results directory)",
+    )
+    ap.add_argument(
+        "--scratch-budget",
+        type=int,
+        metavar="MIB",
+        help="Memory for HDD images and extracted files on tmpfs, 0 to keep them "
+        "on disk (default: half of the free space of /dev/shm)",
+    )
+    ap.add_argument(
+        "--pack-artifacts",
+        metavar="PATH",
+        help="Also pack the results directory into a ZIP archive at PATH, adding "
+        "the results of each test as it finishes",
+    )
+    ap.add_argument(
+        "--benchmark",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Benchmark mode: run the selected tests N times without video capture "
+        "and write timing statistics to benchmark.json in the results directory",
+    )
+    ap.add_argument(
+        "--warmup",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of unmeasured warm-up runs in benchmark mode (default: 1)",
+    )
+    ap.add_argument(
+        "--baseline",
+        metavar="PATH",
+        help="benchmark.json of a previous benchmark to compare against",
+    )
     ap.add_argument(
         "-v", "--verbose", action="store_true", help="Print verbose logging information"
     )
@@ -59,99 +229,188 @@ def main():
             log.error(error)
         sys.exit(1)
 
-    tests = []
     result = True
 
-    tests_dir = this_dir / "tests"
-    sys.path.append(str(tests_dir))
-    for path in tests_dir.iterdir():
-        if not path.name.startswith("test_") or path.suffix != ".py":
-            continue
-
-        module = importlib.import_module(path.stem)
-        for test_name, test_class in inspect.getmembers(module, inspect.isclass):
-            if (
-                test_name.startswith("Test")
-                and issubclass(test_class, TestBase)
-                and test_class is not TestBase
-            ):
-                tests.append((test_name, test_class))
+    selection = TestSelection(args.select)
+    tests = discover_tests(this_dir / "tests", selection)
+    if selection and not tests:
+        log.error("No tests match the selection %r", selection.patterns)
+        sys.exit(1)
 
     results_root = Path(args.results).expanduser().resolve()
     results_root.mkdir(parents=True, exist_ok=True)
 
+    scratch = ScratchSpace(
+        default_budget()
+        if args.scratch_budget is None
+        else args.scratch_budget * 1024 * 1024
+    )
+    atexit.register(scratch.close)
+
+    budget = None
+    if any(
+        limit is not None
+        for limit in (args.max_failures, args.max_incomplete, args.max_duration)
+    ):
+        budget = FailureBudget(
+            args.max_failures,
+            args.max_incomplete,
+            args.max_duration * 60 if args.max_duration is not None else None,
+        )
+
     test_env = Environment(
         private_path,
         xemu_path,
         ffmpeg_path,
         perceptualdiff_path,
+        DisplayPool.from_environment(),
+        compare_mode=args.compare_mode,
+        budget=budget,
+    )
+
+    history = scheduler.TimingHistory(
+        Path(args.timings) if args.timings else results_root / "timings.json"
+    )
+    jobs = scheduler.expand_jobs(tests, history)
+    # Without the classes that turned out not to be tests
+    tests = [test for test in tests if any(job.test is test for job in jobs)]
+    if not args.benchmark:
+        jobs = scheduler.shard_jobs(jobs, history, args.jobs)
+    export_lock = threading.Lock()
+    # Cells and shards only clear their own results
+    for discovered in tests:
+        remove_tree(results_root / discovered.name)
+
+    retry_policy = RetryPolicy(max_retries=args.retries)
+
+    def run_job(job: scheduler.Job, worker: int, listener=None) -> TestResult:
+        work_path = Path.cwd()
+        if args.jobs > 1:
+            # Concurrent jobs need their own HDD image and xemu config
+            work_path = work_path / "workers" / str(worker)
+            work_path.mkdir(parents=True, exist_ok=True)
+        job_env = dataclasses.replace(
+            test_env,
+            work_path=work_path,
+            scratch_path=scratch.allocate(str(worker), work_path),
+        )
+        if listener is not None:
+            listener = scheduler.JobResultListener(listener, job, export_lock)
+        return scheduler.run_job(
+            job,
+            job_env,
+            results_root,
+            test_data_root,
+            selection,
+            retry_policy,
+            listener,
+            # Log groups cannot be interleaved
+            log_group=args.jobs <= 1,
+        )
+
+    def run_test(i: int, discovered) -> TestResult:
+        """Run all config matrix cells of a test."""
+        test_jobs = [job for job in jobs if job.test is discovered]
+        job_results = {
+            job.name: job_result
+            for job, job_result in scheduler.run_jobs(
+                test_jobs, run_job, args.jobs, args.schedule
+            )
+        }
+        return scheduler.group_results(test_jobs, job_results)[discovered.name]
+
+    if args.benchmark and args.serve:
+        log.error("Benchmark mode cannot be combined with --serve")
+        sys.exit(1)
+    if budget is not None and args.serve:
+        log.error("Failure budgets cannot be combined with --serve")
+        sys.exit(1)
+
+    if args.benchmark:
+        # Video capture would compete with xemu for CPU time
+        test_env.ffmpeg_path = None
+        report = benchmark.run_benchmark(
+            tests, run_test, iterations=args.benchmark, warmup=args.warmup
+        )
+        report.write(results_root / "benchmark.json")
+        comparisons = None
+        if args.baseline:
+            baseline = json.loads(Path(args.baseline).read_text())
+            comparisons = benchmark.compare_to_baseline(report, baseline)
+        benchmark.log_report(report, comparisons)
+        exit(0 if report.failures == 0 else 1)
+
+    exporter = ResultExporter(results_root)
+    packer = (
+        ArtifactPacker(Path(args.pack_artifacts).expanduser().resolve(), results_root)
+        if args.pack_artifacts
+        else None
+    )
+    job_results: dict[str, TestResult] = {}
+
+    if args.serve:
+        # The HTTP server is only needed by the coordinator
+        from xemutest import distributed
+
+        coordinator = distributed.Coordinator(
+            jobs,
+            results_root,
+            distributed.parse_address(args.serve),
+            selection,
+            retry_policy,
+        )
+        finished_jobs = coordinator.run()
+    else:
+        finished_jobs = scheduler.run_jobs(
+            jobs,
+            functools.partial(run_job, listener=exporter),
+            args.jobs,
+            args.schedule,
+        )
+    for job, job_result in finished_jobs:
+        job_results[job.name] = job_result
+        if not job_result.ok:
+            result = False
+        with export_lock:
+            if args.serve:
+                # Subtests of remote jobs are only known once they finish
+                for subtest in job_result.subtests:
+                    exporter.subtest_finished(job.name, subtest)
+            exporter.test_finished(dataclasses.replace(job_result, name=job.name))
+        if packer is not None:
+            packer.add(scheduler.job_results_path(results_root, job))
+
+    exporter.close()
+    test_results_summary = scheduler.group_results(jobs, job_results)
+
+    cancelled = test_env.cancelled
+    if cancelled:
+        log.error("Run cancelled: %s", budget.token.reason)
+        result = False
+    history.record_jobs(
+        jobs,
+        test_results_summary,
+        complete=lambda test_name: not cancelled
+        and selection.subtest_patterns(test_name) is None,
     )
+    history.write()
 
-    test_results_summary: dict[str, TestResult] = {}
-
-    for i, (test_name, test_cls) in enumerate(tests):
-        test_results = results_root / test_name
-        test_data = test_data_root / test_name
-        with ci.log_group(f"Test {i}: {test_name}"):
-            try:
-                log.info("Test %d - %s: Starting", i, test_name)
-                test = test_cls(test_env, test_results, test_data)
-                test_result = test.run()
-                log.info("Test %d - %s: Finished", i, test_name)
-                test_results_summary[test_name] = test_result
-                if not test_result.ok:
-                    result = False
-            except BaseException:
-                log.exception("Test %d - %s: Failed", i, test_name)
-                test_results_summary[test_name] = TestResult(
-                    name=test_name, status=TestStatus.FAILED
-                )
-                result = False
+    try:
+        thumbnail_ffmpeg = ffmpeg_path or shutil.which("ffmpeg")
+        html_report.write_report(
+            results_root,
+            test_results_summary,
+            Path(thumbnail_ffmpeg) if thumbnail_ffmpeg else None,
+        )
+    except Exception:
+        log.exception("Failed to write HTML report")
 
     # Write job summary for GitHub Actions
     if ci.is_github_actions():
-        summary = ci.JobSummary()
-        summary.add_heading("xemu Test Results")
-
-        def format_status(r: TestResult) -> str:
-            match r.status:
-                case TestStatus.PASSED:
-                    return "✅ Passed"
-                case TestStatus.FAILED:
-                    return "❌ Failed"
-                case TestStatus.UNVERIFIED:
-                    return "⚠️ Unverified"
-                case TestStatus.RUNNING:
-                    return "🔄 Running"
-
-        def collect_rows(
-            test_result: TestResult, parent_path: str = ""
-        ) -> list[list[str]]:
-            """Recursively collect rows for a test and its subtests."""
-            full_name = (
-                f"{parent_path}::{test_result.name}"
-                if parent_path
-                else test_result.name
-            )
-            rows = [
-                [
-                    full_name,
-                    format_status(test_result),
-                    test_result.duration,
-                    test_result.message,
-                ]
-            ]
-            for subtest in test_result.subtests:
-                rows.extend(collect_rows(subtest, full_name))
-            return rows
-
-        # Build rows including subtests
-        rows: list[list[str]] = []
-        for test_result in test_results_summary.values():
-            rows.extend(collect_rows(test_result))
-
-        summary.add_table(headers=["Test", "Status", "Duration", "Details"], rows=rows)
-        summary.write()
+        build_job_summary(test_results_summary).write()
+
+    if packer is not None:
+        packer.close()
 
     exit(0 if result else 1)
 
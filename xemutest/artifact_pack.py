@@ -0,0 +1,91 @@
+"""Packing of result trees into a single ZIP archive during the run.
+
+The results directory of every job is appended to the archive on a background
+thread as soon as the job finishes, and the files written at the end of the run
+(report, exports, timings) are added when the archive is finalized. The central
+directory of a ZIP is an index of its members, so single images can be pulled
+out of the archive without unpacking the rest of it, and uploading the results
+is one large sequential read instead of thousands of small ones.
+
+The archive is written under a temporary name and only renamed into place once
+it is complete, so an archive at the final path is never truncated.
+"""
+
+import logging
+import os
+import queue
+import threading
+import zipfile
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+# Already compressed, stored as is to save CPU time
+STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".gif", ".mp4", ".webm", ".zip", ".gz"}
+COMPRESS_LEVEL = 6
+
+
+class ArtifactPacker:
+    """Appends directory trees below a root directory to a ZIP archive."""
+
+    def __init__(self, archive_path: Path, root: Path):
+        self.archive_path = archive_path
+        self.root = root
+        self._partial_path = archive_path.with_name(f".{archive_path.name}.partial")
+        self._zip = zipfile.ZipFile(
+            self._partial_path,
+            "w",
+            zipfile.ZIP_DEFLATED,
+            compresslevel=COMPRESS_LEVEL,
+        )
+        self._queue: queue.Queue[Path | None] = queue.Queue()
+        self._packed: set[str] = set()
+        self._thread = threading.Thread(target=self._pack, daemon=True)
+        self._thread.start()
+
+    def _pack(self):
+        while (path := self._queue.get()) is not None:
+            try:
+                self._add_tree(path)
+            except Exception:
+                log.exception("Failed to pack %s", path)
+
+    def _add_file(self, path: Path):
+        name = path.relative_to(self.root).as_posix()
+        if name in self._packed:
+            return
+        compression = (
+            zipfile.ZIP_STORED
+            if path.suffix.lower() in STORED_SUFFIXES
+            else zipfile.ZIP_DEFLATED
+        )
+        self._zip.write(path, name, compression)
+        self._packed.add(name)
+
+    def _add_tree(self, path: Path):
+        if path.is_file():
+            self._add_file(path)
+            return
+        for dir_path, dir_names, file_names in os.walk(path):
+            # Trees being deleted in the background, see scratch.remove_tree
+            dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+            for file_name in sorted(file_names):
+                file_path = Path(dir_path, file_name)
+                if not file_name.startswith(".") and file_path != self.archive_path:
+                    self._add_file(file_path)
+
+    def add(self, path: Path):
+        """Queue a file or directory tree below the root for packing."""
+        self._queue.put(path)
+
+    def close(self):
+        """Pack the rest of the root directory and finalize the archive."""
+        self._queue.put(self.root)
+        self._queue.put(None)
+        self._thread.join()
+        self._zip.close()
+        self._partial_path.replace(self.archive_path)
+        log.info(
+            "Packed %d result file(s) into %s", len(self._packed), self.archive_path
+        )
@@ -0,0 +1,231 @@
+"""Benchmark mode: repeated test runs for measuring xemu performance.
+
+Tests are run a number of times after some warm-up runs, and the timings reported
+by each run (per-subtest durations, boot latency, xemu and test wall time) are
+summarized by their median and interquartile range. Summaries are stored as JSON
+and can be compared against a baseline from a previous benchmark.
+"""
+
+import json
+import logging
+import statistics
+import time
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from . import ci
+from .test_base import TestResult
+
+
+log = logging.getLogger(__name__)
+
+BENCHMARK_FORMAT_VERSION = 1
+
+
+@dataclass
+class MetricSummary:
+    """Summary statistics of the samples of one metric.
+
+    Values are in seconds, or in bytes for metrics named ``*_bytes``.
+    """
+
+    samples: list[float]
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.samples)
+
+    @property
+    def quartiles(self) -> tuple[float, float]:
+        if len(self.samples) < 2:
+            return self.median, self.median
+        q1, _, q3 = statistics.quantiles(self.samples, n=4, method="inclusive")
+        return q1, q3
+
+    @property
+    def iqr(self) -> float:
+        q1, q3 = self.quartiles
+        return q3 - q1
+
+    def to_dict(self) -> dict:
+        q1, q3 = self.quartiles
+        return {
+            "median": self.median,
+            "q1": q1,
+            "q3": q3,
+            "iqr": q3 - q1,
+            "samples": self.samples,
+        }
+
+
+@dataclass
+class BenchmarkReport:
+    """Samples of every metric collected over the measured runs."""
+
+    iterations: int
+    warmup: int
+    metrics: dict[str, MetricSummary] = field(default_factory=dict)
+    failures: int = 0
+
+    def add_sample(self, name: str, value: float | None):
+        if value is None:
+            return
+        self.metrics.setdefault(name, MetricSummary([])).samples.append(value)
+
+    def add_result(self, result: TestResult):
+        """Add the timings reported by one run of a test."""
+        self.add_sample(f"{result.name}::wall_time", result.duration_seconds)
+        for name, value in result.metrics.items():
+            self.add_sample(f"{result.name}::{name}", value)
+        for subtest in result.subtests:
+            if subtest.subtests:
+                # A config matrix cell
+                self.add_result(replace(subtest, name=f"{result.name}::{subtest.name}"))
+                continue
+            self.add_sample(f"{result.name}::{subtest.name}", subtest.duration_seconds)
+            for name, value in subtest.metrics.items():
+                self.add_sample(f"{result.name}::{subtest.name}::{name}", value)
+
+    def to_dict(self) -> dict:
+        return {
+            "version": BENCHMARK_FORMAT_VERSION,
+            "iterations": self.iterations,
+            "warmup": self.warmup,
+            "failures": self.failures,
+            "metrics": {
+                name: summary.to_dict()
+                for name, summary in sorted(self.metrics.items())
+            },
+        }
+
+    def write(self, path: Path):
+        path.write_text(json.dumps(self.to_dict(), indent=2))
+
+
+@dataclass
+class MetricComparison:
+    name: str
+    baseline: float
+    current: float
+    regressed: bool
+
+    @property
+    def change(self) -> float:
+        """Relative change of the median against the baseline."""
+        return (self.current - self.baseline) / self.baseline if self.baseline else 0
+
+
+def compare_to_baseline(
+    report: BenchmarkReport, baseline: dict, threshold: float = 0.1
+) -> list[MetricComparison]:
+    """
+    Compare the medians of a report against a stored baseline.
+
+    A metric regressed if its median is more than `threshold` (relative) higher
+    than the baseline median, and also beyond the baseline's upper quartile, so
+    that noise within the baseline's spread is not reported.
+    """
+    comparisons = []
+    baseline_metrics = baseline.get("metrics", {})
+    for name, summary in sorted(report.metrics.items()):
+        if name not in baseline_metrics:
+            continue
+        base = baseline_metrics[name]
+        current = summary.median
+        regressed = current > base["median"] * (1 + threshold) and (
+            current > base["q3"]
+        )
+        comparisons.append(MetricComparison(name, base["median"], current, regressed))
+    return comparisons
+
+
+def run_benchmark(
+    tests: Iterable,
+    run_test: Callable[[int, object], TestResult],
+    iterations: int,
+    warmup: int = 1,
+) -> BenchmarkReport:
+    """
+    Run every test `warmup` times without measuring, then `iterations` times.
+
+    `run_test(index, test)` runs one test and returns its result.
+    """
+    tests = list(tests)
+    report = BenchmarkReport(iterations, warmup)
+    for iteration in range(-warmup, iterations):
+        label = (
+            f"Warm-up {iteration + warmup + 1}/{warmup}"
+            if iteration < 0
+            else f"Iteration {iteration + 1}/{iterations}"
+        )
+        with ci.log_group(f"Benchmark: {label}"):
+            start = time.monotonic()
+            for i, test in enumerate(tests):
+                result = run_test(i, test)
+                if iteration < 0:
+                    continue
+                if not result.ok:
+                    report.failures += 1
+                report.add_result(result)
+            if iteration >= 0:
+                report.add_sample("total_wall_time", time.monotonic() - start)
+    return report
+
+
+def format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}ms" if seconds < 1 else f"{seconds:.3f}s"
+
+
+def format_metric(name: str, value: float) -> str:
+    if name.endswith("_bytes"):
+        return f"{value / 1024:.1f}KiB"
+    return format_seconds(value)
+
+
+def log_report(
+    report: BenchmarkReport, comparisons: list[MetricComparison] | None = None
+):
+    """Log summary metrics and any regressions, and add them to the job summary."""
+    rows = []
+    for name, summary in sorted(report.metrics.items()):
+        # Per-subtest metrics are only written to the JSON report
+        if name.count("::") > 2:
+            continue
+        median = format_metric(name, summary.median)
+        iqr = format_metric(name, summary.iqr)
+        rows.append([name, median, iqr])
+        log.info("%s: median %s, IQR %s", name, median, iqr)
+
+    regressions = [c for c in comparisons or [] if c.regressed]
+    for c in regressions:
+        log.warning(
+            "Benchmark regression in %s: %s -> %s (%+.1f%%)",
+            c.name,
+            format_metric(c.name, c.baseline),
+            format_metric(c.name, c.current),
+            c.change * 100,
+        )
+
+    if ci.is_github_actions():
+        summary = ci.JobSummary()
+        summary.add_heading("xemu Benchmark Results")
+        summary.add_paragraph(
+            f"{report.iterations} iteration(s) after {report.warmup} warm-up run(s)"
+        )
+        summary.add_table(headers=["Metric", "Median", "IQR"], rows=rows)
+        if comparisons is not None:
+            summary.add_heading("Regressions against baseline", level=3)
+            summary.add_table(
+                headers=["Metric", "Baseline", "Current", "Change"],
+                rows=[
+                    [
+                        c.name,
+                        format_metric(c.name, c.baseline),
+                        format_metric(c.name, c.current),
+                        f"{c.change * 100:+.1f}%",
+                    ]
+                    for c in regressions
+                ],
+            )
+        summary.write()
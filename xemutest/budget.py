@@ -0,0 +1,93 @@
+"""Failure budgets, and cooperative cancellation of a run when one is exceeded.
+
+A run can be given budgets for the number of failed subtests, the share of tests
+that xemu started but did not complete (i.e. crashed or hung on), and the total
+wall time. When a budget is exceeded, the cancellation token is set: running xemu
+instances are terminated along with their video capture, tests stop launching
+xemu and report the results they have so far, and jobs that have not started are
+reported as not run.
+
+Failures are counted as jobs finish, incomplete tests as each xemu launch ends.
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+
+log = logging.getLogger(__name__)
+
+# Tests started before the share of incomplete ones is judged
+MIN_STARTED_TESTS = 10
+
+
+class CancellationToken:
+    """Signals cancellation of a run to the threads taking part in it."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = ""
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str):
+        if self._event.is_set():
+            return
+        self.reason = reason
+        log.error("Cancelling the run: %s", reason)
+        self._event.set()
+
+
+@dataclass
+class FailureBudget:
+    """Limits after which a run is cancelled. None means unlimited."""
+
+    max_failures: int | None = None
+    max_incomplete_percent: float | None = None
+    max_duration: float | None = None  # Seconds of wall time
+    token: CancellationToken = field(default_factory=CancellationToken)
+    failures: int = 0
+    tests_started: int = 0
+    tests_incomplete: int = 0
+    _start: float = field(default_factory=time.monotonic)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @property
+    def cancelled(self) -> bool:
+        return self.token.cancelled
+
+    def record_failures(self, count: int):
+        """Count failed subtests (or tests without any)."""
+        with self._lock:
+            self.failures += count
+            if self.max_failures is not None and self.failures >= self.max_failures:
+                self.token.cancel(f"{self.failures} failure(s)")
+        self.check_time()
+
+    def record_tests(self, started: int, incomplete: int):
+        """Count tests started by an xemu launch, of which incomplete never ended."""
+        with self._lock:
+            self.tests_started += started
+            self.tests_incomplete += incomplete
+            if (
+                self.max_incomplete_percent is not None
+                and self.tests_started >= MIN_STARTED_TESTS
+                and self.tests_incomplete * 100
+                > self.max_incomplete_percent * self.tests_started
+            ):
+                self.token.cancel(
+                    f"{self.tests_incomplete} of {self.tests_started} started tests "
+                    "did not complete"
+                )
+        self.check_time()
+
+    def check_time(self):
+        """Cancel the run if it is over its wall time budget."""
+        if self.max_duration is None or self.cancelled:
+            return
+        elapsed = time.monotonic() - self._start
+        if elapsed > self.max_duration:
+            self.token.cancel(f"over the time budget of {self.max_duration:.0f}s")
@@ -6,6 +6,7 @@ including log grouping, annotations, and job summaries.
 
 import logging
 import os
+from collections.abc import Iterable
 from contextlib import contextmanager
 from pathlib import Path
 
@@ -103,23 +104,96 @@ class GitHubActionsHandler(logging.Handler):
     Add this handler to automatically convert Python logging warnings and errors
     into GitHub Actions annotations that appear in the workflow summary.
 
+    Records are aggregated by logger, level and message template (the unformatted
+    ``record.msg``). Only the first ``max_per_template`` records of a template are
+    annotated, and GitHub only displays a limited number of annotations per level
+    and step, so at most ``max_per_level`` annotations are emitted for each of
+    warnings and errors. Suppressed records are only counted, their message is
+    never formatted, and a rollup of the suppressed counts is printed when the
+    handler is closed (logging closes all handlers at interpreter exit).
+
     Usage:
         if ci.is_github_actions():
             logging.getLogger().addHandler(ci.GitHubActionsHandler())
     """
 
+    def __init__(self, max_per_template: int = 3, max_per_level: int = 10):
+        super().__init__(logging.WARNING)
+        self.max_per_template = max_per_template
+        self.max_per_level = max_per_level
+        # (logger, level, template) -> [records seen, annotations emitted]
+        self._templates: dict[tuple[str, int, str], list[int]] = {}
+        self._emitted_per_level: dict[int, int] = {}
+        self._closed = False
+
+    @staticmethod
+    def _level_of(levelno: int) -> int:
+        return logging.ERROR if levelno >= logging.ERROR else logging.WARNING
+
     def emit(self, record: logging.LogRecord):
+        # Called with the handler lock held by Handler.handle()
         if not is_github_actions():
             return
 
-        message = record.getMessage()
-        title = record.name
+        level = self._level_of(record.levelno)
+        key = (record.name, level, str(record.msg))
+        counts = self._templates.get(key)
+        if counts is None:
+            counts = self._templates[key] = [0, 0]
+        counts[0] += 1
+        if (
+            counts[1] >= self.max_per_template
+            or self._emitted_per_level.get(level, 0) >= self.max_per_level
+        ):
+            return
+        counts[1] += 1
+        self._emitted_per_level[level] = self._emitted_per_level.get(level, 0) + 1
+
+        try:
+            self._annotate(level, record.getMessage(), record.name)
+        except Exception:
+            self.handleError(record)
 
-        if record.levelno >= logging.ERROR:
+    @staticmethod
+    def _annotate(level: int, message: str, title: str):
+        if level >= logging.ERROR:
             error(message, title=title)
-        elif record.levelno >= logging.WARNING:
+        else:
             warning(message, title=title)
 
+    def suppressed(self) -> dict[tuple[str, int, str], int]:
+        """Returns the number of suppressed records per (logger, level, template)."""
+        with self.lock:
+            return {
+                key: seen - emitted
+                for key, (seen, emitted) in self._templates.items()
+                if seen > emitted
+            }
+
+    def close(self):
+        """Print a rollup of all suppressed records."""
+        with self.lock:
+            first_close = not self._closed
+            self._closed = True
+        if first_close and is_github_actions():
+            suppressed = self.suppressed()
+            if suppressed:
+                with log_group("Suppressed warning/error annotations"):
+                    for (name, level, template), count in sorted(
+                        suppressed.items(), key=lambda item: -item[1]
+                    ):
+                        print(
+                            f"{logging.getLevelName(level)} {name}: "
+                            f"{count} more occurrence(s) of {template!r}",
+                            flush=True,
+                        )
+                notice(
+                    f"{sum(suppressed.values())} warning/error annotation(s) "
+                    f"suppressed across {len(suppressed)} message template(s)",
+                    title="xemutest",
+                )
+        super().close()
+
 
 class JobSummary:
     """
@@ -152,8 +226,8 @@ class JobSummary:
         """Add a paragraph of text."""
         self._content.append(f"{text}\n")
 
-    def add_table(self, headers: list[str], rows: list[list[str]]):
-        """Add a markdown table."""
+    def add_table(self, headers: list[str], rows: Iterable[Iterable[str]]):
+        """Add a markdown table. Rows may be generated as the table is written."""
         # Header row
         self._content.append("| " + " | ".join(headers) + " |")
         # Separator row
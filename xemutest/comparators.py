@@ -1,12 +1,42 @@
+import hashlib
 import logging
+import re
+import shutil
 import subprocess
+import zlib
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from .env import Environment
+from .golden_store import GoldenStore
+from .image_diff import Box, diff_images, read_png, same_pixels
 
 
 log = logging.getLogger(__name__)
 
+PIXELS_DIFFERENT_RE = re.compile(r"(\d+) pixels are different")
+# full: perceptualdiff of whole images. tiered: images with identical pixels
+# match without perceptualdiff, and the differing tiles of the images it failed
+# are localized. Both give the same verdicts.
+COMPARE_MODES = ("full", "tiered")
+
+
+@dataclass
+class ImageComparison:
+    """Details of a failed comparison of a generated image against its golden."""
+
+    actual_path: Path
+    expected_path: Path  # Copy of the golden image, next to the diff image
+    diff_path: Path
+    message: str
+    regions: list[Box] = field(default_factory=list)  # Bounding boxes of differences
+
+    @property
+    def pixels_different(self) -> int | None:
+        """Returns the number of differing pixels reported by perceptualdiff."""
+        match = PIXELS_DIFFERENT_RE.search(self.message)
+        return int(match.group(1)) if match else None
+
 
 class GoldenImageComparator:
     """Compares generated images against golden reference images."""
@@ -16,10 +46,18 @@ class GoldenImageComparator:
         test_env: Environment,
         results_path: Path,
         golden_results_path: Path,
+        golden_store: GoldenStore | None = None,
     ):
+        """
+        Golden images are read from golden_store if given, otherwise from files
+        below golden_results_path.
+        """
         self.test_env = test_env
         self.results_path = results_path
         self.golden_results_path = golden_results_path
+        self.golden_store = golden_store
+        # Failed comparisons of the last compare_all, by relative image path
+        self.failures: dict[str, ImageComparison] = {}
 
     def compare_all(
         self,
@@ -35,6 +73,7 @@ class GoldenImageComparator:
         diff_results_dir.mkdir(parents=True, exist_ok=True)
 
         failed_comparisons = {}
+        self.failures = {}
 
         # Walk all directories including root
         dirs_to_check = [self.results_path]
@@ -93,24 +132,51 @@ class GoldenImageComparator:
             else:
                 golden_relative_path = root_relative_to_out_path
 
-            expected_path = (
-                self.golden_results_path / golden_relative_path / file
-            ).resolve()
-
             diff_path = diff_results_dir / relative_file_path
             diff_path.parent.mkdir(parents=True, exist_ok=True)
 
-            if not expected_path.is_file():
-                log.warning(
-                    "Missing golden image %s for output %s", expected_path, actual_path
-                )
+            if self.golden_store is not None:
+                golden_key = golden_relative_path / file
+                if golden_key not in self.golden_store:
+                    log.warning(
+                        "Missing golden image %s for output %s", golden_key, actual_path
+                    )
+                    continue
+                # Identical files match without running perceptualdiff
+                actual_digest = hashlib.sha256(actual_path.read_bytes()).hexdigest()
+                if actual_digest == self.golden_store.digest(golden_key):
+                    continue
+                expected_path = self.golden_store.materialize(golden_key)
+            else:
+                expected_path = (
+                    self.golden_results_path / golden_relative_path / file
+                ).resolve()
+
+                if not expected_path.is_file():
+                    log.warning(
+                        "Missing golden image %s for output %s",
+                        expected_path,
+                        actual_path,
+                    )
+                    continue
+
+            tiered = self.test_env.compare_mode == "tiered"
+            if tiered and self._same_pixels(expected_path, actual_path):
                 continue
-
             match, message = self._compare_images(expected_path, actual_path, diff_path)
             if not match:
+                regions = self._localize(expected_path, actual_path) if tiered else []
                 log.warning("Generated image %s does not match golden", actual_path)
                 failed_comparisons[str(relative_file_path)] = message
 
+                # Keep the golden image with the diff so failures can be triaged
+                # from the results alone
+                expected_copy = diff_path.with_name(diff_path.stem + ".expected.png")
+                shutil.copyfile(expected_path, expected_copy)
+                self.failures[str(relative_file_path)] = ImageComparison(
+                    actual_path, expected_copy, diff_path, message, regions
+                )
+
         return failed_comparisons
 
     def _compare_images(
@@ -126,3 +192,24 @@ class GoldenImageComparator:
         c.extend([str(expected_path), str(actual_path)])
         result = subprocess.run(c, capture_output=True)
         return result.returncode == 0, result.stderr.decode("utf-8")
+
+    @staticmethod
+    def _same_pixels(expected_path: Path, actual_path: Path) -> bool:
+        try:
+            return same_pixels(expected_path, actual_path)
+        except (ValueError, zlib.error) as e:
+            log.debug("Failed to compare pixels of %s: %s", actual_path, e)
+            return False
+
+    @staticmethod
+    def _localize(expected_path: Path, actual_path: Path) -> list[Box]:
+        """Returns the bounding boxes of the differing tiles of two images."""
+        try:
+            expected = read_png(expected_path)
+            actual = read_png(actual_path)
+        except (ValueError, zlib.error) as e:
+            log.debug("Failed to decode %s: %s", actual_path, e)
+            return []
+        if (expected.width, expected.height) != (actual.width, actual.height):
+            return []
+        return diff_images(expected, actual).regions()
@@ -0,0 +1,281 @@
+"""Content-addressed cache of test data.
+
+Test data (ISOs, XBEs, golden results) is described by a manifest listing the
+SHA-256 digest and size of every file, and the files themselves are stored in a
+local cache by digest. Checking out a manifest hardlinks the files from the cache
+into ``xemutest/data``, so only missing or changed files are written, and nothing
+is copied when the cache is on the same filesystem.
+
+Every ingested manifest is also kept in the cache, and the latest one is checked
+out by default, so a worker with a populated (e.g. mounted) cache can set up its
+test data offline.
+
+Usage:
+    python -m xemutest.data_cache ingest build/data  # e.g. copied out of docker
+    python -m xemutest.data_cache checkout
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+DATA_PATH = Path(__file__).resolve().parent / "data"
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+def default_cache_path() -> Path:
+    """Returns $XEMUTEST_DATA_CACHE, or xemutest/data in the user cache directory."""
+    if path := os.environ.get("XEMUTEST_DATA_CACHE"):
+        return Path(path)
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "xemutest" / "data"
+
+
+def file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass(frozen=True)
+class Artifact:
+    """A file of the test data."""
+
+    path: str  # Relative to the data directory, with forward slashes
+    digest: str  # SHA-256
+    size: int
+
+
+def read_manifest(path: Path) -> dict[str, Artifact]:
+    data = json.loads(path.read_text())
+    if data.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported test data manifest version in {path}")
+    return {
+        name: Artifact(name, entry["sha256"], entry["size"])
+        for name, entry in data["files"].items()
+    }
+
+
+def manifest_json(artifacts: dict[str, Artifact]) -> str:
+    return json.dumps(
+        {
+            "version": MANIFEST_VERSION,
+            "files": {
+                name: {"sha256": artifact.digest, "size": artifact.size}
+                for name, artifact in sorted(artifacts.items())
+            },
+        },
+        indent=1,
+    )
+
+
+def _temp_path(dest: Path) -> Path:
+    return dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}")
+
+
+def _link_or_copy(source: Path, dest: Path):
+    """Hardlink source to dest atomically, or copy it across filesystems."""
+    temp_path = _temp_path(dest)
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, dest)
+
+
+class DataCache:
+    """Files stored by digest, and the manifests that refer to them."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.objects_path = path / "objects"
+        self.manifests_path = path / "manifests"
+
+    def object_path(self, digest: str) -> Path:
+        return self.objects_path / digest[:2] / digest
+
+    def add(self, source: Path) -> tuple[str, int]:
+        """Store a file, unless already stored. Returns its digest and size."""
+        size = source.stat().st_size
+        digest = file_digest(source)
+        object_path = self.object_path(digest)
+        if not object_path.is_file() or object_path.stat().st_size != size:
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            # Copied, as a link would let changes to the source corrupt the cache
+            temp_path = _temp_path(object_path)
+            shutil.copyfile(source, temp_path)
+            temp_path.chmod(0o444)
+            os.replace(temp_path, object_path)
+            log.debug("Cached %s as %s", source, digest[:12])
+        return digest, size
+
+    def ingest(self, source_path: Path) -> dict[str, Artifact]:
+        """Store every file of a directory, and a manifest of them."""
+        artifacts = {}
+        for path in sorted(source_path.rglob("*")):
+            if not path.is_file() or path.name == MANIFEST_NAME:
+                continue
+            name = path.relative_to(source_path).as_posix()
+            artifacts[name] = Artifact(name, *self.add(path))
+        self.add_manifest(artifacts)
+        return artifacts
+
+    def add_manifest(self, artifacts: dict[str, Artifact]) -> Path:
+        """Store a manifest, and make it the latest one."""
+        content = manifest_json(artifacts)
+        self.manifests_path.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        manifest_path = self.manifests_path / f"{digest}.json"
+        manifest_path.write_text(content)
+        _link_or_copy(manifest_path, self.manifests_path / "latest.json")
+        return manifest_path
+
+    def latest_manifest(self) -> Path:
+        return self.manifests_path / "latest.json"
+
+    def missing(self, artifacts: dict[str, Artifact]) -> list[Artifact]:
+        """Returns the artifacts that are not in the cache."""
+        return [
+            artifact
+            for artifact in artifacts.values()
+            if not self.object_path(artifact.digest).is_file()
+        ]
+
+    def _is_current(self, artifact: Artifact, dest: Path) -> bool:
+        try:
+            dest_stat = dest.stat()
+        except FileNotFoundError:
+            return False
+        if dest_stat.st_size != artifact.size:
+            return False
+        object_stat = self.object_path(artifact.digest).stat()
+        if (dest_stat.st_dev, dest_stat.st_ino) == (
+            object_stat.st_dev,
+            object_stat.st_ino,
+        ):
+            return True
+        return file_digest(dest) == artifact.digest
+
+    def checkout(
+        self, artifacts: dict[str, Artifact], data_path: Path, prune: bool = True
+    ) -> tuple[int, int]:
+        """Materialize artifacts in a data directory from the cache.
+
+        Files that are not in the manifest are removed if prune is set. Returns the
+        numbers of files written and removed.
+        """
+        if missing := self.missing(artifacts):
+            raise FileNotFoundError(
+                f"{len(missing)} test data file(s) not in the cache at {self.path}, "
+                f"e.g. {missing[0].path}"
+            )
+        written = 0
+        for name, artifact in artifacts.items():
+            dest = data_path / name
+            if self._is_current(artifact, dest):
+                continue
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            _link_or_copy(self.object_path(artifact.digest), dest)
+            log.debug("Checked out %s", name)
+            written += 1
+
+        removed = 0
+        if prune:
+            for path in sorted(data_path.rglob("*"), reverse=True):
+                name = path.relative_to(data_path).as_posix()
+                if path.is_dir():
+                    if not any(path.iterdir()):
+                        path.rmdir()
+                elif name not in artifacts and name != MANIFEST_NAME:
+                    log.debug("Removing %s", name)
+                    path.unlink()
+                    removed += 1
+
+        (data_path / MANIFEST_NAME).write_text(manifest_json(artifacts))
+        return written, removed
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument(
+        "--cache",
+        help="Cache directory (default: $XEMUTEST_DATA_CACHE or "
+        "~/.cache/xemutest/data)",
+    )
+    ap.add_argument(
+        "--data",
+        default=str(DATA_PATH),
+        help="Test data directory (default: the data directory of the package)",
+    )
+    commands = ap.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser(
+        "ingest", help="Add the files of a directory to the cache and check them out"
+    )
+    ingest.add_argument("source", help="Directory of test data files")
+    ingest.add_argument(
+        "--no-checkout", action="store_true", help="Only add the files to the cache"
+    )
+    checkout = commands.add_parser(
+        "checkout", help="Materialize the test data of a manifest from the cache"
+    )
+    checkout.add_argument(
+        "manifest", nargs="?", help="Manifest (default: the latest ingested one)"
+    )
+    checkout.add_argument(
+        "--keep", action="store_true", help="Keep files not in the manifest"
+    )
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    cache = DataCache(
+        Path(args.cache).expanduser() if args.cache else default_cache_path()
+    )
+    data_path = Path(args.data).expanduser()
+
+    if args.command == "ingest":
+        artifacts = cache.ingest(Path(args.source))
+        log.info("Cached %d test data file(s) in %s", len(artifacts), cache.path)
+        if args.no_checkout:
+            return
+        prune = True
+    else:
+        manifest_path = (
+            Path(args.manifest) if args.manifest else cache.latest_manifest()
+        )
+        if not manifest_path.is_file():
+            log.error("Test data manifest not found: %s", manifest_path)
+            sys.exit(1)
+        artifacts = read_manifest(manifest_path)
+        prune = not args.keep
+
+    try:
+        written, removed = cache.checkout(artifacts, data_path, prune)
+    except FileNotFoundError as e:
+        log.error("%s", e)
+        sys.exit(1)
+    log.info(
+        "Test data in %s: %d file(s) updated, %d removed, %d unchanged",
+        data_path,
+        written,
+        removed,
+        len(artifacts) - written,
+    )
+
+
+if __name__ == "__main__":
+    main()
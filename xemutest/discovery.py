@@ -0,0 +1,146 @@
+"""Lazy test discovery and selection.
+
+Test modules are scanned for ``Test*`` class definitions without importing them, so
+that only modules containing selected tests are ever imported.
+"""
+
+import ast
+import importlib
+import logging
+import sys
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+
+class TestSelection:
+    """
+    Selects tests and subtests by fnmatch-style patterns.
+
+    A pattern is either a test class pattern (e.g. ``TestNxdkPgraph*``), which
+    selects the whole test, or a test class pattern followed by a subtest pattern
+    (e.g. ``TestNxdkPgraphTests::Lighting normals::*``), which selects only the
+    matching subtests of that test. Without any patterns, everything is selected.
+    """
+
+    def __init__(self, patterns: list[str] | None = None):
+        self.patterns = list(patterns or [])
+
+    def __bool__(self) -> bool:
+        return bool(self.patterns)
+
+    def _split(self):
+        for pattern in self.patterns:
+            class_pattern, _, subtest_pattern = pattern.partition("::")
+            yield class_pattern, subtest_pattern
+
+    def selects_class(self, class_name: str) -> bool:
+        """Returns True if any part of the test class is selected."""
+        if not self.patterns:
+            return True
+        return any(fnmatchcase(class_name, c) for c, _ in self._split())
+
+    def subtest_patterns(self, class_name: str) -> list[str] | None:
+        """
+        Returns the subtest patterns selected for a test class.
+
+        None means that all subtests are selected.
+        """
+        if not self.patterns:
+            return None
+        patterns = []
+        for class_pattern, subtest_pattern in self._split():
+            if not fnmatchcase(class_name, class_pattern):
+                continue
+            if not subtest_pattern:
+                return None
+            patterns.append(subtest_pattern)
+        return patterns
+
+    def selects_subtest(self, class_name: str, subtest_id: str) -> bool:
+        """Returns True if the subtest (e.g. ``suite::test``) is selected."""
+        patterns = self.subtest_patterns(class_name)
+        if patterns is None:
+            return True
+        return any(fnmatchcase(subtest_id, pattern) for pattern in patterns)
+
+
+@dataclass
+class Shard:
+    """
+    A part of the subtests of a test, by the first component of their names (the
+    unit, e.g. the pgraph test suite).
+    """
+
+    index: int
+    units: set[str] | None  # Units in the shard, None for all but the excluded
+    excluded: set[str] = field(default_factory=set)
+
+    @property
+    def name(self) -> str:
+        return f"shard_{self.index}"
+
+    def contains(self, subtest_id: str) -> bool:
+        unit = subtest_id.split("::", 1)[0]
+        if self.units is not None:
+            return unit in self.units
+        return unit not in self.excluded
+
+
+@dataclass
+class DiscoveredTest:
+    """A test class found in a test module, which is imported on first use."""
+
+    name: str
+    module_path: Path
+
+    def load(self):
+        """Import the test module and return the test class.
+
+        Returns None if the class turns out not to be a TestBase, e.g. a helper
+        class named like a test.
+        """
+        from .test_base import TestBase
+
+        tests_dir = str(self.module_path.parent)
+        if tests_dir not in sys.path:
+            sys.path.append(tests_dir)
+        module = importlib.import_module(self.module_path.stem)
+        test_class = getattr(module, self.name)
+        if not (isinstance(test_class, type) and issubclass(test_class, TestBase)):
+            log.debug("Skipping %s in %s, not a TestBase", self.name, self.module_path)
+            return None
+        return test_class
+
+
+def _scan_module(path: Path) -> list[str]:
+    """Returns the names of Test* classes defined at the top level of a module."""
+    tree = ast.parse(path.read_bytes(), filename=str(path))
+    return [
+        node.name
+        for node in tree.body
+        if (
+            isinstance(node, ast.ClassDef)
+            and node.name.startswith("Test")
+            and node.bases
+        )
+    ]
+
+
+def discover_tests(
+    tests_dir: Path, selection: TestSelection | None = None
+) -> list[DiscoveredTest]:
+    """Find selected test classes in tests_dir/test_*.py without importing them."""
+    tests = []
+    for path in sorted(tests_dir.iterdir()):
+        if not path.name.startswith("test_") or path.suffix != ".py":
+            continue
+        for name in _scan_module(path):
+            if selection is not None and not selection.selects_class(name):
+                log.debug("Deselected %s", name)
+                continue
+            tests.append(DiscoveredTest(name, path))
+    return tests
@@ -0,0 +1,61 @@
+"""Pool of X displays for running several xemu instances concurrently.
+
+Each concurrently running xemu instance leases a display of its own, which is
+used both by xemu and by the ffmpeg process capturing it. The pool is read from
+the XEMUTEST_DISPLAY_POOL environment variable (a comma separated list such as
+``:99,:100``, set by docker_entry.sh), falling back to DISPLAY.
+"""
+
+import logging
+import os
+import platform
+import queue
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+
+class DisplayPool:
+    """Thread-safe pool of X display names."""
+
+    def __init__(self, displays: list[str]):
+        if not displays:
+            raise ValueError("Display pool must not be empty")
+        self.displays = list(displays)
+        self._available: queue.Queue[str] = queue.Queue()
+        for display in self.displays:
+            self._available.put(display)
+
+    def __len__(self) -> int:
+        return len(self.displays)
+
+    @classmethod
+    def from_environment(cls) -> "DisplayPool | None":
+        """Create a pool from the environment, or None where X is not used."""
+        if platform.system() in ("Windows", "Darwin"):
+            return None
+        displays = [
+            d.strip()
+            for d in os.environ.get("XEMUTEST_DISPLAY_POOL", "").split(",")
+            if d.strip()
+        ]
+        if not displays and os.environ.get("DISPLAY"):
+            displays = [os.environ["DISPLAY"]]
+        if not displays:
+            return None
+        log.debug("Display pool: %s", ", ".join(displays))
+        return cls(displays)
+
+    @contextmanager
+    def lease(self, timeout: float | None = None):
+        """Lease a display for the duration of the context, waiting if necessary."""
+        try:
+            display = self._available.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No display became available") from None
+        log.debug("Leased display %s", display)
+        try:
+            yield display
+        finally:
+            self._available.put(display)
@@ -0,0 +1,506 @@
+"""Distributed execution of test jobs across hosts.
+
+With ``--serve [HOST:]PORT``, the runner acts as a coordinator: instead of running
+jobs itself, it serves its job queue over HTTP. Workers, on other hosts or in
+other containers, pull jobs, run them and upload the results directory of each
+job along with its result:
+
+    python -m xemutest.distributed http://coordinator:8765 xemu private
+
+Protocol (requests carry the worker name in an X-Xemutest-Worker header):
+
+- ``POST /jobs/lease``: 200 with the job to run as JSON, 204 if no job is pending
+  right now, or 410 once all jobs have finished.
+- ``POST /jobs/<id>/heartbeat``: 204 while the job is leased to the worker,
+  otherwise 409.
+- ``POST /jobs/<id>/result``: A tar archive of the results directory of the job,
+  with the result in ``.xemutest-result.json``. 204, or 409 if the job has
+  already finished.
+
+Leases expire when a worker stops sending heartbeats, e.g. because it died, and
+the job is then handed to another worker. There is no authentication, so only
+serve on trusted networks.
+"""
+
+import argparse
+import collections
+import io
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections.abc import Iterator
+from dataclasses import fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path, PurePosixPath
+
+from .comparators import COMPARE_MODES
+from .discovery import DiscoveredTest, Shard, TestSelection, discover_tests
+from .display_pool import DisplayPool
+from .env import Environment
+from .matrix import MatrixCell
+from .scheduler import Job, job_results_path, order_jobs, run_job
+from .scratch import ScratchSpace, default_budget, remove_tree
+from .test_base import RetryPolicy, TestResult, TestStatus
+
+
+log = logging.getLogger(__name__)
+
+WORKER_HEADER = "X-Xemutest-Worker"
+RESULT_MEMBER = ".xemutest-result.json"
+LEASE_TIMEOUT = 60.0  # Seconds without a heartbeat after which a job is requeued
+POLL_INTERVAL = 2.0  # Seconds between lease requests of idle workers
+REQUEST_TIMEOUT = 60.0
+
+
+def encode_result(result: TestResult) -> dict:
+    """Convert a result, including its subtests, into a JSON-serializable dict."""
+    data = {f.name: getattr(result, f.name) for f in fields(TestResult)}
+    data["status"] = result.status.name
+    data["subtests"] = [encode_result(subtest) for subtest in result.subtests]
+    return data
+
+
+def decode_result(data: dict) -> TestResult:
+    kwargs = {**data, "status": TestStatus[data["status"]]}
+    # Left out when empty, so that they default to the containers results share
+    for key in ("subtests", "metrics", "artifacts"):
+        if not kwargs[key]:
+            del kwargs[key]
+    if "subtests" in kwargs:
+        kwargs["subtests"] = [decode_result(subtest) for subtest in data["subtests"]]
+    return TestResult(**kwargs)
+
+
+def _extract_results(archive: tarfile.TarFile, dest: Path) -> dict | None:
+    """Extract regular files and directories of a results archive into dest."""
+    result = None
+    for member in archive:
+        name = PurePosixPath(member.name)
+        if name.is_absolute() or ".." in name.parts:
+            raise ValueError(f"Invalid path in results archive: {member.name}")
+        if member.name == RESULT_MEMBER:
+            result = json.load(archive.extractfile(member))
+        elif member.isdir():
+            (dest / name).mkdir(parents=True, exist_ok=True)
+        elif member.isfile():
+            target = dest / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with archive.extractfile(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+    return result
+
+
+class Coordinator:
+    """Serves jobs to workers and collects their results."""
+
+    def __init__(
+        self,
+        jobs: list[Job],
+        results_root: Path,
+        address: tuple[str, int],
+        selection: TestSelection | None = None,
+        retry_policy: RetryPolicy | None = None,
+        lease_timeout: float = LEASE_TIMEOUT,
+    ):
+        self.jobs = order_jobs(jobs)
+        self.results_root = results_root
+        self.selection = selection or TestSelection()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.lease_timeout = lease_timeout
+        self._pending = collections.deque(range(len(self.jobs)))
+        self._leases: dict[int, tuple[str, float]] = {}  # Job ID: worker, deadline
+        self._finished: set[int] = set()
+        self._lock = threading.Lock()
+        self._results: queue.SimpleQueue[tuple[int, TestResult]] = queue.SimpleQueue()
+        self.server = ThreadingHTTPServer(address, _CoordinatorRequestHandler)
+        self.server.coordinator = self
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.server.server_address[:2]
+
+    def _job_spec(self, job_id: int) -> dict:
+        job = self.jobs[job_id]
+        shard = None
+        if job.shard is not None:
+            shard = {
+                "index": job.shard.index,
+                "units": (
+                    sorted(job.shard.units) if job.shard.units is not None else None
+                ),
+                "excluded": sorted(job.shard.excluded),
+            }
+        return {
+            "id": job_id,
+            "index": job.index,
+            "test": job.test.name,
+            "cell": job.cell.overrides,
+            "shard": shard,
+            "selection": self.selection.patterns,
+            "retries": self.retry_policy.max_retries,
+            "lease_timeout": self.lease_timeout,
+        }
+
+    def _expire_leases(self):
+        now = time.monotonic()
+        with self._lock:
+            for job_id, (worker, deadline) in list(self._leases.items()):
+                if deadline < now:
+                    log.warning(
+                        "Lease of %s by %s expired, requeueing",
+                        self.jobs[job_id].name,
+                        worker,
+                    )
+                    del self._leases[job_id]
+                    self._pending.appendleft(job_id)
+
+    def lease(self, worker: str) -> tuple[int, dict | None]:
+        self._expire_leases()
+        with self._lock:
+            if len(self._finished) == len(self.jobs):
+                return 410, None
+            if not self._pending:
+                return 204, None
+            job_id = self._pending.popleft()
+            self._leases[job_id] = (worker, time.monotonic() + self.lease_timeout)
+        log.info("Leased %s to %s", self.jobs[job_id].name, worker)
+        return 200, self._job_spec(job_id)
+
+    def heartbeat(self, job_id: int, worker: str) -> int:
+        with self._lock:
+            if self._leases.get(job_id, (None,))[0] != worker:
+                return 409
+            self._leases[job_id] = (worker, time.monotonic() + self.lease_timeout)
+        return 204
+
+    def finish(self, job_id: int, worker: str, archive_file) -> int:
+        if job_id >= len(self.jobs):
+            return 404
+        with self._lock:
+            if job_id in self._finished:
+                return 409
+            # A worker whose lease expired may still deliver first
+            self._finished.add(job_id)
+            self._leases.pop(job_id, None)
+            if job_id in self._pending:
+                self._pending.remove(job_id)
+
+        job = self.jobs[job_id]
+        results_path = job_results_path(self.results_root, job)
+        try:
+            remove_tree(results_path)
+            results_path.mkdir(parents=True)
+            with tarfile.open(fileobj=archive_file, mode="r|") as archive:
+                result = _extract_results(archive, results_path)
+            if result is None:
+                raise ValueError("Result missing from results archive")
+        except Exception:
+            log.exception("Invalid results of %s from %s", job.name, worker)
+            with self._lock:
+                self._finished.discard(job_id)
+                self._pending.appendleft(job_id)
+            return 400
+        log.info("Received results of %s from %s", job.name, worker)
+        self._results.put((job_id, decode_result(result)))
+        return 204
+
+    def run(self) -> Iterator[tuple[Job, TestResult]]:
+        """Serve jobs, yielding (job, result) as workers finish them."""
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        host, port = self.address
+        log.info("Serving %d jobs on http://%s:%d", len(self.jobs), host, port)
+        try:
+            remaining = len(self.jobs)
+            while remaining:
+                try:
+                    job_id, result = self._results.get(timeout=1)
+                except queue.Empty:
+                    self._expire_leases()
+                    continue
+                remaining -= 1
+                yield self.jobs[job_id], result
+            # Give idle workers a chance to learn that all jobs are finished
+            time.sleep(POLL_INTERVAL * 2)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class _CoordinatorRequestHandler(BaseHTTPRequestHandler):
+    server: ThreadingHTTPServer
+
+    def _respond(self, status: int, body: dict | None = None):
+        content = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        if content:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        coordinator: Coordinator = self.server.coordinator
+        worker = self.headers.get(WORKER_HEADER, self.client_address[0])
+        length = int(self.headers.get("Content-Length", 0))
+        match self.path.strip("/").split("/"):
+            case ["jobs", "lease"]:
+                self._respond(*coordinator.lease(worker))
+            case ["jobs", job_id, "heartbeat"] if job_id.isdigit():
+                self._respond(coordinator.heartbeat(int(job_id), worker))
+            case ["jobs", job_id, "result"] if job_id.isdigit():
+                with tempfile.TemporaryFile() as archive_file:
+                    while length > 0:
+                        chunk = self.rfile.read(min(length, 1024 * 1024))
+                        if not chunk:
+                            break
+                        archive_file.write(chunk)
+                        length -= len(chunk)
+                    archive_file.seek(0)
+                    self._respond(coordinator.finish(int(job_id), worker, archive_file))
+            case _:
+                self._respond(404)
+
+    def log_message(self, format, *args):
+        log.debug("%s: %s", self.client_address[0], format % args)
+
+
+class Worker:
+    """Runs jobs leased from a coordinator."""
+
+    def __init__(
+        self,
+        url: str,
+        test_env: Environment,
+        test_data_root: Path,
+        name: str | None = None,
+        connect_timeout: float = 60.0,
+    ):
+        self.url = url.rstrip("/")
+        self.test_env = test_env
+        self.test_data_root = test_data_root
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.connect_timeout = connect_timeout
+        self.results_root = (test_env.work_path or Path.cwd()) / "results"
+        self._tests: dict[str, DiscoveredTest] = {}
+
+    def _request(self, path: str, data=None, headers=None) -> tuple[int, dict | None]:
+        request = urllib.request.Request(
+            self.url + path,
+            data=data if data is not None else b"",
+            headers={WORKER_HEADER: self.name, **(headers or {})},
+            method="POST",
+        )
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                with urllib.request.urlopen(request, timeout=REQUEST_TIMEOUT) as r:
+                    body = r.read()
+                    return r.status, json.loads(body) if body else None
+            except urllib.error.HTTPError as e:
+                return e.code, None
+            except urllib.error.URLError as e:
+                if data is not None or time.monotonic() > deadline:
+                    raise
+                log.debug("Coordinator not reachable, retrying: %s", e.reason)
+                time.sleep(POLL_INTERVAL)
+
+    def _discovered_test(self, name: str) -> DiscoveredTest:
+        if name not in self._tests:
+            tests_dir = Path(__file__).resolve().parent / "tests"
+            for test in discover_tests(tests_dir, TestSelection([name])):
+                if test.name == name:
+                    self._tests[name] = test
+        if name not in self._tests:
+            raise ValueError(f"Unknown test {name}")
+        return self._tests[name]
+
+    def _job_from_spec(self, spec: dict) -> Job:
+        shard = None
+        if spec["shard"] is not None:
+            units = spec["shard"]["units"]
+            shard = Shard(
+                spec["shard"]["index"],
+                set(units) if units is not None else None,
+                set(spec["shard"]["excluded"]),
+            )
+        return Job(
+            spec["index"],
+            self._discovered_test(spec["test"]),
+            MatrixCell(spec["cell"]),
+            expected_duration=0.0,
+            shard=shard,
+        )
+
+    def _heartbeat(self, job_id: int, interval: float, stop: threading.Event):
+        while not stop.wait(interval):
+            try:
+                status, _ = self._request(f"/jobs/{job_id}/heartbeat")
+            except OSError:
+                log.warning("Heartbeat for job %d failed", job_id, exc_info=True)
+                continue
+            if status != 204:
+                log.warning("Lease of job %d was lost", job_id)
+
+    def _upload(self, job_id: int, results_path: Path, result: TestResult) -> int:
+        with tempfile.TemporaryFile() as archive_file:
+            with tarfile.open(fileobj=archive_file, mode="w") as archive:
+                for path in sorted(results_path.rglob("*")):
+                    archive.add(
+                        path, path.relative_to(results_path).as_posix(), recursive=False
+                    )
+                content = json.dumps(encode_result(result)).encode("utf-8")
+                info = tarfile.TarInfo(RESULT_MEMBER)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+            size = archive_file.tell()
+            archive_file.seek(0)
+            status, _ = self._request(
+                f"/jobs/{job_id}/result",
+                data=archive_file,
+                headers={
+                    "Content-Type": "application/x-tar",
+                    "Content-Length": str(size),
+                },
+            )
+        return status
+
+    def run_one(self, spec: dict) -> TestResult:
+        """Run a leased job and upload its results."""
+        job_id = spec["id"]
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat,
+            args=(job_id, spec["lease_timeout"] / 3, stop),
+            daemon=True,
+        )
+        heartbeat.start()
+        results_path = self.results_root / f"job_{job_id}"
+        try:
+            try:
+                job = self._job_from_spec(spec)
+            except Exception as e:
+                # E.g. a test that this worker does not have
+                log.exception("Failed to run job %d", job_id)
+                result = TestResult(
+                    name=MatrixCell(spec["cell"]).name or spec["test"],
+                    status=TestStatus.FAILED,
+                    message=f"Worker {self.name}: {e}",
+                )
+            else:
+                results_path = job_results_path(self.results_root, job)
+                result = run_job(
+                    job,
+                    self.test_env,
+                    self.results_root,
+                    self.test_data_root,
+                    TestSelection(spec["selection"]),
+                    RetryPolicy(max_retries=spec["retries"]),
+                )
+            results_path.mkdir(parents=True, exist_ok=True)
+            status = self._upload(job_id, results_path, result)
+            if status != 204:
+                log.warning("Results of job %d were rejected (%d)", job_id, status)
+        finally:
+            stop.set()
+            heartbeat.join()
+        remove_tree(results_path)
+        return result
+
+    def run(self) -> int:
+        """Run jobs until the coordinator has none left. Returns the number run."""
+        num_jobs = 0
+        log.info("Worker %s pulling jobs from %s", self.name, self.url)
+        while True:
+            status, spec = self._request("/jobs/lease")
+            if status == 410:
+                break
+            if status != 200 or spec is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+            self.run_one(spec)
+            num_jobs += 1
+        log.info("Worker %s finished after %d jobs", self.name, num_jobs)
+        return num_jobs
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    """Parse ``[HOST:]PORT``, defaulting to localhost."""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run test jobs from a coordinator")
+    ap.add_argument("coordinator", help="URL of the coordinator, e.g. http://host:port")
+    ap.add_argument("xemu", help="Path to the xemu binary")
+    ap.add_argument("private", help="Path to private data files")
+    ap.add_argument("--ffmpeg", help="Path to the ffmpeg binary")
+    ap.add_argument("--perceptualdiff", help="Path to the perceptualdiff binary")
+    ap.add_argument(
+        "--compare-mode",
+        choices=COMPARE_MODES,
+        default="full",
+        help="How images are compared, see xemutest/comparators.py",
+    )
+    ap.add_argument(
+        "--data",
+        help="Path to the test data (default: the data installed with the package)",
+    )
+    ap.add_argument("--work-dir", help="Directory for the HDD image and results")
+    ap.add_argument("--name", help="Worker name (default: hostname-pid)")
+    ap.add_argument(
+        "-v", "--verbose", action="store_true", help="Print verbose logging information"
+    )
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    logging.getLogger("pyfatx").setLevel(logging.WARNING)
+
+    xemu_path = Path(args.xemu).expanduser().resolve()
+    private_path = Path(args.private).expanduser().resolve()
+    test_data_root = (
+        Path(args.data).expanduser().resolve()
+        if args.data
+        else Path(__file__).resolve().parent / "data"
+    )
+    if not xemu_path.is_file():
+        log.error("xemu binary not found: %s", xemu_path)
+        sys.exit(1)
+
+    scratch = ScratchSpace(default_budget())
+    with tempfile.TemporaryDirectory(prefix="xemutest-worker-") as temp_dir:
+        work_path = Path(args.work_dir).resolve() if args.work_dir else Path(temp_dir)
+        work_path.mkdir(parents=True, exist_ok=True)
+        test_env = Environment(
+            private_path,
+            xemu_path,
+            Path(args.ffmpeg).expanduser().resolve() if args.ffmpeg else None,
+            (
+                Path(args.perceptualdiff).expanduser().resolve()
+                if args.perceptualdiff
+                else None
+            ),
+            DisplayPool.from_environment(),
+            work_path=work_path,
+            scratch_path=scratch.allocate("worker", work_path),
+            compare_mode=args.compare_mode,
+        )
+        try:
+            Worker(args.coordinator, test_env, test_data_root, args.name).run()
+        finally:
+            scratch.close()
+
+
+if __name__ == "__main__":
+    main()
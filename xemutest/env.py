@@ -1,6 +1,9 @@
 from dataclasses import dataclass
 from pathlib import Path
 
+from .budget import FailureBudget
+from .display_pool import DisplayPool
+
 
 @dataclass
 class Environment:
@@ -10,6 +13,17 @@ class Environment:
     xemu_path: Path
     ffmpeg_path: Path | None = None
     perceptualdiff_path: Path | None = None
+    display_pool: DisplayPool | None = None  # X displays for concurrent instances
+    # Directory for the HDD image and other scratch files, instead of the cwd
+    work_path: Path | None = None
+    # Directory for the HDD image and extracted files, defaults to work_path
+    scratch_path: Path | None = None
+    compare_mode: str = "full"  # How images are compared, see comparators.py
+    budget: FailureBudget | None = None  # Cancels the run when exceeded
+
+    @property
+    def cancelled(self) -> bool:
+        return self.budget is not None and self.budget.cancelled
 
     @property
     def video_capture_enabled(self) -> bool:
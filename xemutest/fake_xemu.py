@@ -0,0 +1,149 @@
+"""Stand-in for the xemu executable, used to benchmark the harness itself.
+
+Accepts the xemu command line used by XemuManager, reads the HDD image path from
+the xemu config, and writes synthetic nxdk_pgraph_tests output into the image
+(honoring the suite config written by the harness) before exiting. If a batch
+manifest of TestXBEBatch is present, it writes the output of the batch launcher,
+and otherwise the result file expected by TestXBE.
+
+The number of synthetic tests is controlled by the XEMUTEST_FAKE_SUBTESTS and
+XEMUTEST_FAKE_SUITES environment variables.
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import zlib
+from pathlib import Path
+
+from pyfatx import Fatx
+
+
+HDD_PATH_RE = re.compile(r"^hdd_path\s*=\s*'(?P<path>.*)'\s*$", re.MULTILINE)
+PGRAPH_CONFIG_PATH = "/nxdk_pgraph_tests/nxdk_pgraph_tests_config.json"
+BATCH_MANIFEST_PATH = "/xemutest/batch.txt"
+
+
+def make_png(width: int = 640, height: int = 480, rgb=(0, 0, 0)) -> bytes:
+    """Encode a solid color RGB PNG."""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height))
+        + chunk(b"IEND", b"")
+    )
+
+
+def fake_test_ids(num_tests: int, num_suites: int) -> list[tuple[str, str]]:
+    """Returns (suite, test) names of the synthetic pgraph tests."""
+    return [(f"Suite {i % num_suites:03d}", f"Test_{i:05d}") for i in range(num_tests)]
+
+
+def _is_selected(config: dict, suite: str, test: str) -> bool:
+    suite_config = config.get("test_suites", {}).get(suite, {})
+    test_config = suite_config.get(test, {})
+    default = config["settings"].get("skip_tests_by_default", False)
+    return not test_config.get("skipped", suite_config.get("skipped", default))
+
+
+def run_pgraph_tests(hdd_path: str, config: dict, num_tests: int, num_suites: int):
+    fs_c = Fatx(hdd_path, drive="c")
+    fs_c.mkdir("/nxdk_pgraph_tests")
+    png = make_png()
+    log = []
+    created_dirs = set()
+    for suite, test in fake_test_ids(num_tests, num_suites):
+        if not _is_selected(config, suite, test):
+            continue
+        suite_dir = "/nxdk_pgraph_tests/" + suite.replace(" ", "_")
+        if suite_dir not in created_dirs:
+            fs_c.mkdir(suite_dir)
+            created_dirs.add(suite_dir)
+        log.append(f"Starting {suite}::{test}")
+        fs_c.write(f"{suite_dir}/{test}.png", png)
+        log.append(f"Completed '{test}' in 1ms")
+    log.append("Testing completed normally, closing log.")
+    fs_c.write(
+        "/nxdk_pgraph_tests/pgraph_progress_log.txt",
+        ("\n".join(log) + "\n").encode("utf-8"),
+    )
+
+
+def fake_guest_results() -> bytes:
+    """Returns structured results of test-xbe, see xemutest/guest_results.py."""
+    frequency = 3375000
+    records = [("video_mode", 0.002), ("sleep", 1.0), ("file_write", 0.004)]
+    lines = [f"xemutest-results 1 {frequency}"] + [
+        f"PASS\t{name}\t{round(seconds * frequency)}\t" for name, seconds in records
+    ]
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+def run_xbe_test(hdd_path: str):
+    fs_c = Fatx(hdd_path, drive="c")
+    fs_c.mkdir("/results")
+    fs_c.write("/results/test_results.txt", fake_guest_results())
+    fs_c.write("/results/results.txt", b"Success")
+
+
+def run_xbe_batch(hdd_path: str, names: list[str]):
+    fs_c = Fatx(hdd_path, drive="c")
+    fs_c.mkdir("/results")
+    for name in names:
+        fs_c.mkdir(f"/results/{name}")
+        fs_c.write(f"/results/{name}/test_results.txt", fake_guest_results())
+        fs_c.write(f"/results/{name}/results.txt", b"Success")
+    progress = [f"Starting {name}" for name in names] + ["Completed batch"]
+    fs_c.write(
+        "/results/batch_progress.txt", ("\n".join(progress) + "\n").encode("ascii")
+    )
+
+
+def _read_file(hdd_path: str, drive: str, path: str) -> bytes | None:
+    try:
+        fs = Fatx(hdd_path, drive=drive)
+        return bytes(fs.read(path))
+    except AssertionError:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-config_path", required=True)
+    ap.add_argument("-dvd_path")
+    args, _ = ap.parse_known_args()
+
+    config_text = Path(args.config_path).read_text()
+    hdd_path = HDD_PATH_RE.search(config_text).group("path")
+
+    pgraph_config = _read_file(hdd_path, "e", PGRAPH_CONFIG_PATH)
+    batch_manifest = _read_file(hdd_path, "e", BATCH_MANIFEST_PATH)
+
+    if batch_manifest is not None:
+        run_xbe_batch(hdd_path, batch_manifest.decode("ascii").split())
+    elif pgraph_config is None:
+        run_xbe_test(hdd_path)
+    else:
+        pgraph_config = json.loads(pgraph_config)
+        run_pgraph_tests(
+            hdd_path,
+            pgraph_config,
+            int(os.environ.get("XEMUTEST_FAKE_SUBTESTS", "100")),
+            int(os.environ.get("XEMUTEST_FAKE_SUITES", "10")),
+        )
+
+
+if __name__ == "__main__":
+    main()
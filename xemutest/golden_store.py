@@ -0,0 +1,183 @@
+"""Packed, deduplicated storage for golden images.
+
+A golden store consists of two files:
+
+- ``<name>.pack``: A magic header followed by the content of every unique file,
+  each stored once no matter how many golden paths refer to it.
+- ``<name>.pack.json``: The index, mapping each golden path (relative, using
+  forward slashes) to the SHA-256 digest of its content, and each digest to the
+  offset and size of the content in the pack.
+
+The pack is memory-mapped for reading, so file contents are accessed without
+copying and lookups do not touch the filesystem.
+
+Usage:
+    python -m xemutest.golden_store pack <golden results dir> <output .pack>
+    python -m xemutest.golden_store info <.pack>
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import shutil
+import tempfile
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+PACK_MAGIC = b"XTGOLD01"
+INDEX_VERSION = 1
+
+
+def index_path_for(pack_path: Path) -> Path:
+    return pack_path.with_name(pack_path.name + ".json")
+
+
+class GoldenStore:
+    """Read access to a packed golden image set."""
+
+    def __init__(self, pack_path: Path):
+        self.pack_path = Path(pack_path)
+        index = json.loads(index_path_for(self.pack_path).read_text())
+        if index.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported golden store index in {self.pack_path}")
+        self._files: dict[str, str] = index["files"]
+        self._blobs: dict[str, list[int]] = index["blobs"]
+
+        with open(self.pack_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[: len(PACK_MAGIC)] != PACK_MAGIC:
+            raise ValueError(f"{self.pack_path} is not a golden store pack")
+        self._view = memoryview(self._mmap)
+        self._cache_dir: Path | None = None
+        self._materialized: dict[str, Path] = {}
+
+    @staticmethod
+    def _key(path: Path | str) -> str:
+        return Path(path).as_posix()
+
+    def __contains__(self, path: Path | str) -> bool:
+        return self._key(path) in self._files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def paths(self) -> list[str]:
+        """Returns all golden paths in the store."""
+        return list(self._files)
+
+    def digest(self, path: Path | str) -> str:
+        """Returns the SHA-256 hex digest of a golden file."""
+        return self._files[self._key(path)]
+
+    def get(self, path: Path | str) -> memoryview:
+        """Returns the content of a golden file without copying it."""
+        offset, size = self._blobs[self.digest(path)]
+        return self._view[offset : offset + size]
+
+    def materialize(self, path: Path | str) -> Path:
+        """
+        Returns a filesystem path with the content of a golden file, for tools that
+        need one. Each unique blob is written at most once per store instance.
+        """
+        digest = self.digest(path)
+        if digest not in self._materialized:
+            if self._cache_dir is None:
+                self._cache_dir = Path(tempfile.mkdtemp(prefix="xemutest-golden-"))
+            target = self._cache_dir / (digest + Path(self._key(path)).suffix)
+            target.write_bytes(self.get(path))
+            self._materialized[digest] = target
+        return self._materialized[digest]
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+        if self._cache_dir is not None:
+            shutil.rmtree(self._cache_dir, True)
+            self._cache_dir = None
+            self._materialized.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pack_directory(source: Path, pack_path: Path, pattern: str = "*.png") -> dict:
+    """
+    Pack all files matching pattern below source into a golden store.
+
+    Returns statistics about the packed files.
+    """
+    files: dict[str, str] = {}
+    blobs: dict[str, list[int]] = {}
+    total_size = 0
+    tmp_pack_path = pack_path.with_name(pack_path.name + ".tmp")
+    with open(tmp_pack_path, "wb") as pack:
+        pack.write(PACK_MAGIC)
+        for path in sorted(source.rglob(pattern)):
+            if not path.is_file():
+                continue
+            content = path.read_bytes()
+            total_size += len(content)
+            digest = hashlib.sha256(content).hexdigest()
+            files[path.relative_to(source).as_posix()] = digest
+            if digest not in blobs:
+                blobs[digest] = [pack.tell(), len(content)]
+                pack.write(content)
+        pack_size = pack.tell()
+
+    index_path = index_path_for(pack_path)
+    tmp_index_path = index_path.with_name(index_path.name + ".tmp")
+    tmp_index_path.write_text(
+        json.dumps(
+            {"version": INDEX_VERSION, "files": files, "blobs": blobs},
+            indent=0,
+            sort_keys=True,
+        )
+    )
+    tmp_pack_path.replace(pack_path)
+    tmp_index_path.replace(index_path)
+
+    stats = {
+        "files": len(files),
+        "unique": len(blobs),
+        "total_size": total_size,
+        "pack_size": pack_size,
+    }
+    log.info(
+        "Packed %d files (%d unique) into %s: %d -> %d bytes",
+        stats["files"],
+        stats["unique"],
+        pack_path,
+        total_size,
+        pack_size,
+    )
+    return stats
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Manage packed golden image stores")
+    subparsers = ap.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack a golden results dir")
+    pack_parser.add_argument("source", help="Golden results directory")
+    pack_parser.add_argument("pack", help="Output .pack file")
+    info_parser = subparsers.add_parser("info", help="Describe a golden store")
+    info_parser.add_argument("pack", help=".pack file")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "pack":
+        pack_directory(Path(args.source), Path(args.pack))
+    else:
+        with GoldenStore(Path(args.pack)) as store:
+            unique = len(set(map(store.digest, store.paths())))
+            print(f"{len(store)} files, {unique} unique")
+
+
+if __name__ == "__main__":
+    main()
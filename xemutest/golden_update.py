@@ -0,0 +1,276 @@
+"""Batch update of golden images from test results.
+
+Maps result images back into the golden layout with the test's own path
+transform (e.g. dropping the ``<renderer>/iteration_N`` directories of
+nxdk_pgraph_tests results), copies the images that failed their comparison
+against the golden image (and those without one) in parallel, optionally
+regenerates a packed golden store, and reports what changed. Of the launches of a
+cell, the last one decides. If cells, e.g. renderers, disagree, the golden image
+is left alone and reported as a conflict.
+
+Images that only differ in bytes from their golden image but passed the
+perceptual comparison are left alone, unless ``--all-differing`` is given.
+
+Usage:
+    python -m xemutest.golden_update results/TestNxdkPgraphTests \\
+        path/to/nxdk_pgraph_tests_golden_results/results -k 'vulkan/*/Lighting_*'
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import re
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from .discovery import TestSelection, discover_tests
+from .golden_store import pack_directory
+
+
+log = logging.getLogger(__name__)
+
+# Directories of the xemu launches of a result cell, see TestNxdkPgraphTests
+LAUNCH_DIR_RE = re.compile(r"^(?P<kind>iteration|retry)_(?P<number>\d+)$")
+
+
+@dataclass
+class GoldenUpdateReport:
+    """Golden paths that were added, updated, left unchanged or in conflict."""
+
+    added: list[str] = field(default_factory=list)
+    updated: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    # Golden paths that cells produced different images for, mapped to them
+    conflicts: dict[str, list[str]] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            "added": self.added,
+            "updated": self.updated,
+            "unchanged": len(self.unchanged),
+            "conflicts": self.conflicts,
+        }
+
+
+def _digest(path: Path) -> str | None:
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def find_failed(results_path: Path, diff_dir_name: str = "_diffs") -> set[Path]:
+    """
+    Returns the result images that failed their golden comparison.
+
+    The comparator keeps a copy of the golden image of every failure in the diff
+    directory, next to the diff image, see GoldenImageComparator.
+    """
+    failed = set()
+    for diff_dir in results_path.rglob(diff_dir_name):
+        if not diff_dir.is_dir():
+            continue
+        for expected_copy in diff_dir.rglob("*.expected.png"):
+            relative_path = expected_copy.relative_to(diff_dir)
+            name = expected_copy.name.removesuffix(".expected.png") + ".png"
+            failed.add(diff_dir.parent / relative_path.with_name(name))
+    return failed
+
+
+def _launch_order(part: str) -> tuple[int, int]:
+    """Order of a launch directory within a result cell, retries after iterations."""
+    match = LAUNCH_DIR_RE.match(part)
+    if match is None:
+        return (0, 0)
+    return (int(match["kind"] == "retry"), int(match["number"]))
+
+
+def find_candidates(
+    results_path: Path,
+    path_transform=None,
+    patterns: list[str] | None = None,
+    diff_dir_name: str = "_diffs",
+) -> dict[Path, dict[str, Path]]:
+    """
+    Map golden paths (relative) to the result image of each cell for them.
+
+    The result directories that the path transform drops (e.g.
+    ``vulkan/iteration_0``) are a cell (``vulkan``) and a launch directory. The
+    image of a cell is the one of its last launch, e.g. of a retry. Patterns are
+    matched against both the result path and the golden path, both relative and
+    using forward slashes.
+    """
+    found: dict[Path, dict[str, tuple[tuple[int, int], Path]]] = {}
+    for actual_path in results_path.rglob("*.png"):
+        relative_path = actual_path.relative_to(results_path)
+        if diff_dir_name in relative_path.parts:
+            continue
+        golden_dir = (
+            path_transform(relative_path.parent)
+            if path_transform
+            else relative_path.parent
+        )
+        golden_path = golden_dir / relative_path.name
+        if patterns and not any(
+            fnmatchcase(relative_path.as_posix(), p)
+            or fnmatchcase(golden_path.as_posix(), p)
+            for p in patterns
+        ):
+            continue
+        dropped = relative_path.parent.parts[
+            : len(relative_path.parent.parts) - len(golden_dir.parts)
+        ]
+        if dropped and LAUNCH_DIR_RE.match(dropped[-1]):
+            cell, launch = "/".join(dropped[:-1]), _launch_order(dropped[-1])
+        else:
+            cell, launch = "/".join(dropped), (0, 0)
+        cells = found.setdefault(golden_path, {})
+        if cell not in cells or launch > cells[cell][0]:
+            cells[cell] = (launch, actual_path)
+    return {
+        golden_path: {cell: path for cell, (_, path) in sorted(cells.items())}
+        for golden_path, cells in found.items()
+    }
+
+
+def update_goldens(
+    results_path: Path,
+    golden_results_path: Path,
+    path_transform=None,
+    patterns: list[str] | None = None,
+    jobs: int = 8,
+    dry_run: bool = False,
+    all_differing: bool = False,
+) -> GoldenUpdateReport:
+    """
+    Copy result images that failed their comparison into the golden set.
+
+    If all_differing is set, every image that is not identical to its golden
+    image is copied instead. Golden images whose cells (e.g. renderers) produced
+    different images are left alone and reported as conflicts.
+    """
+    candidates = find_candidates(results_path, path_transform, patterns)
+    failed = None if all_differing else find_failed(results_path)
+    report = GoldenUpdateReport()
+
+    def process(item: tuple[Path, dict[str, Path]]):
+        golden_path, cells = item
+        actual_paths = list(cells.values())
+        digests = {_digest(path) for path in actual_paths}
+        if len(digests) > 1:
+            return golden_path, "conflicts"
+        source, (source_digest,) = actual_paths[0], digests
+        target = golden_results_path / golden_path
+        golden_digest = _digest(target)
+        if golden_digest == source_digest:
+            return golden_path, "unchanged"
+        # The last launch of each cell decides, e.g. a retry that matched
+        if (
+            golden_digest is not None
+            and failed is not None
+            and not any(path in failed for path in actual_paths)
+        ):
+            return golden_path, "unchanged"
+        if not dry_run:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(source, target)
+        return golden_path, "added" if golden_digest is None else "updated"
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for golden_path, change in executor.map(process, sorted(candidates.items())):
+            key = golden_path.as_posix()
+            if change != "conflicts":
+                getattr(report, change).append(key)
+                continue
+            report.conflicts[key] = [
+                str(path.relative_to(results_path))
+                for path in candidates[golden_path].values()
+            ]
+            log.warning(
+                "Results for %s differ between %s, left unchanged",
+                key,
+                ", ".join(report.conflicts[key]),
+            )
+    return report
+
+
+def _load_path_transform(test_name: str):
+    tests_dir = Path(__file__).resolve().parent / "tests"
+    tests = discover_tests(tests_dir, TestSelection([test_name]))
+    test_cls = tests[0].load() if tests else None
+    if test_cls is None:
+        raise ValueError(f"Unknown test {test_name}")
+    return getattr(test_cls, "golden_path_transform", None)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Update golden images from results")
+    ap.add_argument("results", help="Results directory of a single test")
+    ap.add_argument("golden", help="Golden results directory to update")
+    ap.add_argument(
+        "--test",
+        default="TestNxdkPgraphTests",
+        help="Test whose result layout to map (default: TestNxdkPgraphTests)",
+    )
+    ap.add_argument(
+        "-k",
+        "--select",
+        action="append",
+        metavar="PATTERN",
+        help="Only update images whose result or golden path matches the pattern",
+    )
+    ap.add_argument("-j", "--jobs", type=int, default=8, help="Parallel workers")
+    ap.add_argument("--pack", help="Regenerate this packed golden store afterwards")
+    ap.add_argument("--report", help="Write a JSON report of the changes here")
+    ap.add_argument(
+        "--all-differing",
+        action="store_true",
+        help="Update every golden image that is not byte for byte identical to its "
+        "result, not only those that failed the comparison",
+    )
+    ap.add_argument(
+        "-n", "--dry-run", action="store_true", help="Only report what would change"
+    )
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    results_path = Path(args.results).expanduser().resolve()
+    golden_results_path = Path(args.golden).expanduser().resolve()
+    if not results_path.is_dir():
+        log.error("Results directory not found: %s", results_path)
+        sys.exit(1)
+
+    report = update_goldens(
+        results_path,
+        golden_results_path,
+        _load_path_transform(args.test),
+        args.select,
+        args.jobs,
+        args.dry_run,
+        args.all_differing,
+    )
+    for key in report.added:
+        log.info("Added %s", key)
+    for key in report.updated:
+        log.info("Updated %s", key)
+    log.info(
+        "%d added, %d updated, %d unchanged, %d conflicting",
+        len(report.added),
+        len(report.updated),
+        len(report.unchanged),
+        len(report.conflicts),
+    )
+
+    if args.pack and not args.dry_run and (report.added or report.updated):
+        pack_directory(golden_results_path, Path(args.pack))
+    if args.report:
+        Path(args.report).write_text(json.dumps(report.to_dict(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Structured results written by guest test programs.
+
+Guest programs record their checks with test-xbe/xemutest_results.h, which
+writes a header with the frequency of the guest performance counter followed by
+one tab-separated record per check::
+
+    xemutest-results 1 3375000
+    PASS	video_mode	1234
+    FAIL	file_read	56789	Read back data differs
+
+Records are parsed as they are read, so a file cut short by a crash yields the
+records written before it. Records are flushed along with their newline, so a
+last line without one was cut short, and is ignored.
+"""
+
+import logging
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+from pathlib import Path
+
+from .test_base import TestStatus
+
+
+log = logging.getLogger(__name__)
+
+RESULTS_FILE_NAME = "test_results.txt"
+HEADER_MAGIC = "xemutest-results"
+FORMAT_VERSION = 1
+STATUSES = {
+    "PASS": TestStatus.PASSED,
+    "FAIL": TestStatus.FAILED,
+    "SKIP": TestStatus.UNVERIFIED,
+}
+
+
+@dataclass
+class GuestRecord:
+    """Outcome of one check of a guest test program."""
+
+    name: str
+    status: TestStatus
+    seconds: float  # Measured by the guest
+    message: str = ""
+
+
+def parse_guest_results(lines: Iterable[str]) -> Iterator[GuestRecord]:
+    """Parse the lines of a results file into records."""
+    lines = iter(lines)
+    header_line = next(lines, "")
+    header = header_line.split()
+    if not header_line.endswith("\n") or len(header) != 3 or header[0] != HEADER_MAGIC:
+        raise ValueError("Not a guest results file")
+    if int(header[1]) != FORMAT_VERSION:
+        raise ValueError(f"Unsupported guest results version {header[1]}")
+    frequency = int(header[2])
+    if frequency <= 0:
+        raise ValueError(f"Invalid performance counter frequency {frequency}")
+
+    for line_number, line in enumerate(lines, 2):
+        if not line.endswith("\n"):
+            log.warning("Ignoring unterminated guest result on line %d", line_number)
+            continue
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        fields = line.split("\t", 3)
+        try:
+            status = STATUSES[fields[0]]
+            ticks = int(fields[2])
+        except (IndexError, KeyError, ValueError):
+            # Usually the last line of a program that crashed while writing it
+            log.warning("Ignoring malformed guest result on line %d", line_number)
+            continue
+        message = fields[3] if len(fields) > 3 else ""
+        yield GuestRecord(fields[1], status, ticks / frequency, message)
+
+
+def read_guest_results(path: Path) -> Iterator[GuestRecord]:
+    """Read records from a results file as it is parsed."""
+    with open(path, encoding="utf-8", errors="replace") as file:
+        yield from parse_guest_results(file)
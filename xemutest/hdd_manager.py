@@ -1,10 +1,13 @@
 import logging
-import shutil
 import subprocess
 import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from pyfatx import Fatx
+from .scratch import remove_tree
+
+if TYPE_CHECKING:
+    from pyfatx import Fatx
 
 
 log = logging.getLogger(__name__)
@@ -17,22 +20,24 @@ class HddManager:
         self.hdd_path = hdd_path
 
     def prepare(self, disk_size: int = 8 * 1024 * 1024 * 1024):
-        """Create or format the HDD image."""
+        """Create or format the HDD image.
+
+        The image is recreated as a sparse file, so that it only takes up space for
+        the data written to it, e.g. when it is on a tmpfs.
+        """
         log.debug("Preparing HDD image")
-        if self.hdd_path.exists():
-            if self.hdd_path.stat().st_size != disk_size:
-                raise FileExistsError(
-                    "Target image path exists and is not expected size"
-                )
-            Fatx.format(str(self.hdd_path))
-        else:
-            Fatx.create(str(self.hdd_path), disk_size)
+        if self.hdd_path.exists() and self.hdd_path.stat().st_size != disk_size:
+            raise FileExistsError("Target image path exists and is not expected size")
+        with open(self.hdd_path, "wb") as image:
+            image.truncate(disk_size)
+        from pyfatx import Fatx
+
+        Fatx.format(str(self.hdd_path))
 
     def extract_files_to(self, dest: Path):
         """Mount the HDD image to the filesystem."""
         log.debug(f"Extracting HDD image files from {self.hdd_path} to {dest}")
-        if dest.exists():
-            shutil.rmtree(dest)
+        remove_tree(dest)
         dest.mkdir(parents=True, exist_ok=True)
 
         subprocess.run(
@@ -41,6 +46,8 @@ class HddManager:
             cwd=dest,
         )
 
-    def get_filesystem(self, drive: str = "c") -> Fatx:
+    def get_filesystem(self, drive: str = "c") -> "Fatx":
         """Get a Fatx filesystem object for the HDD."""
+        from pyfatx import Fatx
+
         return Fatx(str(self.hdd_path), drive=drive)
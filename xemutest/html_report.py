@@ -0,0 +1,197 @@
+"""Static HTML triage report of failed tests.
+
+Writes ``report/index.html`` to the results directory, showing the expected,
+actual and diff images of every failed subtest side by side along with its
+scores. Thumbnails are generated by a pool of ffmpeg workers when ffmpeg is
+available, and all images are lazy-loaded so that reports with thousands of
+entries open instantly. Full-size images link to the files in the results
+directory, so the report can be browsed from a downloaded results artifact.
+"""
+
+import hashlib
+import html
+import logging
+import os
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .scratch import remove_tree
+from .test_base import TestResult, TestStatus
+
+
+log = logging.getLogger(__name__)
+
+THUMBNAIL_WIDTH = 213
+IMAGE_ROLES = ("expected", "actual", "diff")
+
+STYLE = """
+body { font-family: sans-serif; margin: 1em; }
+table { border-collapse: collapse; }
+td, th { border: 1px solid #ccc; padding: 4px; vertical-align: top; }
+td.name { max-width: 24em; word-break: break-all; }
+img { width: %dpx; height: %dpx; object-fit: contain; background: #eee; }
+.FAILED { color: #b00; } .PASSED { color: #070; } .UNVERIFIED { color: #a60; }
+#filter { width: 30em; margin-bottom: 1em; }
+""" % (
+    THUMBNAIL_WIDTH,
+    THUMBNAIL_WIDTH * 3 // 4,
+)
+
+FILTER_SCRIPT = """
+document.getElementById("filter").addEventListener("input", function (e) {
+  var needle = e.target.value.toLowerCase();
+  document.querySelectorAll("tbody tr").forEach(function (row) {
+    row.hidden = needle && row.dataset.name.indexOf(needle) < 0;
+  });
+});
+"""
+
+
+class ThumbnailGenerator:
+    """Scales images down with ffmpeg on a pool of worker threads."""
+
+    def __init__(self, thumbs_path: Path, ffmpeg_path: Path | None, jobs: int):
+        self.thumbs_path = thumbs_path
+        self.ffmpeg_path = ffmpeg_path
+        self._executor = None
+        self._futures = {}
+        if ffmpeg_path:
+            self.thumbs_path.mkdir(parents=True, exist_ok=True)
+            self._executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def submit(self, image_path: Path) -> Path:
+        """Queue a thumbnail and return its path, or image_path without ffmpeg."""
+        if self._executor is None:
+            return image_path
+        digest = hashlib.sha1(str(image_path).encode("utf-8")).hexdigest()
+        thumb_path = self.thumbs_path / f"{digest}.png"
+        if thumb_path not in self._futures:
+            self._futures[thumb_path] = self._executor.submit(
+                self._generate, image_path, thumb_path
+            )
+        return thumb_path
+
+    def _generate(self, image_path: Path, thumb_path: Path):
+        c = [
+            str(self.ffmpeg_path),
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            str(image_path),
+            "-vf",
+            f"scale={THUMBNAIL_WIDTH}:-1",
+            str(thumb_path),
+        ]
+        result = subprocess.run(c, capture_output=True)
+        if result.returncode != 0:
+            # Fall back to the full image
+            log.debug("Thumbnail of %s failed: %s", image_path, result.stderr)
+            shutil.copyfile(image_path, thumb_path)
+
+    def wait(self):
+        if self._executor is None:
+            return
+        self._executor.shutdown(wait=True)
+        for future in self._futures.values():
+            future.result()
+
+
+def _failed_entries(test_result: TestResult, name: str, results_path: Path):
+    """
+    Yields (name, result, results path) for every failed leaf of a test result.
+
+    Config matrix cells are subtests with subtests of their own, whose results are
+    in a subdirectory named after the cell.
+    """
+    if not test_result.subtests:
+        if test_result.status == TestStatus.FAILED:
+            yield name, test_result, results_path
+        return
+    for subtest in test_result.subtests:
+        if subtest.subtests:
+            yield from _failed_entries(
+                subtest, f"{name}::{subtest.name}", results_path / subtest.name
+            )
+        elif subtest.status == TestStatus.FAILED:
+            yield f"{name}::{subtest.name}", subtest, results_path
+
+
+def write_report(
+    results_root: Path,
+    test_results: dict[str, TestResult],
+    ffmpeg_path: Path | None = None,
+    jobs: int | None = None,
+) -> Path:
+    """Write the HTML report and return its path."""
+    report_path = results_root / "report"
+    remove_tree(report_path)
+    report_path.mkdir(parents=True)
+    thumbnails = ThumbnailGenerator(
+        report_path / "thumbs", ffmpeg_path, jobs or os.cpu_count() or 4
+    )
+
+    def link(path: Path) -> str:
+        return html.escape(Path(os.path.relpath(path, report_path)).as_posix())
+
+    overview = []
+    rows = []
+    for test_name, test_result in test_results.items():
+        counts: dict[str, int] = {}
+        for subtest in test_result.subtests or [test_result]:
+            counts[subtest.status.name] = counts.get(subtest.status.name, 0) + 1
+        overview.append(
+            f'<li><span class="{test_result.status.name}">'
+            f"{html.escape(test_name)}: {test_result.status.name}</span> "
+            f"({', '.join(f'{n} {s.lower()}' for s, n in sorted(counts.items()))})"
+            f"{' - ' + html.escape(test_result.message) if test_result.message else ''}"
+            "</li>"
+        )
+
+        for name, result, results_path in _failed_entries(
+            test_result, test_name, results_root / test_name
+        ):
+            images = []
+            for role in IMAGE_ROLES:
+                artifact = result.artifacts.get(role)
+                image_path = results_path / artifact if artifact else None
+                if image_path is None or not image_path.is_file():
+                    images.append("<td></td>")
+                    continue
+                thumb_path = thumbnails.submit(image_path)
+                images.append(
+                    f'<td><a href="{link(image_path)}"><img loading="lazy" '
+                    f'decoding="async" alt="{role}" src="{link(thumb_path)}"></a></td>'
+                )
+            scores = "<br>".join(
+                f"{html.escape(k)}: {v:g}" for k, v in sorted(result.metrics.items())
+            )
+            rows.append(
+                f'<tr data-name="{html.escape(name.lower())}">'
+                f'<td class="name">{html.escape(name)}</td>'
+                f"<td>{html.escape(result.message)}</td>"
+                f"<td>{scores}</td>{''.join(images)}</tr>"
+            )
+
+    thumbnails.wait()
+
+    index_path = report_path / "index.html"
+    index_path.write_text(
+        "<!DOCTYPE html>\n"
+        '<html><head><meta charset="utf-8"><title>xemu Test Report</title>'
+        f"<style>{STYLE}</style></head><body>\n"
+        "<h1>xemu Test Report</h1>\n"
+        f"<ul>{''.join(overview)}</ul>\n"
+        f"<h2>Failures ({len(rows)})</h2>\n"
+        '<input id="filter" type="search" placeholder="Filter by name">\n'
+        "<table><thead><tr><th>Test</th><th>Details</th><th>Scores</th>"
+        + "".join(f"<th>{role.capitalize()}</th>" for role in IMAGE_ROLES)
+        + "</tr></thead><tbody>\n"
+        + "\n".join(rows)
+        + f"\n</tbody></table><script>{FILTER_SCRIPT}</script></body></html>\n",
+        encoding="utf-8",
+    )
+    log.info("Wrote test report to %s", index_path)
+    return index_path
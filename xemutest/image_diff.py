@@ -0,0 +1,267 @@
+"""Pixel-level image comparison without third-party dependencies.
+
+Two PNG images have the same pixels if their headers, palettes and decompressed
+image data match, which is checked without decoding the pixels, so that such
+images are recognized without a perceptual diff. Images that the perceptual diff
+failed are decoded with zlib and compared tile by tile, to localize the
+differences to bounding boxes. Only the color channels are compared; alpha is
+dropped when decoding.
+"""
+
+import functools
+import struct
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TILE_SIZE = 32
+
+# Bytes per pixel by PNG color type, for a bit depth of 8
+_COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+@dataclass
+class Image:
+    """An RGB image with 8 bits per channel."""
+
+    width: int
+    height: int
+    rows: list[bytes]  # width * 3 bytes each
+
+
+@dataclass(frozen=True)
+class Box:
+    x: int
+    y: int
+    width: int
+    height: int
+
+    def union(self, other: "Box") -> "Box":
+        x = min(self.x, other.x)
+        y = min(self.y, other.y)
+        return Box(
+            x,
+            y,
+            max(self.x + self.width, other.x + other.width) - x,
+            max(self.y + self.height, other.y + other.height) - y,
+        )
+
+    def __str__(self) -> str:
+        return f"{self.width}x{self.height}+{self.x}+{self.y}"
+
+
+@dataclass
+class TileDiff:
+    """Differences between two images of the same size."""
+
+    tile_size: int
+    # Bounding box of each differing tile, by tile index
+    tiles: dict[tuple[int, int], Box] = field(default_factory=dict)
+
+    def regions(self) -> list[Box]:
+        """Bounding boxes of groups of adjacent differing tiles."""
+        regions = []
+        remaining = set(self.tiles)
+        while remaining:
+            stack = [remaining.pop()]
+            box = self.tiles[stack[0]]
+            while stack:
+                tx, ty = stack.pop()
+                for dx in (-1, 0, 1):
+                    for dy in (-1, 0, 1):
+                        neighbor = (tx + dx, ty + dy)
+                        if neighbor in remaining:
+                            remaining.remove(neighbor)
+                            box = box.union(self.tiles[neighbor])
+                            stack.append(neighbor)
+            regions.append(box)
+        return sorted(regions, key=lambda box: (box.y, box.x))
+
+
+@functools.lru_cache(maxsize=16)
+def _byte_masks(length: int) -> tuple[int, int]:
+    return (
+        int.from_bytes(b"\x7f" * length, "little"),
+        int.from_bytes(b"\x80" * length, "little"),
+    )
+
+
+def _add_bytes(a: int, b: int, length: int) -> int:
+    """Add the bytes of two little-endian integers modulo 256, without carries."""
+    low, high = _byte_masks(length)
+    return ((a & low) + (b & low)) ^ ((a ^ b) & high)
+
+
+def _unfilter(data: bytes, width: int, height: int, bpp: int) -> list[bytes]:
+    stride = width * bpp
+    full = (1 << (8 * stride)) - 1
+    rows = []
+    prev = bytes(stride)
+    pos = 0
+    for _ in range(height):
+        filter_type = data[pos]
+        line = data[pos + 1 : pos + 1 + stride]
+        pos += stride + 1
+        if filter_type == 0:
+            row = line
+        elif filter_type == 1:
+            # Prefix sums of the pixels, in log2(width) steps
+            value = int.from_bytes(line, "little")
+            shift = bpp
+            while shift < stride:
+                shifted = (value << (8 * shift)) & full
+                value = _add_bytes(value, shifted, stride)
+                shift *= 2
+            row = value.to_bytes(stride, "little")
+        elif filter_type == 2:
+            row = _add_bytes(
+                int.from_bytes(line, "little"), int.from_bytes(prev, "little"), stride
+            ).to_bytes(stride, "little")
+        elif filter_type == 3:
+            out = bytearray(line)
+            for i in range(stride):
+                left = out[i - bpp] if i >= bpp else 0
+                out[i] = (out[i] + ((left + prev[i]) >> 1)) & 0xFF
+            row = bytes(out)
+        elif filter_type == 4:
+            out = bytearray(line)
+            for i in range(stride):
+                a = out[i - bpp] if i >= bpp else 0
+                b = prev[i]
+                c = prev[i - bpp] if i >= bpp else 0
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                if pa <= pb and pa <= pc:
+                    predictor = a
+                elif pb <= pc:
+                    predictor = b
+                else:
+                    predictor = c
+                out[i] = (out[i] + predictor) & 0xFF
+            row = bytes(out)
+        else:
+            raise ValueError(f"Invalid PNG filter type {filter_type}")
+        rows.append(row)
+        prev = row
+    return rows
+
+
+def _to_rgb(row: bytes, color_type: int, palette: bytes) -> bytes:
+    if color_type == 2:
+        return row
+    rgb = bytearray(len(row) // _COLOR_TYPE_CHANNELS[color_type] * 3)
+    if color_type == 6:
+        rgb[0::3], rgb[1::3], rgb[2::3] = row[0::4], row[1::4], row[2::4]
+    elif color_type in (0, 4):
+        gray = row[0::2] if color_type == 4 else row
+        rgb[0::3] = rgb[1::3] = rgb[2::3] = gray
+    else:
+        for channel in range(3):
+            rgb[channel::3] = row.translate(palette[channel::3].ljust(256, b"\0"))
+    return bytes(rgb)
+
+
+@dataclass
+class PngData:
+    """The chunks of a PNG image that determine its pixels."""
+
+    header: tuple  # IHDR fields
+    palette: bytes
+    idat: bytes  # Compressed image data
+
+    @property
+    def width(self) -> int:
+        return self.header[0]
+
+    @property
+    def height(self) -> int:
+        return self.header[1]
+
+
+def read_png_data(path: Path) -> PngData:
+    """Read the chunks of a PNG image, without decompressing them."""
+    data = Path(path).read_bytes()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError(f"{path} is not a PNG image")
+    pos = len(PNG_SIGNATURE)
+    header = None
+    palette = b""
+    idat = []
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos : pos + 8])
+        chunk = data[pos + 8 : pos + 8 + length]
+        pos += length + 12
+        if kind == b"IHDR":
+            header = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"PLTE":
+            palette = chunk
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+    if header is None:
+        raise ValueError(f"{path} has no PNG header")
+    return PngData(header, palette, b"".join(idat))
+
+
+def same_pixels(expected_path: Path, actual_path: Path) -> bool:
+    """Whether two PNG images certainly have the same pixels.
+
+    Images encoded with different filters may have the same pixels, but are not
+    recognized as such.
+    """
+    expected = read_png_data(expected_path)
+    actual = read_png_data(actual_path)
+    if (expected.header, expected.palette) != (actual.header, actual.palette):
+        return False
+    if expected.idat == actual.idat:
+        return True
+    return zlib.decompress(expected.idat) == zlib.decompress(actual.idat)
+
+
+def read_png(path: Path) -> Image:
+    """Decode a non-interlaced PNG with 8 bits per channel."""
+    png = read_png_data(path)
+    width, height, bit_depth, color_type, _, _, interlace = png.header
+    if bit_depth != 8 or color_type not in _COLOR_TYPE_CHANNELS or interlace:
+        raise ValueError(
+            f"Unsupported PNG format of {path} (bit depth {bit_depth}, "
+            f"color type {color_type}, interlace {interlace})"
+        )
+    rows = _unfilter(
+        zlib.decompress(png.idat),
+        width,
+        height,
+        _COLOR_TYPE_CHANNELS[color_type],
+    )
+    return Image(width, height, [_to_rgb(row, color_type, png.palette) for row in rows])
+
+
+def diff_images(expected: Image, actual: Image, tile_size: int = TILE_SIZE) -> TileDiff:
+    """Find the tiles that differ between two images of the same size.
+
+    Rows of tiles are compared as byte strings, so the box of a tile spans its
+    width and the rows that differ in it.
+    """
+    if (expected.width, expected.height) != (actual.width, actual.height):
+        raise ValueError("Images differ in size")
+    diff = TileDiff(tile_size)
+    tiles_x = (actual.width + tile_size - 1) // tile_size
+    row_bytes = tile_size * 3
+    for y in range(actual.height):
+        a = expected.rows[y]
+        b = actual.rows[y]
+        if a == b:
+            continue
+        ty = y // tile_size
+        for tx in range(tiles_x):
+            start = tx * row_bytes
+            if a[start : start + row_bytes] == b[start : start + row_bytes]:
+                continue
+            x = tx * tile_size
+            row = Box(x, y, min(tile_size, actual.width - x), 1)
+            box = diff.tiles.get((tx, ty))
+            diff.tiles[(tx, ty)] = row if box is None else box.union(row)
+    return diff
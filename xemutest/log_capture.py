@@ -0,0 +1,148 @@
+"""Bounded capture of process output with crash signature matching.
+
+Output is read line by line on a background thread. The first ``head_bytes`` are
+written to the log file as they arrive, and after that only the last
+``tail_bytes`` are kept in a ring, which is appended to the log file when the
+process exits, after a note of how much output was dropped. Every line is matched
+against known signatures of crashes and rendering errors on the fly.
+
+The reader owns the stream and closes it at its end. If the stream stays open
+after the process has exited, e.g. because a child process inherited it, the log
+is completed without waiting, and the reader keeps draining the stream in the
+background without recording it. Closing the stream from another thread is not
+an option, as it blocks while a read is in progress.
+"""
+
+import collections
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import BinaryIO
+
+
+log = logging.getLogger(__name__)
+
+HEAD_BYTES = 1024 * 1024
+TAIL_BYTES = 4 * 1024 * 1024
+MAX_LINE_BYTES = 64 * 1024
+MAX_FINDINGS = 10
+MAX_FINDING_LENGTH = 200
+# Seconds to wait for the end of the output once the process has exited
+CLOSE_TIMEOUT = 10
+
+CRASH_SIGNATURES: list[tuple[str, re.Pattern]] = [
+    ("Assertion", re.compile(rb"[Aa]ssertion .*failed")),
+    ("Segfault", re.compile(rb"Segmentation fault|SIGSEGV|signal 11\b")),
+    ("Abort", re.compile(rb"SIGABRT|\bAborted\b|terminate called")),
+    ("OpenGL", re.compile(rb"GL_INVALID_\w+|GL_OUT_OF_MEMORY|OpenGL error")),
+    ("Vulkan", re.compile(rb"VK_ERROR_\w+|Validation Error:")),
+    ("Fatal", re.compile(rb"\b(?:FATAL|[Ff]atal error|panic)\b")),
+]
+
+
+class LogCapture:
+    """Streams process output into a size-bounded log file."""
+
+    def __init__(
+        self,
+        log_path: Path,
+        head_bytes: int = HEAD_BYTES,
+        tail_bytes: int = TAIL_BYTES,
+        signatures: list[tuple[str, re.Pattern]] = CRASH_SIGNATURES,
+    ):
+        self.log_path = log_path
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.signatures = signatures
+        self.total_bytes = 0
+        self.findings: list[str] = []  # e.g. "Segfault: Segmentation fault"
+        self._tail: collections.deque[bytes] = collections.deque()
+        self._tail_size = 0
+        self._file = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._detached = False  # Whether close() stopped waiting for the reader
+
+    def start(self, stream: BinaryIO):
+        """Start reading a binary stream until it is closed."""
+        self._file = open(self.log_path, "wb")
+        self._thread = threading.Thread(target=self._read, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _match(self, line: bytes):
+        if len(self.findings) >= MAX_FINDINGS:
+            return
+        for name, pattern in self.signatures:
+            if pattern.search(line):
+                text = line.decode("utf-8", "replace").strip()
+                finding = f"{name}: {text[:MAX_FINDING_LENGTH]}"
+                if finding not in self.findings:
+                    log.warning("xemu log: %s", finding)
+                    self.findings.append(finding)
+                return
+
+    def _read(self, stream: BinaryIO):
+        head_remaining = self.head_bytes
+        try:
+            for line in iter(lambda: stream.readline(MAX_LINE_BYTES), b""):
+                with self._lock:
+                    if self._detached:
+                        continue  # Only drain the stream
+                    self.total_bytes += len(line)
+                    self._match(line)
+                    if head_remaining > 0:
+                        head_remaining -= len(line)
+                        self._write_head(line)
+                        continue
+                    self._tail.append(line)
+                    self._tail_size += len(line)
+                    while self._tail_size > self.tail_bytes:
+                        self._tail_size -= len(self._tail.popleft())
+        except Exception:
+            log.exception("Failed to read the output for %s", self.log_path)
+        finally:
+            stream.close()
+
+    def _write_head(self, line: bytes):
+        if self._file is None:
+            return
+        try:
+            self._file.write(line)
+            self._file.flush()
+        except OSError as e:
+            # Keep draining the stream, so that the process does not block on it
+            log.error("Failed to write %s: %s", self.log_path, e)
+            file, self._file = self._file, None
+            try:
+                file.close()
+            except OSError:
+                pass
+
+    def close(self, timeout: float = CLOSE_TIMEOUT):
+        """Complete the log file once the stream ends, or after timeout seconds."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                log.warning(
+                    "Output for %s still open after %ds, no longer recording it",
+                    self.log_path,
+                    timeout,
+                )
+            self._thread = None
+        with self._lock:
+            self._detached = True
+            if self._file is None:
+                return
+            try:
+                omitted = self.total_bytes - self._file.tell() - self._tail_size
+                if omitted > 0:
+                    note = f"\n[... {omitted} bytes omitted ...]\n\n"
+                    self._file.write(note.encode())
+                self._file.writelines(self._tail)
+                self._file.close()
+            except OSError as e:
+                log.error("Failed to write %s: %s", self.log_path, e)
+            self._file = None
+            self._tail.clear()
+            self._tail_size = 0
@@ -0,0 +1,45 @@
+"""Configuration matrices of tests.
+
+A test declares a matrix as a ``config_matrix`` class attribute, mapping xemu
+config keys to the values to test, e.g.::
+
+    config_matrix = {
+        "display.renderer": ["OPENGL", "VULKAN"],
+        "sys.mem_limit": ["64", "128"],
+    }
+
+Every combination of values (a cell) is run as an independent job, whose xemu
+config is overridden with the values of the cell.
+"""
+
+import itertools
+from dataclasses import dataclass, field
+
+from .xemu_config import ConfigValue
+
+
+@dataclass
+class MatrixCell:
+    """One combination of config matrix values."""
+
+    overrides: dict[str, ConfigValue] = field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        """Name of the cell, e.g. ``vulkan-128``. Empty for the default cell."""
+        return "-".join(str(value).lower() for value in self.overrides.values())
+
+    def get(self, key: str, default=None):
+        return self.overrides.get(key, default)
+
+    def __bool__(self) -> bool:
+        return bool(self.overrides)
+
+
+def expand_matrix(config_matrix: dict[str, list]) -> list[MatrixCell]:
+    """Returns every cell of a matrix, or a single default cell if it is empty."""
+    keys = list(config_matrix)
+    return [
+        MatrixCell(dict(zip(keys, values)))
+        for values in itertools.product(*(config_matrix[key] for key in keys))
+    ]
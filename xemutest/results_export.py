@@ -0,0 +1,232 @@
+"""Machine-readable export of test results.
+
+Results are streamed to disk as they are produced, so that a runner that crashes
+or is killed part way through still leaves behind everything that finished:
+
+- ``results.jsonl``: One JSON object per line for every subtest and test.
+- ``junit.xml``: JUnit XML, rewritten in place so the file is always well-formed.
+"""
+
+import json
+import logging
+import re
+import socket
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+
+from .test_base import TestResult, TestStatus
+
+
+log = logging.getLogger(__name__)
+
+# Characters that are not allowed in XML 1.0 documents
+XML_INVALID_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def format_timestamp(timestamp: float) -> str:
+    """Format seconds since the epoch as an ISO 8601 UTC timestamp."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(
+        timespec="milliseconds"
+    )
+
+
+def result_to_dict(result: TestResult, test_id: str | None = None) -> dict:
+    """Convert a result into a JSON-serializable dict (without subtests)."""
+    return {
+        "id": test_id or result.name,
+        "name": result.name,
+        "status": result.status.name,
+        "message": result.message,
+        "duration": result.duration_seconds,
+        "start_time": (
+            format_timestamp(result.start_time) if result.start_time else None
+        ),
+        "attempts": result.attempts,
+        "failed_attempts": result.failed_attempts,
+        "flaky": result.flaky,
+        "metrics": result.metrics,
+        "artifacts": result.artifacts,
+    }
+
+
+class JsonLinesResultWriter:
+    """Appends one JSON record per finished subtest and test to a file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _write(self, record: dict):
+        record["timestamp"] = format_timestamp(time.time())
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def subtest_finished(self, test_name: str, subtest: TestResult):
+        record = result_to_dict(subtest, f"{test_name}::{subtest.name}")
+        record["type"] = "subtest"
+        record["test"] = test_name
+        self._write(record)
+
+    def test_finished(self, result: TestResult):
+        record = result_to_dict(result)
+        record["type"] = "test"
+        record["subtests"] = len(result.subtests)
+        record["failed_subtests"] = sum(
+            1 for subtest in result.subtests if subtest.status == TestStatus.FAILED
+        )
+        self._write(record)
+
+    def close(self):
+        self._file.close()
+
+
+class JUnitXmlResultWriter:
+    """
+    Streams results into a JUnit XML file.
+
+    Each test becomes a ``<testsuite>`` and each subtest a ``<testcase>``. New
+    elements are written over the closing tags, which are then re-appended, so the
+    file on disk is a complete document after every write. Subtests of tests that
+    run concurrently with the test whose suite is open are held back until their
+    own suite is opened.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._file = open(path, "wb")
+        self._file.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<testsuites>\n')
+        self._body_end = self._file.tell()
+        self._open_suite: str | None = None
+        self._pending: dict[str, list[str]] = {}  # Held back testcases by test
+        self._hostname = socket.gethostname()
+        self._write("")
+
+    @staticmethod
+    def _attr(value) -> str:
+        return quoteattr(XML_INVALID_RE.sub("", str(value)))
+
+    @staticmethod
+    def _text(value: str) -> str:
+        return escape(XML_INVALID_RE.sub("", value))
+
+    def _write(self, content: str):
+        footer = "</testsuites>\n"
+        if self._open_suite is not None:
+            footer = "  </testsuite>\n" + footer
+        self._file.seek(self._body_end)
+        self._file.write(content.encode("utf-8"))
+        self._body_end = self._file.tell()
+        self._file.write(footer.encode("utf-8"))
+        self._file.truncate()
+        self._file.flush()
+
+    def _ensure_suite(self, test_name: str, start_time: float | None = None):
+        if self._open_suite == test_name:
+            return
+        if self._open_suite is not None:
+            self._close_suite()
+        timestamp = format_timestamp(start_time or time.time())
+        content = (
+            f"  <testsuite name={self._attr(test_name)}"
+            f" timestamp={self._attr(timestamp)}"
+            f" hostname={self._attr(self._hostname)}>\n"
+        )
+        self._open_suite = test_name
+        self._write(content + "".join(self._pending.pop(test_name, [])))
+
+    def _close_suite(self, system_out: str = ""):
+        content = ""
+        if system_out:
+            content += f"    <system-out>{self._text(system_out)}</system-out>\n"
+        content += "  </testsuite>\n"
+        self._open_suite = None
+        self._write(content)
+
+    def _testcase(self, classname: str, result: TestResult) -> str:
+        attrs = f"name={self._attr(result.name)} classname={self._attr(classname)}"
+        seconds = result.duration_seconds
+        if seconds is not None:
+            attrs += f' time="{seconds:.3f}"'
+        match result.status:
+            case TestStatus.FAILED:
+                child = f"<failure message={self._attr(result.message or 'Failed')}/>"
+            case TestStatus.UNVERIFIED:
+                child = '<skipped message="Result not verified"/>'
+            case TestStatus.RUNNING:
+                child = '<error message="Test did not finish"/>'
+            case _:
+                child = ""
+        if result.flaky:
+            # Surefire convention for tests that passed after failing
+            child += "".join(
+                '<flakyFailure message="Failed attempt"/>'
+                for _ in range(result.failed_attempts)
+            )
+        if child:
+            return f"    <testcase {attrs}>{child}</testcase>\n"
+        return f"    <testcase {attrs}/>\n"
+
+    def subtest_finished(self, test_name: str, subtest: TestResult):
+        testcase = self._testcase(test_name, subtest)
+        if self._open_suite not in (None, test_name):
+            self._pending.setdefault(test_name, []).append(testcase)
+            return
+        self._ensure_suite(test_name)
+        self._write(testcase)
+
+    def test_finished(self, result: TestResult):
+        self._ensure_suite(result.name, result.start_time)
+        if not result.subtests:
+            self._write(self._testcase(result.name, result))
+        self._close_suite(result.message)
+
+    def close(self):
+        if self._open_suite is not None:
+            self._close_suite()
+        for test_name in list(self._pending):
+            self._ensure_suite(test_name)
+            self._close_suite()
+        self._file.close()
+
+
+class ResultExporter:
+    """
+    Streams test results to JSON Lines and JUnit XML files in a directory.
+
+    Usage:
+        with ResultExporter(results_root) as exporter:
+            test.set_result_listener(exporter)
+            exporter.test_finished(test.run())
+    """
+
+    def __init__(self, results_root: Path):
+        self.writers = [
+            JsonLinesResultWriter(results_root / "results.jsonl"),
+            JUnitXmlResultWriter(results_root / "junit.xml"),
+        ]
+
+    def subtest_finished(self, test_name: str, subtest: TestResult):
+        for writer in self.writers:
+            try:
+                writer.subtest_finished(test_name, subtest)
+            except Exception:
+                log.exception("Failed to export result of %s", subtest.name)
+
+    def test_finished(self, result: TestResult):
+        for writer in self.writers:
+            try:
+                writer.test_finished(result)
+            except Exception:
+                log.exception("Failed to export result of %s", result.name)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
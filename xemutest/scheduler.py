@@ -0,0 +1,562 @@
+"""Scheduling of test jobs across a pool of workers.
+
+Every selected test is expanded into one job per cell of its config matrix.
+Expected job durations come from the timings of previous runs (see
+TimingHistory), falling back to the ``expected_duration`` of the test class, and
+jobs are started longest expected duration first, which keeps the makespan close
+to optimal. Two strategies are available:
+
+- ``lpt``: Workers take the next job from a shared queue in that order.
+- ``steal``: Jobs are planned onto workers up front, and workers that run out of
+  jobs steal the shortest pending job of the worker with the most work left.
+
+With several workers, long jobs of shardable tests are split into shards of their
+subtests (e.g. pgraph test suites), packed by their historical durations so that
+all workers finish at about the same time.
+"""
+
+import collections
+import contextlib
+import heapq
+import json
+import logging
+import math
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, replace
+from pathlib import Path
+
+from . import ci
+from .discovery import DiscoveredTest, Shard, TestSelection
+from .env import Environment
+from .matrix import MatrixCell, expand_matrix
+from .test_base import (
+    ResultCounts,
+    RetryPolicy,
+    TestResult,
+    TestStatus,
+    format_duration,
+)
+
+
+log = logging.getLogger(__name__)
+
+SCHEDULE_STRATEGIES = ("lpt", "steal")
+TIMING_HISTORY_VERSION = 1
+
+
+class TimingHistory:
+    """
+    Durations of jobs and subtests in previous runs, by name.
+
+    Durations are exponentially smoothed over runs. For every job, the overhead of
+    a launch (e.g. booting xemu), which is the job duration not spent in any
+    subtest, is kept as well.
+    """
+
+    SMOOTHING = 0.5  # Weight of the latest run
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.durations: dict[str, float] = {}
+        self.overheads: dict[str, float] = {}
+        if path is not None and path.is_file():
+            try:
+                data = json.loads(path.read_text())
+                if data.get("version") == TIMING_HISTORY_VERSION:
+                    self.durations = data["durations"]
+                    self.overheads = data["overheads"]
+            except (ValueError, KeyError):
+                log.warning("Ignoring invalid timing history %s", path)
+
+    def _update(self, table: dict[str, float], name: str, seconds: float):
+        previous = table.get(name)
+        if previous is not None:
+            seconds = self.SMOOTHING * seconds + (1 - self.SMOOTHING) * previous
+        table[name] = seconds
+
+    def duration(self, name: str) -> float | None:
+        return self.durations.get(name)
+
+    def overhead(self, name: str) -> float | None:
+        return self.overheads.get(name)
+
+    def unit_durations(self, name: str) -> dict[str, float]:
+        """Returns the durations of the subtests of a job, summed by shard unit."""
+        prefix = f"{name}::"
+        units: dict[str, float] = {}
+        for key, seconds in self.durations.items():
+            if key.startswith(prefix):
+                unit = key[len(prefix) :].split("::", 1)[0]
+                units[unit] = units.get(unit, 0.0) + seconds
+        return units
+
+    def record(
+        self, name: str, result: TestResult, launches: int = 1, complete: bool = True
+    ):
+        """
+        Record the durations of a job result and its subtests.
+
+        The job duration and overhead are only recorded if all of its subtests
+        were run (`complete`), and the overhead is divided over its `launches`.
+        """
+        subtest_time = 0.0
+        for subtest in result.subtests:
+            seconds = subtest.duration_seconds
+            if seconds is not None:
+                self._update(self.durations, f"{name}::{subtest.name}", seconds)
+                subtest_time += seconds
+        seconds = result.duration_seconds
+        if complete and seconds is not None:
+            self._update(self.durations, name, seconds)
+            overhead = max(0.0, seconds - subtest_time) / max(1, launches)
+            self._update(self.overheads, name, overhead)
+
+    def record_jobs(
+        self,
+        jobs: list["Job"],
+        grouped: dict[str, TestResult],
+        complete: Callable[[str], bool] = lambda test_name: True,
+    ):
+        """
+        Record the results of jobs grouped by test (see group_results), per cell.
+
+        `complete(test_name)` tells whether all subtests of a test were run.
+        """
+        launches = collections.Counter(job.cell_name for job in jobs)
+        matrix_tests = {job.test.name for job in jobs if job.cell}
+        cells = {
+            (test_name, cell.name): cell
+            for test_name in matrix_tests
+            for cell in grouped[test_name].subtests
+        }
+        for job in jobs:
+            if job.shard is not None and job.shard.index > 0:
+                continue
+            result = grouped[job.test.name]
+            if job.cell:
+                result = cells[job.test.name, job.cell.name]
+            self.record(
+                job.cell_name, result, launches[job.cell_name], complete(job.test.name)
+            )
+
+    def write(self):
+        if self.path is None:
+            return
+        self.path.write_text(
+            json.dumps(
+                {
+                    "version": TIMING_HISTORY_VERSION,
+                    "durations": self.durations,
+                    "overheads": self.overheads,
+                },
+                indent=0,
+                sort_keys=True,
+            )
+        )
+
+
+@dataclass
+class Job:
+    """One cell of the config matrix of a test, or a shard of one."""
+
+    index: int  # Index of the test
+    test: DiscoveredTest
+    cell: MatrixCell
+    expected_duration: float  # In seconds
+    shardable: bool = False
+    shard: Shard | None = None
+
+    @property
+    def cell_name(self) -> str:
+        """Name of the test and cell the job belongs to."""
+        if not self.cell:
+            return self.test.name
+        return f"{self.test.name}::{self.cell.name}"
+
+    @property
+    def name(self) -> str:
+        if self.shard is None:
+            return self.cell_name
+        return f"{self.cell_name}::{self.shard.name}"
+
+
+def expand_jobs(
+    tests: Iterable[DiscoveredTest], history: TimingHistory | None = None
+) -> list[Job]:
+    """Expand tests into a job per config matrix cell, in test order."""
+    jobs = []
+    for i, test in enumerate(tests):
+        try:
+            test_cls = test.load()
+        except Exception:
+            # Run as a single job, which reports the error
+            log.exception("Failed to load %s", test.name)
+            jobs.append(Job(i, test, MatrixCell(), 0.0))
+            continue
+        if test_cls is None:
+            continue
+        for cell in expand_matrix(test_cls.config_matrix):
+            job = Job(i, test, cell, test_cls.expected_duration, test_cls.shardable)
+            if history is not None:
+                job.expected_duration = (
+                    history.duration(job.name) or job.expected_duration
+                )
+            jobs.append(job)
+    return jobs
+
+
+def order_jobs(jobs: Iterable[Job]) -> list[Job]:
+    """Order jobs longest expected duration first."""
+    return sorted(jobs, key=lambda job: -job.expected_duration)
+
+
+def _pack(sizes: dict[str, float], bins: int) -> list[tuple[float, list[str]]]:
+    """Pack items into bins, largest first into the emptiest bin."""
+    heap: list[tuple[float, int, list[str]]] = [(0.0, i, []) for i in range(bins)]
+    for name in sorted(sizes, key=lambda name: -sizes[name]):
+        load, i, items = heapq.heappop(heap)
+        items.append(name)
+        heapq.heappush(heap, (load + sizes[name], i, items))
+    return [(load, items) for load, _, items in sorted(heap)]
+
+
+def shard_jobs(jobs: list[Job], history: TimingHistory, workers: int) -> list[Job]:
+    """
+    Split jobs that are longer than an even share of the total work into shards.
+
+    Only jobs of shardable tests with a timing history are split, into no more
+    shards than keeps the work per shard above the launch overhead.
+    """
+    if workers <= 1:
+        return jobs
+    target = sum(job.expected_duration for job in jobs) / workers
+    sharded = []
+    for job in jobs:
+        units = history.unit_durations(job.name) if job.shardable else {}
+        overhead = history.overhead(job.name)
+        if len(units) < 2 or overhead is None or job.expected_duration <= target:
+            sharded.append(job)
+            continue
+        work = sum(units.values())
+        num_shards = min(len(units), workers, math.ceil(job.expected_duration / target))
+        while num_shards > 1 and work / num_shards < overhead:
+            num_shards -= 1
+        if num_shards < 2:
+            sharded.append(job)
+            continue
+
+        bins = _pack(units, num_shards)
+        # The lightest shard also runs any units missing from the history
+        excluded = {unit for _, items in bins[1:] for unit in items}
+        for index, (load, items) in enumerate(bins):
+            if index == 0:
+                shard = Shard(index, None, excluded)
+            else:
+                shard = Shard(index, set(items))
+            sharded.append(replace(job, expected_duration=overhead + load, shard=shard))
+        log.info(
+            "Split %s into %d shards of %s",
+            job.name,
+            num_shards,
+            ", ".join(format_duration(overhead + load) for load, _ in bins),
+        )
+    return sharded
+
+
+def plan_jobs(jobs: Iterable[Job], workers: int) -> list[list[Job]]:
+    """Assign jobs, longest first, to the worker with the least planned work."""
+    heap = [(0.0, worker) for worker in range(workers)]
+    plans: list[list[Job]] = [[] for _ in range(workers)]
+    for job in order_jobs(jobs):
+        load, worker = heapq.heappop(heap)
+        plans[worker].append(job)
+        heapq.heappush(heap, (load + job.expected_duration, worker))
+    log.info(
+        "Planned makespan: %s on %d workers",
+        format_duration(max(load for load, _ in heap)),
+        workers,
+    )
+    return plans
+
+
+def _run_work_stealing(
+    jobs: list[Job], run_job: Callable[[Job, int], TestResult], workers: int
+) -> Iterator[tuple[Job, TestResult]]:
+    pending = [collections.deque(plan) for plan in plan_jobs(jobs, workers)]
+    lock = threading.Lock()
+    finished: queue.SimpleQueue = queue.SimpleQueue()
+
+    def next_job(worker: int) -> Job | None:
+        with lock:
+            if pending[worker]:
+                return pending[worker].popleft()
+            victim = max(
+                range(workers),
+                key=lambda w: sum(job.expected_duration for job in pending[w]),
+            )
+            if not pending[victim]:
+                return None
+            job = pending[victim].pop()
+            log.debug("Worker %d stole %s from worker %d", worker, job.name, victim)
+            return job
+
+    def work(worker: int):
+        while (job := next_job(worker)) is not None:
+            try:
+                finished.put((job, run_job(job, worker), None))
+            except BaseException as e:
+                finished.put((job, None, e))
+        finished.put(None)
+
+    for worker in range(workers):
+        threading.Thread(target=work, args=(worker,), daemon=True).start()
+    running = workers
+    while running:
+        item = finished.get()
+        if item is None:
+            running -= 1
+            continue
+        job, result, error = item
+        if error is not None:
+            raise error
+        yield job, result
+
+
+def run_jobs(
+    jobs: Iterable[Job],
+    run_job: Callable[[Job, int], TestResult],
+    workers: int = 1,
+    strategy: str = "lpt",
+) -> Iterator[tuple[Job, TestResult]]:
+    """
+    Run jobs on a pool of workers, yielding (job, result) as they finish.
+
+    `run_job(job, worker)` runs one job and returns its result. `worker` is the
+    index of the worker running it, which is never shared by concurrent jobs.
+    """
+    ordered = order_jobs(jobs)
+    if workers <= 1:
+        for job in ordered:
+            yield job, run_job(job, 0)
+        return
+
+    log.info("Running %d jobs on %d workers (%s)", len(ordered), workers, strategy)
+    if strategy == "steal":
+        yield from _run_work_stealing(ordered, run_job, workers)
+        return
+
+    plan_jobs(ordered, workers)  # Logs the expected makespan
+    idle_workers: queue.SimpleQueue[int] = queue.SimpleQueue()
+    for worker in range(workers):
+        idle_workers.put(worker)
+
+    def run(job: Job) -> TestResult:
+        worker = idle_workers.get()
+        try:
+            return run_job(job, worker)
+        finally:
+            idle_workers.put(worker)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # The executor starts jobs in submission order
+        futures = {executor.submit(run, job): job for job in ordered}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def _merged_status(results: list[TestResult]) -> TestStatus:
+    statuses = {result.status for result in results}
+    if TestStatus.FAILED in statuses or TestStatus.RUNNING in statuses:
+        return TestStatus.FAILED
+    if TestStatus.UNVERIFIED in statuses:
+        return TestStatus.UNVERIFIED
+    return TestStatus.PASSED
+
+
+def _start_time(results: list[TestResult]) -> float | None:
+    start_times = [r.start_time for r in results if r.start_time is not None]
+    return min(start_times) if start_times else None
+
+
+def _total_duration(results: list[TestResult]) -> float:
+    return sum(result.duration_seconds or 0.0 for result in results)
+
+
+def merge_cell_results(test_name: str, cell_results: list[TestResult]) -> TestResult:
+    """
+    Combine the results of all cells of a test into one result, with a subtree
+    per cell. Cell results must be named after their cell.
+    """
+    failed = [result.name for result in cell_results if not result.ok]
+    return TestResult(
+        name=test_name,
+        status=_merged_status(cell_results),
+        message=f"Failed with {', '.join(failed)}" if failed else "",
+        duration_seconds=_total_duration(cell_results),
+        subtests=cell_results,
+        start_time=_start_time(cell_results),
+    )
+
+
+def merge_shard_results(
+    name: str, shard_results: list[tuple[Shard, TestResult]]
+) -> TestResult:
+    """
+    Combine the results of the shards of a job into one result. Artifact paths
+    are made relative to the results directory of the job, and metrics are
+    summed over the shards.
+    """
+    results = [result for _, result in shard_results]
+    merged = TestResult(
+        name=name,
+        status=_merged_status(results),
+        message="; ".join(result.message for result in results if result.message),
+        duration_seconds=_total_duration(results),
+        start_time=_start_time(results),
+    )
+    for shard, result in shard_results:
+        for metric, value in result.metrics.items():
+            merged.set_metric(metric, merged.metrics.get(metric, 0.0) + value)
+        for subtest in result.subtests:
+            if subtest.artifacts:
+                artifacts = {
+                    role: f"{shard.name}/{path}"
+                    for role, path in subtest.artifacts.items()
+                }
+                subtest = replace(subtest, artifacts=artifacts)
+            merged.add_subtest(subtest)
+    return merged
+
+
+def group_results(
+    jobs: Iterable[Job], results: dict[str, TestResult]
+) -> dict[str, TestResult]:
+    """
+    Group job results (by job name) into a result per test, in test order.
+
+    Shards are merged into the result of their cell. Tests without a config
+    matrix are reported as is, others with a subtree per cell.
+    """
+    jobs_by_cell: dict[str, list[Job]] = {}
+    for job in sorted(jobs, key=lambda job: job.shard.index if job.shard else 0):
+        jobs_by_cell.setdefault(job.cell_name, []).append(job)
+
+    cells_by_test: dict[str, list[tuple[Job, TestResult]]] = {}
+    for cell_jobs in jobs_by_cell.values():
+        job = cell_jobs[0]
+        if job.shard is None:
+            result = results[job.name]
+        else:
+            result = merge_shard_results(
+                job.cell.name or job.test.name,
+                [(j.shard, results[j.name]) for j in cell_jobs if j.shard],
+            )
+        cells_by_test.setdefault(job.test.name, []).append((job, result))
+
+    grouped = {}
+    for test_name, cells in cells_by_test.items():
+        if len(cells) == 1 and not cells[0][0].cell:
+            grouped[test_name] = cells[0][1]
+        else:
+            grouped[test_name] = merge_cell_results(
+                test_name, [result for _, result in cells]
+            )
+    return grouped
+
+
+def job_results_path(results_root: Path, job: Job) -> Path:
+    """Returns the results directory of a job."""
+    path = results_root / job.test.name
+    if job.cell:
+        path /= job.cell.name
+    if job.shard is not None:
+        path /= job.shard.name
+    return path
+
+
+def run_job(
+    job: Job,
+    test_env: Environment,
+    results_root: Path,
+    test_data_root: Path,
+    selection: TestSelection | None = None,
+    retry_policy: RetryPolicy | None = None,
+    listener=None,
+    log_group: bool = True,
+) -> TestResult:
+    """
+    Run a single job, converting any exception into a failed result.
+
+    The result is named after the cell of the job, or the test if it has none.
+    """
+    result_name = job.cell.name or job.test.name
+    if test_env.cancelled:
+        log.info("Test %d - %s: Not run", job.index, job.name)
+        return TestResult(
+            name=result_name,
+            status=TestStatus.FAILED,
+            message=f"Not run, run cancelled: {test_env.budget.token.reason}",
+        )
+    group = (
+        ci.log_group(f"Test {job.index}: {job.name}")
+        if log_group
+        else contextlib.nullcontext()
+    )
+    with group:
+        start_time = time.time()
+        test = None
+        try:
+            log.info("Test %d - %s: Starting", job.index, job.name)
+            test_cls = job.test.load()
+            if test_cls is None:
+                raise TypeError(f"{job.test.name} is not a TestBase")
+            test = test_cls(
+                test_env,
+                job_results_path(results_root, job),
+                test_data_root / job.test.name,
+            )
+            if listener is not None:
+                test.set_result_listener(listener)
+            if selection is not None:
+                test.set_selection(selection)
+            if retry_policy is not None:
+                test.set_retry_policy(retry_policy)
+            test.set_matrix_cell(job.cell)
+            test.set_shard(job.shard)
+            test_result = test.run()
+            log.info("Test %d - %s: Finished", job.index, job.name)
+        except BaseException:
+            log.exception("Test %d - %s: Failed", job.index, job.name)
+            test_result = TestResult(
+                name=result_name,
+                status=TestStatus.FAILED,
+                duration_seconds=time.time() - start_time,
+                start_time=start_time,
+            )
+    test_result.name = result_name
+    if test_env.budget is not None:
+        # Tests may have counted some of their failures while running
+        failures = ResultCounts.count([test_result]).total[TestStatus.FAILED]
+        recorded = test.failures_recorded if test is not None else 0
+        test_env.budget.record_failures(max(0, failures - recorded))
+    return test_result
+
+
+class JobResultListener:
+    """
+    Forwards subtest results of a job to a listener shared by all workers,
+    reporting them under the name of the job.
+    """
+
+    def __init__(self, listener, job: Job, lock: threading.Lock):
+        self.listener = listener
+        self.job = job
+        self.lock = lock
+
+    def subtest_finished(self, test_name: str, subtest: TestResult):
+        with self.lock:
+            self.listener.subtest_finished(self.job.name, subtest)
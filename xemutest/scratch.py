@@ -0,0 +1,132 @@
+"""Scratch space for HDD images and background deletion of directory trees.
+
+HDD images and the files extracted from them are written and read back for every
+xemu launch. Where a tmpfs is available (``/dev/shm`` on Linux), each worker is
+given a scratch directory in it for as long as the memory budget allows, and
+falls back to its work directory on disk otherwise. The HDD image is sparse, so
+a worker only uses the memory of the files written to it.
+
+Directory trees are deleted by renaming them to a hidden sibling, which is
+immediate, and removing them on a background thread. Pending deletions are
+completed when the interpreter exits, or with wait_for_removals().
+"""
+
+import atexit
+import logging
+import os
+import queue
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+
+log = logging.getLogger(__name__)
+
+TMPFS_PATH = Path("/dev/shm")
+# Expected tmpfs usage of one worker: the HDD image and the extracted results
+WORKER_SCRATCH_SIZE = 1024 * 1024 * 1024
+TRASH_MARKER = ".trash-"
+
+
+class _Trash:
+    """Removes directory trees on a background thread."""
+
+    def __init__(self):
+        self._queue: queue.Queue[Path] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._purge, daemon=True)
+                self._thread.start()
+                atexit.register(self.wait)
+
+    def _purge(self):
+        while True:
+            path = self._queue.get()
+            try:
+                shutil.rmtree(path, True)
+            finally:
+                self._queue.task_done()
+
+    def remove(self, path: Path):
+        if not path.exists():
+            return
+        trash_name = f".{path.name}{TRASH_MARKER}{uuid.uuid4().hex[:8]}"
+        trash_path = path.with_name(trash_name)
+        try:
+            path.rename(trash_path)
+        except OSError:
+            log.debug("Failed to move %s to trash, removing it now", path)
+            shutil.rmtree(path, True)
+            return
+        self._start()
+        self._queue.put(trash_path)
+
+    def wait(self):
+        self._queue.join()
+
+
+_trash = _Trash()
+
+
+def remove_tree(path: Path):
+    """Remove a directory tree in the background. It is gone from path at once."""
+    _trash.remove(Path(path))
+
+
+def wait_for_removals():
+    """Wait until the trees passed to remove_tree have been removed."""
+    _trash.wait()
+
+
+def default_budget() -> int:
+    """Returns half of the free tmpfs space, or 0 without a tmpfs."""
+    if os.name != "posix" or not TMPFS_PATH.is_dir():
+        return 0
+    return shutil.disk_usage(TMPFS_PATH).free // 2
+
+
+class ScratchSpace:
+    """Allocates per-worker scratch directories on tmpfs within a memory budget."""
+
+    def __init__(self, budget: int, root: Path = TMPFS_PATH):
+        self.budget = budget
+        self.root = root / f"xemutest-{os.getpid()}"
+        self._allocated: dict[str, Path] = {}
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def allocate(
+        self, name: str, fallback: Path, size: int = WORKER_SCRATCH_SIZE
+    ) -> Path:
+        """Returns the scratch directory of a worker, or fallback if out of budget."""
+        with self._lock:
+            if name in self._allocated:
+                return self._allocated[name]
+            path = fallback
+            if self._used + size <= self.budget:
+                try:
+                    if shutil.disk_usage(self.root.parent).free >= size:
+                        path = self.root / name
+                        path.mkdir(parents=True, exist_ok=True)
+                        self._used += size
+                except OSError as e:
+                    log.warning("tmpfs scratch space unavailable: %s", e)
+                    path = fallback
+            if path == fallback:
+                log.debug("Using %s as scratch space of worker %s", fallback, name)
+            else:
+                log.debug("Using tmpfs %s as scratch space of worker %s", path, name)
+            self._allocated[name] = path
+            return path
+
+    def close(self):
+        """Remove the tmpfs scratch directories."""
+        with self._lock:
+            shutil.rmtree(self.root, True)
+            self._allocated.clear()
+            self._used = 0
@@ -0,0 +1,329 @@
+"""Benchmark of the overhead added by the test harness itself.
+
+Runs TestNxdkPgraphTests against a stand-in for xemu (see fake_xemu.py) that
+produces a configurable number of synthetic test results, and times every harness
+phase: HDD preparation, config writes, extraction, result copying, progress log
+analysis, golden image comparison and result summary generation. The peak memory
+allocated per subtest is measured in one more run, as tracing allocations slows
+the harness down. No BIOS images,
+GPU or display are required, only Linux and pyfatx.
+
+Usage:
+    python -m xemutest.selfbench --subtests 10000 --output selfbench.json
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from . import benchmark
+from .comparators import COMPARE_MODES, GoldenImageComparator
+from .discovery import TestSelection, discover_tests
+from .env import Environment
+from .fake_xemu import fake_test_ids, make_png
+from .golden_store import pack_directory
+from .hdd_manager import HddManager
+from .results_export import ResultExporter
+from .test_base import TestBase, XemuTestBase
+from .xemu_manager import XemuManager
+
+
+log = logging.getLogger(__name__)
+
+# Seconds an entry point may take to import in a fresh interpreter
+IMPORT_BUDGET = 0.15
+# Entry points of the package, and slow modules they must not import
+IMPORT_ENTRY_POINTS = {
+    "xemutest": ("xemutest.test_base", "pyfatx", "pywinauto"),
+    "xemutest.ci": ("xemutest.test_base", "pyfatx", "pywinauto"),
+    "xemutest.results_export": ("pyfatx", "pywinauto"),
+    "xemutest.html_report": ("pyfatx", "pywinauto"),
+    "xemutest.golden_update": ("xemutest.test_base", "pyfatx", "pywinauto"),
+    "xemutest.distributed": ("pyfatx", "pywinauto"),
+    "xemutest.__main__": ("pyfatx", "pywinauto", "http.server"),
+}
+_IMPORT_SCRIPT = """\
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - start
+print(json.dumps([seconds, [name for name in sys.argv[2:] if name in sys.modules]]))
+"""
+
+
+class PhaseTimer:
+    """Accumulates the exclusive time spent in nested phases."""
+
+    def __init__(self):
+        self.totals: dict[str, float] = {}
+        self._stack: list[list] = []  # [phase, start, time spent in children]
+
+    def start(self, phase: str):
+        self._stack.append([phase, time.perf_counter(), 0.0])
+
+    def stop(self):
+        phase, start, children = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.totals[phase] = self.totals.get(phase, 0.0) + elapsed - children
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def wrap(self, phase: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            self.start(phase)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stop()
+
+        return wrapper
+
+    def instrument(self, cls, attr: str, phase: str):
+        """Time calls of cls.attr as the given phase. Returns a function to undo it."""
+        original = cls.__dict__[attr]
+        if isinstance(original, staticmethod):
+            setattr(cls, attr, staticmethod(self.wrap(phase, original.__func__)))
+        else:
+            setattr(cls, attr, self.wrap(phase, original))
+        return lambda: setattr(cls, attr, original)
+
+
+def create_workspace(
+    work_path: Path, num_tests: int, num_suites: int, golden_store: bool = False
+):
+    """Create the private, data and binary files used by the self-benchmark."""
+    private_path = work_path / "private"
+    private_path.mkdir()
+    (private_path / "bios.bin").write_bytes(b"\0" * 1024)
+    (private_path / "mcpx.bin").write_bytes(b"\0" * 512)
+
+    test_data_path = work_path / "data" / "TestNxdkPgraphTests"
+    golden_path = test_data_path / "nxdk_pgraph_tests_golden_results" / "results"
+    png = make_png()
+    for suite, test in fake_test_ids(num_tests, num_suites):
+        suite_path = golden_path / suite.replace(" ", "_")
+        suite_path.mkdir(parents=True, exist_ok=True)
+        (suite_path / f"{test}.png").write_bytes(png)
+    (test_data_path / "nxdk_pgraph_tests_xiso.iso").write_bytes(b"")
+    if golden_store:
+        pack_directory(
+            golden_path, test_data_path / "nxdk_pgraph_tests_golden_results.pack"
+        )
+
+    bin_path = work_path / "bin"
+    bin_path.mkdir()
+    xemu_path = bin_path / "xemu"
+    xemu_path.write_text(
+        f'#!/bin/sh\nexec "{sys.executable}" -m xemutest.fake_xemu "$@"\n'
+    )
+    xemu_path.chmod(0o755)
+
+    return private_path, xemu_path, test_data_path
+
+
+def measure_import(module: str, forbidden: tuple[str, ...]) -> tuple[float, list[str]]:
+    """Import a module in a fresh interpreter.
+
+    Returns the time taken, and the forbidden modules imported along with it.
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_SCRIPT, module, *forbidden],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    seconds, imported = json.loads(output)
+    return seconds, imported
+
+
+def check_imports(report: benchmark.BenchmarkReport, iterations: int, budget: float):
+    """Time the entry point imports. Returns False if any is over budget."""
+    ok = True
+    for module, forbidden in IMPORT_ENTRY_POINTS.items():
+        for _ in range(iterations):
+            seconds, imported = measure_import(module, forbidden)
+            report.add_sample(f"import:{module}", seconds)
+        fastest = min(report.metrics[f"import:{module}"].samples)
+        if fastest > budget:
+            log.error(
+                "Importing %s takes %.0fms, over the budget of %.0fms",
+                module,
+                fastest * 1000,
+                budget * 1000,
+            )
+            ok = False
+        if imported:
+            log.error("Importing %s also imports %s", module, ", ".join(imported))
+            ok = False
+    return ok
+
+
+def run_once(
+    work_path: Path, test_cls, perceptualdiff_path: Path, compare_mode: str = "full"
+) -> dict[str, float]:
+    """Run the pgraph test once against the stand-in and time each phase."""
+    from .__main__ import build_job_summary
+
+    test_module = sys.modules[test_cls.__module__]
+    timer = PhaseTimer()
+    instrumented = [
+        (HddManager, "prepare", "hdd_prepare"),
+        (test_module.NxdkPgraphTestExecutor, "_prepare_hdd", "suite_config_write"),
+        (XemuManager, "launch", "xemu_stand_in"),
+        (HddManager, "extract_files_to", "extract"),
+        (XemuTestBase, "_copy_results", "copy_results"),
+        (test_cls, "_analyze_pgraph_progress_log", "progress_log"),
+        (GoldenImageComparator, "compare_all", "compare"),
+    ]
+    restore = [timer.instrument(*args) for args in instrumented]
+
+    test_env = Environment(
+        work_path / "private",
+        work_path / "bin" / "xemu",
+        None,
+        perceptualdiff_path,
+        compare_mode=compare_mode,
+    )
+    results_root = work_path / "results"
+    cwd = Path.cwd()
+    os.chdir(work_path)
+    try:
+        start = time.perf_counter()
+        test = test_cls(
+            test_env,
+            results_root / test_cls.__name__,
+            work_path / "data" / test_cls.__name__,
+        )
+        result = test.run()
+        if not result.ok:
+            log.warning("Self-benchmark test run failed: %s", result.message)
+
+        timer.start("export")
+        with ResultExporter(results_root) as exporter:
+            for subtest in result.subtests:
+                exporter.subtest_finished(result.name, subtest)
+            exporter.test_finished(result)
+        timer.stop()
+
+        timer.start("job_summary")
+        str(build_job_summary({result.name: result}))
+        timer.stop()
+        timer.totals["total"] = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        for undo in restore:
+            undo()
+
+    timer.totals["subtests"] = len(result.subtests)
+    return timer.totals
+
+
+def measure_memory(
+    work_path: Path, test_cls, perceptualdiff_path: Path, compare_mode: str = "full"
+) -> tuple[int, int]:
+    """Run the pgraph test once, tracing allocations.
+
+    Returns the peak number of bytes allocated, and the number of subtests.
+    """
+    tracemalloc.start()
+    try:
+        totals = run_once(work_path, test_cls, perceptualdiff_path, compare_mode)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, int(totals["subtests"])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--subtests", type=int, default=1000, help="Synthetic tests")
+    ap.add_argument("--suites", type=int, default=50, help="Synthetic suites")
+    ap.add_argument("--iterations", type=int, default=3, help="Measured runs")
+    ap.add_argument(
+        "--golden-store", action="store_true", help="Use a packed golden store"
+    )
+    ap.add_argument(
+        "--compare-mode",
+        choices=COMPARE_MODES,
+        default="full",
+        help="How images are compared, see xemutest/comparators.py",
+    )
+    ap.add_argument("--perceptualdiff", help="Path to the perceptualdiff binary")
+    ap.add_argument("--work-dir", help="Directory for temporary files")
+    ap.add_argument("--output", help="Write phase timings to this JSON file")
+    ap.add_argument("--baseline", help="Fail on regressions against this JSON file")
+    ap.add_argument(
+        "--import-budget",
+        type=float,
+        default=IMPORT_BUDGET,
+        metavar="SECONDS",
+        help="Fail if importing an entry point of the package takes longer",
+    )
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    log.setLevel(logging.INFO)
+    logging.getLogger(benchmark.__name__).setLevel(logging.INFO)
+
+    # Make the stand-in able to import xemutest, and configure its output
+    package_root = str(Path(__file__).resolve().parent.parent)
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package_root, os.environ.get("PYTHONPATH")])
+    )
+    os.environ["XEMUTEST_FAKE_SUBTESTS"] = str(args.subtests)
+    os.environ["XEMUTEST_FAKE_SUITES"] = str(args.suites)
+    perceptualdiff_path = Path(args.perceptualdiff or shutil.which("true"))
+
+    tests_dir = Path(__file__).resolve().parent / "tests"
+    (discovered,) = discover_tests(tests_dir, TestSelection(["TestNxdkPgraphTests"]))
+    test_cls = discovered.load()
+    assert issubclass(test_cls, TestBase)
+
+    report = benchmark.BenchmarkReport(args.iterations, warmup=0)
+    imports_ok = check_imports(report, args.iterations, args.import_budget)
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        work_path = Path(work_dir)
+        log.info("Creating %d synthetic golden images", args.subtests)
+        create_workspace(work_path, args.subtests, args.suites, args.golden_store)
+        for i in range(args.iterations):
+            totals = run_once(
+                work_path, test_cls, perceptualdiff_path, args.compare_mode
+            )
+            log.info(
+                "Iteration %d: %d subtests in %.2fs",
+                i,
+                totals.pop("subtests"),
+                totals["total"],
+            )
+            for phase, seconds in totals.items():
+                report.add_sample(phase, seconds)
+        peak, subtests = measure_memory(
+            work_path, test_cls, perceptualdiff_path, args.compare_mode
+        )
+        report.add_sample("peak_memory_bytes", peak)
+        report.add_sample("peak_memory_per_subtest_bytes", peak / max(subtests, 1))
+
+    comparisons = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        comparisons = benchmark.compare_to_baseline(report, baseline)
+    benchmark.log_report(report, comparisons)
+    if args.output:
+        report.write(Path(args.output))
+    if not imports_ok or (comparisons and any(c.regressed for c in comparisons)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
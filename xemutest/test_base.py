@@ -1,17 +1,64 @@
+import collections
 import logging
+import re
 import shutil
+import sys
+import time
+from collections.abc import Iterable, Iterator
 from dataclasses import dataclass, field
 from enum import Enum, auto
 from pathlib import Path
 
+from .discovery import Shard, TestSelection
 from .env import Environment
 from .video_capture import VideoCapture
 from .hdd_manager import HddManager
+from .matrix import MatrixCell
+from .scratch import remove_tree
 from .xemu_manager import XemuManager
 
 
 log = logging.getLogger(__name__)
 
+DURATION_PART_RE = re.compile(r"([0-9]*\.?[0-9]+)\s*([a-zµ]*)")
+DURATION_UNITS = {
+    "ns": 1e-9,
+    "us": 1e-6,
+    "µs": 1e-6,
+    "ms": 1e-3,
+    "": 1.0,
+    "s": 1.0,
+    "sec": 1.0,
+    "m": 60.0,
+    "min": 60.0,
+    "h": 3600.0,
+}
+
+
+def parse_duration(duration: str) -> float | None:
+    """Parse a duration string (e.g. "43ms", "1.5s", "2m3s") into seconds."""
+    parts = DURATION_PART_RE.findall(duration.strip().lower())
+    if not parts:
+        return None
+    seconds = 0.0
+    for value, unit in parts:
+        if unit not in DURATION_UNITS:
+            return None
+        seconds += float(value) * DURATION_UNITS[unit]
+    return round(seconds, 9)
+
+
+def format_duration(seconds: float) -> str:
+    """Format a duration in seconds in the style of the pgraph progress log."""
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f}us"
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds}s"
+
 
 class TestStatus(Enum):
     """Status of a test or subtest."""
@@ -22,25 +69,125 @@ class TestStatus(Enum):
     UNVERIFIED = auto()  # Test completed but results not verified
 
 
-@dataclass
+class _EmptyDict(dict):
+    """Shared empty dict, which results hold until they have entries of their own."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared empty dict of a result, assign a new dict instead")
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+_EMPTY_DICT = _EmptyDict()
+
+
+def _empty_dict() -> dict:
+    return _EMPTY_DICT
+
+
+@dataclass(slots=True)
 class TestResult:
-    """Result of a test."""
+    """Result of a test.
+
+    Most results are leaf subtests without subtests, metrics or artifacts, so
+    those default to shared empty containers, to keep large result trees small.
+    Use add_subtest and set_metric to add to them.
+    """
 
     name: str
     status: TestStatus
     message: str = ""
-    duration: str = ""  # Duration string (e.g., "43ms")
-    subtests: list["TestResult"] = field(default_factory=list)
+    duration_seconds: float | None = None  # None if unknown
+    subtests: list["TestResult"] | tuple = ()
+    start_time: float | None = None  # Seconds since the epoch
+    attempts: int = 1  # Number of times the test was run
+    failed_attempts: int = 0  # Number of runs that failed
+    metrics: dict[str, float] = field(default_factory=_empty_dict)  # e.g. timings in s
+    # Output files by role (e.g. "actual", "expected", "diff"), relative to the
+    # results directory of the test
+    artifacts: dict[str, str] = field(default_factory=_empty_dict)
+
+    @property
+    def duration(self) -> str:
+        """Returns the duration formatted for display (e.g. "43ms")."""
+        if self.duration_seconds is None:
+            return ""
+        return format_duration(self.duration_seconds)
+
+    def add_subtest(self, subtest: "TestResult"):
+        if not isinstance(self.subtests, list):
+            self.subtests = []
+        self.subtests.append(subtest)
+
+    def set_metric(self, name: str, value: float):
+        if self.metrics is _EMPTY_DICT:
+            self.metrics = {}
+        self.metrics[name] = value
 
     @property
     def ok(self) -> bool:
         """Returns True if the test did not fail (passed or unverified)."""
         return self.status in (TestStatus.PASSED, TestStatus.UNVERIFIED)
 
+    @property
+    def flaky(self) -> bool:
+        """Returns True if the test did not fail but some of its attempts did."""
+        return self.ok and self.failed_attempts > 0
+
+
+def walk_results(
+    result: TestResult, parent_path: str = ""
+) -> Iterator[tuple[str, TestResult]]:
+    """Yield a result and all results below it with their full names, depth first."""
+    full_name = f"{parent_path}::{result.name}" if parent_path else result.name
+    yield full_name, result
+    for subtest in result.subtests:
+        yield from walk_results(subtest, full_name)
+
+
+@dataclass(slots=True)
+class ResultCounts:
+    """Numbers of leaf results (subtests, or tests without any) by status."""
+
+    total: collections.Counter = field(default_factory=collections.Counter)
+    # By the full name of the parent, e.g. "TestNxdkPgraphTests::vulkan::Suite"
+    groups: dict[str, collections.Counter] = field(default_factory=dict)
+
+    @classmethod
+    def count(cls, results: Iterable[TestResult]) -> "ResultCounts":
+        counts = cls()
+        for result in results:
+            for full_name, leaf in walk_results(result):
+                if leaf.subtests:
+                    continue
+                group = full_name.rpartition("::")[0] or full_name
+                counts.total[leaf.status] += 1
+                if group not in counts.groups:
+                    counts.groups[group] = collections.Counter()
+                counts.groups[group][leaf.status] += 1
+        return counts
+
+
+@dataclass
+class RetryPolicy:
+    """Policy for re-running failed subtests to tell flaky failures from real ones."""
+
+    max_retries: int = 0  # Extra attempts for subtests that failed
+
 
 class TestBase:
     """Minimal generic test framework for managing test execution and results."""
 
+    # xemu config keys mapped to the values to test, see matrix.py
+    config_matrix: dict[str, list] = {}
+    # Rough duration of a run in seconds, used to start long tests first until
+    # timings of previous runs are available
+    expected_duration: float = 60.0
+    # Whether the subtests can be split into shards run by separate instances,
+    # by the first component of their names
+    shardable: bool = False
+
     def __init__(
         self,
         test_env: Environment,
@@ -49,17 +196,80 @@ class TestBase:
         self.test_env = test_env
         self.results_path = Path(results_path)
         self._test_result: TestResult | None = None
+        self.result_listener = None
+        self.selection: TestSelection | None = None
+        self.retry_policy = RetryPolicy()
+        self.matrix_cell = MatrixCell()
+        self.shard: Shard | None = None
+        self.log_findings: list[str] = []  # Notable lines of process logs
+        # Whether the run was cancelled before the test could complete
+        self.interrupted = False
+        # Failures already counted against the failure budget during the run
+        self.failures_recorded = 0
+
+    def set_result_listener(self, listener):
+        """Set an object notified of each subtest result as it is added.
+
+        The listener must provide a ``subtest_finished(test_name, subtest)`` method.
+        """
+        self.result_listener = listener
+
+    def set_retry_policy(self, retry_policy: RetryPolicy):
+        """Set the policy for retrying failed subtests."""
+        self.retry_policy = retry_policy
+
+    def set_selection(self, selection: TestSelection):
+        """Restrict the subtests that should be run."""
+        self.selection = selection
+
+    def set_matrix_cell(self, cell: MatrixCell):
+        """Set the config matrix cell to run the test with."""
+        self.matrix_cell = cell
+
+    def set_shard(self, shard: Shard | None):
+        """Restrict the subtests that should be run to a shard."""
+        self.shard = shard
+
+    def record_failures(self, count: int):
+        """Count failures against the failure budget as soon as they are known.
+
+        Failures of the result that are not counted this way are counted when the
+        job finishes.
+        """
+        if count and self.test_env.budget is not None:
+            self.test_env.budget.record_failures(count)
+        self.failures_recorded += count
+
+    def in_shard(self, subtest_id: str) -> bool:
+        """Returns True if the subtest (e.g. ``suite::test``) is in the shard."""
+        return self.shard is None or self.shard.contains(subtest_id)
+
+    def add_log_findings(self, findings: list[str]):
+        """Record crash signatures found in a log, reported in the result message."""
+        self.log_findings.extend(f for f in findings if f not in self.log_findings)
+
+    def subtest_patterns(self) -> list[str] | None:
+        """Returns the selected subtest patterns, or None if all are selected."""
+        if self.selection is None:
+            return None
+        return self.selection.subtest_patterns(type(self).__name__)
 
     def _run(self):
         """Execute the test. Should be implemented by subclass."""
         raise NotImplementedError("Subclass must implement run() method")
 
     def run(self) -> TestResult:
-        shutil.rmtree(self.results_path, True)
+        remove_tree(self.results_path)
+        self.log_findings = []
+        self.interrupted = False
+        self.failures_recorded = 0
         self.results_path.mkdir(parents=True, exist_ok=True)
         self._test_result = TestResult(
-            name=type(self).__name__, status=TestStatus.RUNNING
+            name=type(self).__name__,
+            status=TestStatus.RUNNING,
+            start_time=time.time(),
         )
+        start = time.monotonic()
         try:
             self._run()
             self.analyze_results()
@@ -69,6 +279,20 @@ class TestBase:
             log.exception("Test failed with exception")
             self._test_result.status = TestStatus.FAILED
             self._test_result.message = str(e)
+        if self.interrupted:
+            # Results of the parts that ran are kept
+            self._test_result.status = TestStatus.FAILED
+            cancelled = f"Cancelled: {self.test_env.budget.token.reason}"
+            if self._test_result.message:
+                cancelled = f"{cancelled} ({self._test_result.message})"
+            self._test_result.message = cancelled
+        if self.log_findings:
+            findings = "xemu log: " + "; ".join(self.log_findings)
+            if self._test_result.message:
+                findings = f"{self._test_result.message} ({findings})"
+            self._test_result.message = findings
+        if self._test_result.duration_seconds is None:
+            self._test_result.duration_seconds = time.monotonic() - start
         return self._test_result
 
     def analyze_results(self):
@@ -79,14 +303,40 @@ class TestBase:
         pass
 
     def add_subtest_result(
-        self, name: str, status: TestStatus, message: str = "", duration: str = ""
+        self,
+        name: str,
+        status: TestStatus,
+        message: str = "",
+        duration_seconds: float | None = None,
+        attempts: int = 1,
+        failed_attempts: int = 0,
+        metrics: dict[str, float] | None = None,
+        artifacts: dict[str, str] | None = None,
     ):
         """Add a subtest result to the test results."""
+        self.add_subtest(
+            TestResult(
+                # Names repeat across config matrix cells and shards
+                sys.intern(name),
+                status,
+                message,
+                duration_seconds,
+                attempts=attempts,
+                failed_attempts=failed_attempts,
+                metrics=metrics or _EMPTY_DICT,
+                artifacts=artifacts or _EMPTY_DICT,
+            )
+        )
+
+    def add_subtest(self, subtest: TestResult):
+        """Add a finished subtest to the test results."""
         if self._test_result is None:
             return
-        self._test_result.subtests.append(TestResult(name, status, message, duration))
-        if status == TestStatus.FAILED:
+        self._test_result.add_subtest(subtest)
+        if subtest.status == TestStatus.FAILED:
             self._test_result.status = TestStatus.FAILED
+        if self.result_listener is not None:
+            self.result_listener.subtest_finished(self._test_result.name, subtest)
 
 
 class XemuTestBase(TestBase):
@@ -95,27 +345,47 @@ class XemuTestBase(TestBase):
     def __init__(self, test_env: Environment, results_path: Path):
         super().__init__(test_env, results_path)
 
-        self.hdd_path = Path.cwd() / "test.img"
+        self.work_path = test_env.work_path or Path.cwd()
+        self.scratch_path = test_env.scratch_path or self.work_path
+        self.hdd_path = self.scratch_path / "test.img"
         self.xbox_results_path: str | None = None
         self.hdd_manager = HddManager(self.hdd_path)
         self.xemu_manager = XemuManager(test_env, self.hdd_path)
         self.video_capture = VideoCapture(test_env, self.results_path / "capture.mp4")
         self.xemu_manager.set_video_capture(self.video_capture)
 
+    def set_matrix_cell(self, cell: MatrixCell):
+        super().set_matrix_cell(cell)
+        self.xemu_manager.config.set_layer("matrix", cell.overrides)
+
     def _prepare_hdd(self):
         """Prepare the HDD image for testing."""
         self.hdd_manager.prepare()
 
     def _launch_xemu(self):
         """Launch xemu and wait for it to complete or timeout."""
-        with open(self.results_path / "xemu.log", "w") as log_file:
-            self.xemu_manager.launch(log_file)
+        display_pool = self.test_env.display_pool
+        log_path = self.results_path / "xemu.log"
+        if display_pool is None:
+            self.xemu_manager.launch(log_path)
+        else:
+            with display_pool.lease() as display:
+                self.xemu_manager.display = display
+                self.video_capture.display = display
+                self.xemu_manager.launch(log_path)
+        self.add_log_findings(self.xemu_manager.log_findings)
+        if self.xemu_manager.cancelled:
+            self.interrupted = True
+        if self._test_result is not None:
+            self._test_result.set_metric(
+                "xemu_wall_time", self.xemu_manager.run_duration
+            )
 
     def _copy_results(self):
         """Copy test results from the mounted HDD and xemu configuration."""
         log.info("Copying test results...")
         if self.xbox_results_path:
-            temp_extract_path = Path.cwd() / "xemu-hdd-mount"
+            temp_extract_path = self.scratch_path / "xemu-hdd-mount"
             self.hdd_manager.extract_files_to(temp_extract_path)
             shutil.copytree(
                 temp_extract_path / self.xbox_results_path,
@@ -126,6 +396,9 @@ class XemuTestBase(TestBase):
 
     def _run(self):
         """Execute the xemu test."""
+        if self.test_env.cancelled:
+            self.interrupted = True
+            return
         self._prepare_hdd()
         self._launch_xemu()
         self._copy_results()
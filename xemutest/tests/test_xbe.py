@@ -1,8 +1,12 @@
 """Test harness for test-xbe."""
 
+import logging
 from pathlib import Path
 
-from xemutest import Environment, XemuTestBase
+from xemutest import Environment, TestStatus, XemuTestBase
+from xemutest.guest_results import RESULTS_FILE_NAME, read_guest_results
+
+log = logging.getLogger(__name__)
 
 
 class TestXBE(XemuTestBase):
@@ -19,5 +23,29 @@ class TestXBE(XemuTestBase):
         self.xbox_results_path = "results"
 
     def analyze_results(self):
-        results_file = self.results_path / "results.txt"
-        assert results_file.read_text().strip() == "Success"
+        guest_results_file = self.results_path / RESULTS_FILE_NAME
+        if not guest_results_file.is_file():
+            # Written by older builds of test-xbe
+            results_file = self.results_path / "results.txt"
+            assert results_file.read_text().strip() == "Success"
+            return
+
+        failed = []
+        try:
+            for record in read_guest_results(guest_results_file):
+                if record.status == TestStatus.FAILED:
+                    log.error("%s: %s", record.name, record.message)
+                    failed.append(record.name)
+                self.add_subtest_result(
+                    record.name,
+                    record.status,
+                    record.message,
+                    record.seconds,
+                    metrics={"guest_seconds": record.seconds},
+                )
+        except ValueError as e:
+            raise Exception(f"Malformed guest results: {e}") from e
+        if failed:
+            raise Exception(f"{len(failed)} check(s) failed: {', '.join(failed)}")
+        if not (self.results_path / "results.txt").is_file():
+            raise Exception("test-xbe did not complete")
@@ -0,0 +1,234 @@
+"""Test harness for batches of small test XBEs run in one xemu session.
+
+The test XBEs and a manifest of their names are written to E:/xemutest, and xemu
+boots the launcher (test-xbe-launcher), which launches them one after another.
+Each test writes C:/results/results.txt, and optionally structured results (see
+xemutest/guest_results.py), and reboots into the launcher, which moves them to
+C:/results/<name>/ and launches the next test, so that a test costs a title
+launch instead of a full xemu boot. The launcher logs its progress to
+C:/results/batch_progress.txt. Tests that were not reached because xemu crashed
+or timed out are run in another launch.
+"""
+
+import logging
+import re
+from dataclasses import dataclass, field
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+from xemutest import ci, Environment, TestBase, TestStatus, XemuTestBase
+from xemutest.guest_results import RESULTS_FILE_NAME, read_guest_results
+
+log = logging.getLogger(__name__)
+
+BATCH_PATH = "/xemutest"
+STARTING_RE = re.compile(r"^Starting (?P<name>\S+)")
+LAUNCH_FAILED_RE = re.compile(r"^Failed to launch (?P<name>\S+)")
+SECONDS_PER_TEST = 30  # Added to the xemu timeout for each test of a batch
+INCOMPLETE_MESSAGE = "Test did not complete"
+
+
+class XBEBatchExecutor(XemuTestBase):
+    """Runs test XBEs through the launcher in one xemu session."""
+
+    def __init__(
+        self,
+        test_env: Environment,
+        results_path: Path,
+        test_data_path: Path,
+        xbe_paths: dict[str, Path],
+    ):
+        super().__init__(test_env, results_path)
+        self.xemu_manager.iso_path = test_data_path / "launcher.iso"
+        self.xemu_manager.timeout = 60 + SECONDS_PER_TEST * len(xbe_paths)
+        self.xbox_results_path = "results"
+        self.xbe_paths = xbe_paths
+
+    def _prepare_hdd(self):
+        super()._prepare_hdd()
+
+        log.debug("Writing batch of %d test XBE(s)", len(self.xbe_paths))
+        fs_e = self.hdd_manager.get_filesystem("e")
+        fs_e.mkdir(BATCH_PATH)
+        fs_e.mkdir(f"{BATCH_PATH}/tests")
+        for name, path in self.xbe_paths.items():
+            fs_e.write(f"{BATCH_PATH}/tests/{name}.xbe", path.read_bytes())
+        fs_e.write(
+            f"{BATCH_PATH}/batch.txt",
+            "".join(f"{name}\n" for name in self.xbe_paths).encode("ascii"),
+        )
+        del fs_e
+
+
+@dataclass
+class XBETestResult:
+    name: str
+    status: TestStatus = TestStatus.FAILED
+    message: str = "Not run"
+    attempts: int = 0
+    failed_attempts: int = 0
+    seconds: float | None = None  # Guest time of the recorded checks
+    metrics: dict[str, float] = field(default_factory=dict)  # Guest time by check
+
+
+class TestXBEBatch(TestBase):
+    """Runs small test XBEs in as few xemu launches as possible."""
+
+    def __init__(
+        self,
+        test_env: Environment,
+        results_path: Path,
+        test_data_path: Path,
+    ):
+        super().__init__(test_env, results_path)
+        self.test_data_path = test_data_path
+        self._xbe_paths: dict[str, Path] = {}
+        self._results: dict[str, XBETestResult] = {}
+
+    def _selected_xbe_paths(self) -> dict[str, Path]:
+        patterns = self.subtest_patterns()
+        return {
+            path.stem: path
+            for path in sorted((self.test_data_path / "tests").glob("*.xbe"))
+            if patterns is None or any(fnmatchcase(path.stem, p) for p in patterns)
+        }
+
+    def _run_batch(self, relative_results_path: Path, xbe_paths: dict[str, Path]):
+        """Launch xemu once and record the result of every test that was started."""
+        results_path = self.results_path / relative_results_path
+        executor = XBEBatchExecutor(
+            self.test_env, results_path, self.test_data_path, xbe_paths
+        )
+        executor.set_matrix_cell(self.matrix_cell)
+        executor.run()
+        self.add_log_findings(executor.log_findings)
+        if executor.interrupted:
+            self.interrupted = True
+
+        progress_path = results_path / "batch_progress.txt"
+        if not progress_path.is_file():
+            if not executor.interrupted:
+                log.error("Launcher did not start, see %s", results_path / "xemu.log")
+            return
+        started = []
+        for line in progress_path.read_text().splitlines():
+            if match := STARTING_RE.match(line):
+                started.append(match.group("name"))
+                self._record_result(started[-1], results_path)
+            elif match := LAUNCH_FAILED_RE.match(line):
+                result = self._results[match.group("name")]
+                result.status = TestStatus.FAILED
+                result.message = "Failed to launch"
+        if executor.interrupted:
+            if started and self._results[started[-1]].message == INCOMPLETE_MESSAGE:
+                self._results[started[-1]].message = "Cancelled before it completed"
+        elif self.test_env.budget is not None:
+            self.test_env.budget.record_tests(
+                len(started),
+                sum(
+                    1
+                    for name in started
+                    if self._results[name].message == INCOMPLETE_MESSAGE
+                ),
+            )
+
+    def _record_result(self, name: str, results_path: Path):
+        result = self._results[name]
+        result.attempts += 1
+        results_file = results_path / name / "results.txt"
+        if not results_file.is_file():
+            result.status = TestStatus.FAILED
+            result.message = INCOMPLETE_MESSAGE
+        elif results_file.read_text().strip() != "Success":
+            result.status = TestStatus.FAILED
+            result.message = results_file.read_text().strip()[:200]
+        else:
+            result.status = TestStatus.PASSED
+            result.message = ""
+        self._record_guest_results(result, results_path / name / RESULTS_FILE_NAME)
+        if result.status == TestStatus.FAILED:
+            result.failed_attempts += 1
+
+    def _record_guest_results(self, result: XBETestResult, path: Path):
+        """Add the checks recorded by the XBE, see test-xbe/xemutest_results.h."""
+        result.seconds = None
+        result.metrics.clear()
+        if not path.is_file():
+            return
+        failure = None
+        try:
+            for record in read_guest_results(path):
+                result.metrics[record.name] = record.seconds
+                if record.status == TestStatus.FAILED and failure is None:
+                    failure = record
+        except ValueError as e:
+            # e.g. the XBE crashed before writing the header
+            log.error("%s: Malformed guest results: %s", result.name, e)
+            if result.status != TestStatus.FAILED:
+                result.status = TestStatus.FAILED
+                result.message = f"Malformed guest results: {e}"
+        if failure is not None:
+            result.status = TestStatus.FAILED
+            result.message = f"{failure.name}: {failure.message}"
+        result.seconds = sum(result.metrics.values())
+
+    def _pending(self) -> dict[str, Path]:
+        """Returns the tests that have not run, or failed and may be retried."""
+        return {
+            name: self._xbe_paths[name]
+            for name, result in self._results.items()
+            if result.attempts == 0
+            or (
+                result.status == TestStatus.FAILED
+                and result.attempts <= self.retry_policy.max_retries
+            )
+        }
+
+    def _run(self):
+        self._xbe_paths = self._selected_xbe_paths()
+        if not self._xbe_paths:
+            raise Exception("No test XBEs match the selection")
+        self._results = {name: XBETestResult(name) for name in self._xbe_paths}
+
+        num_launches = 0
+        while pending := self._pending():
+            with ci.log_group(f"Batch {num_launches}"):
+                log.info("Running batch of %d test XBE(s)", len(pending))
+                started = sum(result.attempts for result in self._results.values())
+                self._run_batch(Path(f"launch_{num_launches}"), pending)
+                num_launches += 1
+            if self.interrupted:
+                log.warning("Run cancelled, reporting the tests run so far")
+                break
+            if sum(r.attempts for r in self._results.values()) == started:
+                log.error("No test XBEs were started, giving up")
+                break
+
+    def analyze_results(self):
+        for result in self._results.values():
+            message = result.message
+            if result.status == TestStatus.FAILED:
+                log.error("%s: %s", result.name, message)
+                if result.attempts > 1:
+                    message = f"{message} (failed all {result.attempts} attempts)"
+            elif result.failed_attempts:
+                message = (
+                    f"Flaky: failed {result.failed_attempts} of "
+                    f"{result.attempts} attempts"
+                )
+                log.warning("%s: %s", result.name, message)
+            self.add_subtest_result(
+                result.name,
+                result.status,
+                message,
+                result.seconds,
+                attempts=max(result.attempts, 1),
+                failed_attempts=result.failed_attempts,
+                metrics=result.metrics,
+            )
+
+        failed_count = sum(
+            1 for r in self._results.values() if r.status == TestStatus.FAILED
+        )
+        if failed_count:
+            raise Exception(f"{failed_count} test(s) failed")
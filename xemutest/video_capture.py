@@ -17,6 +17,7 @@ class VideoCapture:
         self.test_env = test_env
         self.video_capture_path = video_capture_path
         self.ffmpeg = None
+        self.display: str | None = None  # X display to capture (non-Windows)
         self.record_x: int = 0
         self.record_y: int = 0
         self.record_w: int = 0
@@ -76,7 +77,7 @@ class VideoCapture:
                 "-f",
                 "x11grab",
                 "-i",
-                os.environ.get("DISPLAY", ":0"),
+                self.display or os.environ.get("DISPLAY", ":0"),
                 "-c:v",
                 "libx264",
                 "-preset",
@@ -101,4 +102,10 @@ class VideoCapture:
         if not self.test_env.video_capture_enabled or self.ffmpeg is None:
             return
         log.info("Shutting down FFMPEG")
-        self.ffmpeg.communicate(b"q\n", timeout=5)
+        try:
+            self.ffmpeg.communicate(b"q\n", timeout=5)
+        except subprocess.TimeoutExpired:
+            log.warning("FFMPEG did not exit, killing it")
+            self.ffmpeg.kill()
+            self.ffmpeg.wait()
+        self.ffmpeg = None
@@ -0,0 +1,152 @@
+"""Structured xemu configuration.
+
+The configuration is built from named layers (e.g. base, per-test, renderer,
+config matrix cell) that are deep-merged in the order they were added, so that
+later layers override earlier ones. Keys may be given as nested tables or with
+dotted names such as ``display.renderer``. The merged configuration serializes
+to TOML deterministically. Its digest leaves out the tables of host-specific
+paths, such as the HDD image below the per-process scratch directory, so that it
+identifies a configuration variant across runs and workers, e.g. in logs.
+"""
+
+import hashlib
+from pathlib import PurePath
+
+
+ConfigValue = str | bool | int | float | list
+# Tables of paths on the host, which are not part of the configuration variant
+HOST_SPECIFIC_TABLES = ("sys.files",)
+
+
+def _expand(overrides: dict) -> dict:
+    """Expand dotted keys into nested tables and validate values."""
+    expanded: dict = {}
+    for key, value in overrides.items():
+        *tables, name = key.split(".")
+        target = expanded
+        for table in tables:
+            target = target.setdefault(table, {})
+            if not isinstance(target, dict):
+                raise ValueError(f"{key} conflicts with a value of the same name")
+        if isinstance(value, dict):
+            value = _expand(value)
+        elif isinstance(value, PurePath):
+            value = str(value)
+        elif not isinstance(value, ConfigValue):
+            raise TypeError(f"Unsupported type {type(value).__name__} for {key}")
+        if isinstance(value, dict) and isinstance(target.get(name), dict):
+            _merge_into(target[name], value)
+        else:
+            target[name] = value
+    return expanded
+
+
+def _merge_into(target: dict, overrides: dict):
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge_into(target[key], value)
+        elif isinstance(value, dict):
+            target[key] = {}
+            _merge_into(target[key], value)
+        else:
+            target[key] = value
+
+
+def _format_value(value) -> str:
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(_format_value(v) for v in value) + "]"
+    if "'" not in value and "\n" not in value:
+        # Literal strings keep Windows paths readable
+        return f"'{value}'"
+    escaped = (
+        value.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\t", "\\t")
+    )
+    return f'"{escaped}"'
+
+
+def _format_table(lines: list[str], name: str, table: dict):
+    values = sorted((k, v) for k, v in table.items() if not isinstance(v, dict))
+    if values or not name:
+        if name:
+            lines.append(f"[{name}]")
+        lines.extend(f"{k} = {_format_value(v)}" for k, v in values)
+        lines.append("")
+    for key in sorted(k for k, v in table.items() if isinstance(v, dict)):
+        _format_table(lines, f"{name}.{key}" if name else key, table[key])
+
+
+class XemuConfig:
+    """Layered xemu configuration."""
+
+    def __init__(self, base: dict | None = None):
+        self._layers: dict[str, dict] = {}
+        self._merged: dict | None = None
+        self._toml: str | None = None
+        if base:
+            self.set_layer("base", base)
+
+    def set_layer(self, name: str, overrides: dict):
+        """Add a layer, or replace the layer of the same name in place."""
+        self._layers[name] = _expand(overrides)
+        self._merged = self._toml = None
+
+    def remove_layer(self, name: str):
+        self._layers.pop(name, None)
+        self._merged = self._toml = None
+
+    @property
+    def layers(self) -> list[str]:
+        return list(self._layers)
+
+    @property
+    def data(self) -> dict:
+        """The merged configuration. Do not modify it, use set_layer instead."""
+        if self._merged is None:
+            merged: dict = {}
+            for layer in self._layers.values():
+                _merge_into(merged, layer)
+            self._merged = merged
+        return self._merged
+
+    def get(self, key: str, default=None):
+        """Returns the merged value of a dotted key."""
+        value = self.data
+        for part in key.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return default
+            value = value[part]
+        return value
+
+    def to_toml(self) -> str:
+        if self._toml is None:
+            lines: list[str] = []
+            _format_table(lines, "", self.data)
+            self._toml = "\n".join(lines).lstrip("\n")
+        return self._toml
+
+    @property
+    def digest(self) -> str:
+        """SHA-256 hex digest of the configuration, without host-specific paths."""
+        data = dict(self.data)
+        for key in HOST_SPECIFIC_TABLES:
+            *tables, name = key.split(".")
+            parent = data
+            for table in tables:
+                if not isinstance(parent.get(table), dict):
+                    break
+                parent[table] = parent = dict(parent[table])
+            else:
+                parent.pop(name, None)
+        lines: list[str] = []
+        _format_table(lines, "", data)
+        return hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()
+
+    def __str__(self) -> str:
+        return self.to_toml()
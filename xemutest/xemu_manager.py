@@ -1,14 +1,18 @@
 import logging
+import os
 import platform
 import subprocess
 import time
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-if platform.system() == "Windows":
+if TYPE_CHECKING:
     import pywinauto.application
 
 from .env import Environment
+from .log_capture import LogCapture
 from .video_capture import VideoCapture
+from .xemu_config import XemuConfig
 
 
 log = logging.getLogger(__name__)
@@ -23,13 +27,17 @@ class XemuManager:
         hdd_path: Path,
     ):
         self.test_env = test_env
-        self.config_path = Path("xemu.toml")
+        self.config_path = (test_env.work_path or Path()) / "xemu.toml"
         self.flash_path = test_env.private_path / "bios.bin"
         self.mcpx_path = test_env.private_path / "mcpx.bin"
         self.hdd_path = hdd_path
         self.iso_path: Path | None = None
         self.timeout = 60
         self.exit_status = None
+        self.run_duration: float | None = None  # Wall time of the last launch
+        self.display: str | None = None  # X display, if not the inherited one
+        self.log_findings: list[str] = []  # Crash signatures in the last log
+        self.cancelled = False  # Whether the last launch was cut short
         self.video_capture: VideoCapture | None = None
         self._init_config()
 
@@ -37,50 +45,59 @@ class XemuManager:
         assert self.mcpx_path.is_file()
 
         if platform.system() == "Windows":
-            self.app: pywinauto.application.Application | None = None
+            self.app: "pywinauto.application.Application | None" = None
 
     def set_video_capture(self, video_capture: VideoCapture):
         """Set the video capture manager."""
         self.video_capture = video_capture
 
     def _init_config(self):
-        """Prepare the xemu configuration file."""
-        self.config = f"""\
-[general]
-show_welcome = false
-skip_boot_anim = true
-
-[display.ui]
-show_menubar = false
-
-[general.updates]
-check = false
-
-[net]
-enable = false
-
-[sys]
-mem_limit = '64'
+        """Prepare the base xemu configuration."""
+        self.config = XemuConfig(
+            {
+                "general": {"show_welcome": False, "skip_boot_anim": True},
+                "general.updates.check": False,
+                "display.ui.show_menubar": False,
+                "net.enable": False,
+                "sys.mem_limit": "64",
+                "sys.files": {
+                    "bootrom_path": self.mcpx_path,
+                    "flashrom_path": self.flash_path,
+                    "hdd_path": self.hdd_path,
+                },
+            }
+        )
 
-[sys.files]
-bootrom_path = '{self.mcpx_path}'
-flashrom_path = '{self.flash_path}'
-hdd_path = '{self.hdd_path}'
-"""
+    def launch(self, log_path: Path):
+        """Launch xemu and wait for it to complete or timeout.
 
-    def launch(self, log_file):
-        """Launch xemu and wait for it to complete or timeout."""
-        self.config_path.write_text(self.config)
+        The output of xemu is written to a size-bounded log file and scanned for
+        crash signatures, which are stored in log_findings.
+        """
+        self.config_path.write_text(self.config.to_toml())
+        log.debug("Using xemu config %s", self.config.digest[:12])
         c = [str(self.test_env.xemu_path), "-config_path", str(self.config_path)]
         if self.iso_path:
             c += ["-dvd_path", str(self.iso_path)]
         log.debug(
             "Launching xemu with command %s from directory %s", repr(c), Path.cwd()
         )
-        start = time.time()
-        xemu = subprocess.Popen(c, stdout=log_file, stderr=subprocess.STDOUT)
+        env = None
+        if self.display:
+            env = dict(os.environ, DISPLAY=self.display)
+            log.debug("Using display %s", self.display)
+        start = time.monotonic()
+        self.cancelled = False
+        xemu = subprocess.Popen(
+            c, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
+        )
+        log_capture = LogCapture(log_path)
+        log_capture.start(xemu.stdout)
 
         if platform.system() == "Windows":
+            # Slow to import, and only needed on Windows
+            import pywinauto.application
+
             try:
                 self.app = pywinauto.application.Application()
                 self.app.connect(process=xemu.pid)
@@ -115,7 +132,11 @@ hdd_path = '{self.hdd_path}'
             )
 
         while True:
-            status = xemu.poll()
+            try:
+                # Returns as soon as xemu exits, so run_duration is accurate
+                status = xemu.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                status = None
             if status is not None:
                 if status:
                     log.error("xemu exited with code %d", status)
@@ -123,13 +144,31 @@ hdd_path = '{self.hdd_path}'
                     log.debug("xemu exited with code 0")
                 self.exit_status = status
                 break
-            now = time.time()
-            if (now - start) > self.timeout:
+            if (time.monotonic() - start) > self.timeout:
                 log.warning("Timeout exceeded. Terminating.")
                 xemu.kill()
                 xemu.wait()
                 break
-            time.sleep(1)
+            if self.test_env.budget is not None:
+                self.test_env.budget.check_time()
+            if self.test_env.cancelled:
+                log.warning("Run cancelled. Terminating xemu.")
+                self._terminate(xemu)
+                self.cancelled = True
+                break
+        self.run_duration = time.monotonic() - start
+        log_capture.close()
+        self.log_findings = log_capture.findings
 
         if self.video_capture:
             self.video_capture.stop()
+
+    @staticmethod
+    def _terminate(xemu: subprocess.Popen, timeout: float = 5):
+        """Ask xemu to exit, and kill it if it does not in time."""
+        xemu.terminate()
+        try:
+            xemu.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            xemu.kill()
+            xemu.wait()